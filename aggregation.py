@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+from helpers import to_local
+from settings import SHIFT_START
+
+shift_start = datetime.strptime(SHIFT_START, "%H:%M").time()
+
+
+# Pair a punch with the previous ones of the day; punches alternate IN & OUT in order of time
+def pair_punch(punch_count: int, open_since: datetime, punch_time: datetime):
+    """
+    Pair the next punch of a day
+    :param punch_count: number of punches of the day before this one
+    :param open_since: time of the IN punch waiting for an OUT punch
+    :param punch_time: UTC timestamp of punch
+    :return: time of the IN punch waiting after this one & duration of the session
+        closed by this punch, None if this punch is an IN punch
+    """
+    if punch_count % 2 == 0:
+        return punch_time, None
+    return None, punch_time - open_since
+
+
+# Whether the first IN punch of a day is after the start of shift
+def is_late(first_in: datetime):
+    return first_in is not None and to_local(first_in).time() > shift_start
+
+
+# Remarks of an employee's day from their first punch and number of punches
+def day_remarks(first_in: datetime, punch_count: int):
+    """
+    :param first_in: UTC timestamp of first IN punch of the day
+    :param punch_count: number of punches of the day
+    :return: list of remarks; late arrival and missing OUT punch
+    """
+    remarks = []
+    if is_late(first_in):
+        remarks.append("Late")
+    if punch_count % 2:
+        remarks.append("Missing OUT")
+    return remarks
+
+
+class DayAttendance:
+    """
+    Completed attendance of an employee on a local day paired as IN & OUT punches
+    """
+
+    def __init__(self, user_id: int, day, user=None):
+        """
+        :param user_id: user ID of the employee
+        :param day: local date
+        :param user: employee; when loaded along with the records
+        """
+        self.user_id = user_id
+        self.day = day
+        self.user = user
+        self.punches = []  # (record, duration of session closed by it or None)
+        self.first_in = None
+        self.last_out = None
+        self.open_since = None
+        self.worked = timedelta()
+
+    def add_punch(self, record):
+        """
+        Add the next attendance record of the day; records must be added in order of time
+        :param record: completed attendance record
+        """
+        punch_time = record.selfie_time
+        self.open_since, duration = pair_punch(
+            len(self.punches), self.open_since, punch_time
+        )
+        if duration is None:
+            if self.first_in is None:
+                self.first_in = punch_time
+        else:
+            self.last_out = punch_time
+            self.worked += duration
+        self.punches.append((record, duration))
+
+    @property
+    def late(self):
+        return is_late(self.first_in)
+
+    @property
+    def missing_punch(self):
+        return len(self.punches) % 2 == 1
+
+    @property
+    def remarks(self):
+        return day_remarks(self.first_in, len(self.punches))
+
+
+def aggregate(attendance_records, with_user: bool = False):
+    """
+    Group attendance records by employee & local day in a single pass
+    :param attendance_records: iterable of records sorted by user ID & selfie time; either
+        attendance records or (attendance, user) pairs
+    :param with_user: whether the records are (attendance, user) pairs
+    :return: iterator of DayAttendance in the same order
+    """
+    day_attendance = None
+    for item in attendance_records:
+        if with_user:
+            record, user = item
+        else:
+            record, user = item, None
+        day = to_local(record.selfie_time).date()
+        if (
+            day_attendance is None
+            or day_attendance.user_id != record.user_id
+            or day_attendance.day != day
+        ):
+            if day_attendance is not None:
+                yield day_attendance
+            day_attendance = DayAttendance(record.user_id, day, user)
+        day_attendance.add_punch(record)
+    if day_attendance is not None:
+        yield day_attendance
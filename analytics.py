@@ -0,0 +1,263 @@
+"""
+Vectorised attendance reports for large ranges; needs pandas
+
+Attendance of the range is loaded into columns at once and converted, grouped
+by employee & local day, paired and formatted as whole columns instead of one
+record at a time. Produces the same tables as the row by row reports.
+"""
+from datetime import date, datetime
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:  # Optional; reports are rendered row by row without it
+    np = pd = None
+
+from sqlalchemy import select
+
+from aggregation import shift_start
+from db_backend import db_session
+from exporters import ReportTable
+from models import Attendance, DailyAttendanceSummary, User
+from settings import ORG_TIMEZONE
+
+LOCAL_TZ = ORG_TIMEZONE
+
+
+def available():
+    return pd is not None
+
+
+def load_attendance(start_time: datetime, end_time: datetime, user_id: int = None):
+    """
+    Load the completed attendance records with in a time range into a data frame
+    :param start_time: UTC timestamp; inclusive
+    :param end_time: UTC timestamp; exclusive
+    :param user_id: user ID of user; all users if not provided
+    :return: data frame sorted by user & selfie time
+    """
+    query = (
+        select(
+            Attendance.user_id,
+            User.employee_id,
+            Attendance.selfie_time,
+            Attendance.location_time,
+            Attendance.location["longitude"].as_float().label("longitude"),
+            Attendance.location["latitude"].as_float().label("latitude"),
+        )
+        .join(User, User.id == Attendance.user_id)
+        .where(
+            Attendance.selfie_time >= start_time,
+            Attendance.selfie_time < end_time,
+            Attendance.location_time >= start_time,
+            Attendance.location_time < end_time,
+        )
+        .order_by(Attendance.user_id, Attendance.selfie_time)
+    )
+    if user_id:
+        query = query.where(Attendance.user_id == user_id)
+    # Connection of the worker's session; a second one could wait on a pool it exhausts
+    result = db_session.connection().execute(query)
+    return pd.DataFrame.from_records(result.all(), columns=list(result.keys()))
+
+
+def load_summaries(start_day: date, end_day: date, user_id: int = None):
+    """
+    Load the day wise summaries with in a range of dates into a data frame
+    :param start_day: local date; inclusive
+    :param end_day: local date; inclusive
+    :param user_id: user ID of user; all users if not provided
+    :return: data frame sorted by user & day
+    """
+    summary = DailyAttendanceSummary
+    query = (
+        select(
+            User.employee_id,
+            summary.day,
+            summary.first_in,
+            summary.last_out,
+            summary.sessions,
+            summary.worked_seconds,
+        )
+        .join(User, User.id == summary.user_id)
+        .where(summary.day >= start_day, summary.day <= end_day)
+        .order_by(summary.user_id, summary.day)
+    )
+    if user_id:
+        query = query.where(summary.user_id == user_id)
+    result = db_session.connection().execute(query)
+    return pd.DataFrame.from_records(result.all(), columns=list(result.keys()))
+
+
+# Duration in seconds as HH:MM
+def format_durations(seconds):
+    minutes = seconds // 60
+    hours = (minutes // 60).astype(str).str.zfill(2)
+    return hours + ":" + (minutes % 60).astype(str).str.zfill(2)
+
+
+# Naive UTC timestamps as DD-MM-YYYY HH:MM in local time
+def format_times(utc_times):
+    local_times = (
+        utc_times.dt.tz_localize("UTC").dt.tz_convert(LOCAL_TZ).dt.tz_localize(None)
+    )
+    iso = pd.Series(
+        np.datetime_as_string(local_times.to_numpy().astype("datetime64[m]")),
+        index=utc_times.index,
+    ).str
+    return iso[8:10] + "-" + iso[5:7] + "-" + iso[:4] + " " + iso[11:16]
+
+
+# Naive UTC timestamps as HH:MM in local time; empty where there's none
+def format_clock_times(utc_times):
+    utc_times = pd.to_datetime(utc_times)
+    clock_times = format_times(utc_times.fillna(pd.Timestamp(0))).str[11:]
+    return clock_times.where(utc_times.notna(), "")
+
+
+def aggregate_frame(frame):
+    """
+    Group punches by employee & local day, pair them as IN & OUT and add the columns of the
+    report: local selfie & location time, time diff of each OUT punch and remarks of the day
+    on its last punch
+    :param frame: attendance sorted by user & selfie time; from load_attendance
+    """
+    selfie_time = frame["selfie_time"].dt.tz_localize("UTC").dt.tz_convert(LOCAL_TZ)
+    day = selfie_time.dt.normalize()
+
+    days = frame.assign(day=day).groupby(["user_id", "day"], sort=False)
+    punch = days.cumcount()
+    punches = days["selfie_time"].transform("size")
+    is_out = (punch % 2 == 1).to_numpy()
+
+    seconds = pd.Series(
+        frame["selfie_time"].to_numpy().astype("datetime64[s]").astype("int64"),
+        index=frame.index,
+    )
+    # OUT punch is never the first of its day; previous row is the IN punch of its pair
+    duration = pd.Series(
+        np.where(is_out, seconds - seconds.shift(1, fill_value=0), 0), index=frame.index
+    )
+    worked = duration.groupby([frame["user_id"], day], sort=False).transform("sum")
+    first_in = days["selfie_time"].transform("first")
+    first_in_local = first_in.dt.tz_localize("UTC").dt.tz_convert(LOCAL_TZ)
+    late = first_in_local.dt.time > shift_start
+
+    is_last = (punch == punches - 1).to_numpy()
+    remarks = "Worked " + format_durations(worked)
+    remarks = remarks.where(~late, remarks + ", Late")
+    remarks = remarks.where(punches % 2 == 0, remarks + ", Missing OUT")
+
+    return frame.assign(
+        selfie_ist=format_times(frame["selfie_time"]),
+        location_ist=format_times(frame["location_time"]),
+        location_text="Long: "
+        + frame["longitude"].astype(str)
+        + ", Lat: "
+        + frame["latitude"].astype(str),
+        time_diff=np.where(is_out, format_durations(duration), ""),
+        remarks=np.where(is_last, remarks, ""),
+    )
+
+
+# Attendance of all users; same table as reports.render_hr_report
+def render_hr_report(frame, start_date: datetime, end_date: datetime):
+    frame = aggregate_frame(frame)
+    frame.insert(0, "sl_no", np.arange(1, len(frame) + 1))
+    columns = ["sl_no", "employee_id", "selfie_ist", "location_ist", "location_text"]
+    rows = frame[columns + ["time_diff", "remarks"]].to_numpy(dtype=object).tolist()
+    return ReportTable(
+        "Attendance Report",
+        [
+            [
+                f"Start Date: {start_date.strftime('%d-%B-%Y')}",
+                f"End Date: {end_date.strftime('%d-%B-%Y')}",
+            ]
+        ],
+        [
+            ("Sl. No.", 5),
+            ("Employee ID", 12),
+            ("Selfie Time", 14),
+            ("Location Time", 14),
+            ("Location", 25),
+            ("Time Diff", 8),
+            ("Remarks", None),
+        ],
+        rows,
+    )
+
+
+# Day wise summary of users; same table as reports.render_summary_report
+def render_summary_report(frame, start_date: datetime, end_date: datetime):
+    sessions = frame["sessions"].fillna(0).astype("int64")
+    first_in = pd.to_datetime(frame["first_in"])
+    first_in_local = first_in.dt.tz_localize("UTC").dt.tz_convert(LOCAL_TZ)
+    late = (first_in_local.dt.time > shift_start) & first_in.notna()
+    missing_out = sessions % 2 == 1
+    remarks = np.select(
+        [late & missing_out, late, missing_out],
+        ["Late, Missing OUT", "Late", "Missing OUT"],
+        "",
+    )
+    days = pd.to_datetime(frame["day"]).to_numpy().astype("datetime64[D]")
+    days = pd.Series(np.datetime_as_string(days), index=frame.index).str
+    frame = frame.assign(
+        sl_no=np.arange(1, len(frame) + 1),
+        day=days[8:10] + "-" + days[5:7] + "-" + days[:4],
+        first_in=format_clock_times(frame["first_in"]),
+        last_out=format_clock_times(frame["last_out"]),
+        sessions=sessions,
+        worked=format_durations(frame["worked_seconds"].fillna(0).astype("int64")),
+        remarks=remarks,
+    )
+    columns = ["sl_no", "employee_id", "day", "first_in", "last_out", "sessions", "worked"]
+    rows = frame[columns + ["remarks"]].to_numpy(dtype=object).tolist()
+    return ReportTable(
+        "Attendance Summary",
+        [
+            [
+                f"Start Date: {start_date.strftime('%d-%B-%Y')}",
+                f"End Date: {end_date.strftime('%d-%B-%Y')}",
+            ]
+        ],
+        [
+            ("Sl. No.", 5),
+            ("Employee ID", 15),
+            ("Date", 12),
+            ("First IN", 10),
+            ("Last OUT", 10),
+            ("Punches", 8),
+            ("Worked", 10),
+            ("Remarks", None),
+        ],
+        rows,
+    )
+
+
+# Attendance of an employee; same table as reports.render_employee_report
+def render_employee_report(
+    user: User, frame, start_date: datetime, end_date: datetime
+):
+    frame = aggregate_frame(frame)
+    frame.insert(0, "sl_no", np.arange(1, len(frame) + 1))
+    columns = ["sl_no", "selfie_ist", "location_ist", "location_text"]
+    rows = frame[columns + ["time_diff", "remarks"]].to_numpy(dtype=object).tolist()
+    return ReportTable(
+        "Attendance Report",
+        [
+            [f"Employee Name: {user.fullname}", f"Employee ID: {user.employee_id}"],
+            [
+                f"Start Date: {start_date.strftime('%d-%B-%Y')}",
+                f"End Date: {end_date.strftime('%d-%B-%Y')}",
+            ],
+        ],
+        [
+            ("Sl. No.", 5),
+            ("Selfie Time", 16),
+            ("Location Time", 16),
+            ("Location", 25),
+            ("Time Diff", 8),
+            ("Remarks", None),
+        ],
+        rows,
+    )
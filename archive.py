@@ -0,0 +1,235 @@
+"""
+Local archive of selfies; Telegram file IDs can expire, archived photos don't
+
+Selfies are downloaded in background by a bounded pool of workers, away from the
+handlers, and stored under their Telegram file_unique_id, which identifies the
+content; a photo is downloaded and stored only once. Once the archive grows
+beyond its maximum size the oldest photos are removed. Thumbnails are made with
+Pillow when it's installed and kept along with their photos.
+"""
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:  # Optional; photos are archived without thumbnails
+    Image = None
+
+from jobs import JobQueue
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PHOTOS = "photos"
+THUMBNAILS = "thumbnails"
+
+# Telegram file IDs are URL safe base64; anything else is never used as a file name
+FILE_UNIQUE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Partly written files older than this, in seconds, are left by an interrupted download
+PARTIAL_FILE_AGE = 3600
+
+
+class SelfieArchive:
+    """
+    Content addressed store of selfies with a size cap, filled by background downloads
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        download,
+        max_size: int,
+        workers: int = 2,
+        queue_size: int = 1000,
+        thumbnail_size: int = 160,
+    ):
+        """
+        :param directory: root directory of the archive; created when missing
+        :param download: function returning the content of a photo by its file_id
+        :param max_size: maximum size in bytes of the photos & thumbnails
+        :param workers: maximum number of concurrent downloads
+        :param queue_size: maximum number of photos waiting to be downloaded; more
+            are dropped instead of piling up when Telegram is slow
+        :param thumbnail_size: maximum width & height of thumbnails in pixels
+        """
+        self.directory = directory
+        self.download = download
+        self.max_size = max_size
+        self.queue_size = queue_size
+        self.thumbnail_size = thumbnail_size
+        self._jobs = JobQueue(workers=workers, name="archive")
+        self._files = OrderedDict()  # file_unique_id: bytes on disk; oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def path(self, file_unique_id: str, folder: str = PHOTOS):
+        """
+        Path of a photo or its thumbnail; spread over sub directories by hash of the ID
+        :param file_unique_id: Telegram file_unique_id of the photo
+        :param folder: PHOTOS or THUMBNAILS
+        """
+        shard = hashlib.sha1(file_unique_id.encode()).hexdigest()[:2]
+        return os.path.join(self.directory, folder, shard, f"{file_unique_id}.jpg")
+
+    # Photos already archived, oldest first, and the total size with thumbnails
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(os.path.join(self.directory, PHOTOS)):
+            for name in names:
+                file_unique_id, extension = os.path.splitext(name)
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue  # Moved or evicted by the running bot meanwhile
+                if extension != ".jpg":
+                    # Newer ones may still be written by the running bot; the archive is
+                    # also loaded by manage.py and by face workers importing main.py
+                    if stat.st_mtime < time.time() - PARTIAL_FILE_AGE:
+                        os.remove(os.path.join(root, name))
+                    continue
+                size = stat.st_size
+                thumbnail = self.path(file_unique_id, THUMBNAILS)
+                if os.path.exists(thumbnail):
+                    size += os.path.getsize(thumbnail)
+                files.append((stat.st_mtime, file_unique_id, size))
+        files.sort()
+        with self._lock:
+            for _, file_unique_id, size in files:
+                self._files[file_unique_id] = size
+                self._size += size
+        self._evict()
+        logger.info("Selfie archive: %d photos, %d bytes", len(self._files), self._size)
+
+    def __contains__(self, file_unique_id: str):
+        return file_unique_id in self._files
+
+    def stats(self) -> dict:
+        """
+        Number of photos, bytes on disk and photos waiting to be downloaded
+        """
+        with self._lock:
+            photos, size = len(self._files), self._size
+        return {"photos": photos, "bytes": size, "queued": self._jobs.stats()["queued"]}
+
+    def submit(self, file_id: str, file_unique_id: str) -> bool:
+        """
+        Queue a photo to be downloaded & archived unless it's already archived or queued
+        :param file_id: Telegram file_id to download the photo with
+        :param file_unique_id: Telegram file_unique_id of the photo
+        :return: whether the photo has been queued
+        """
+        if not FILE_UNIQUE_ID.match(file_unique_id or ""):
+            logger.warning("Selfie not archived; invalid file_unique_id %r", file_unique_id)
+            return False
+        if file_unique_id in self._files:
+            metrics.archive_photos_total.inc(result="duplicate")
+            return False
+        if self._jobs.stats()["queued"] >= self.queue_size:
+            metrics.archive_photos_total.inc(result="dropped")
+            return False
+        queued = self._jobs.submit(
+            file_unique_id,
+            lambda: self._archive(file_id, file_unique_id),
+            lambda result, error: None,  # Failures are logged by the job queue
+        )
+        if not queued:
+            metrics.archive_photos_total.inc(result="duplicate")
+        return queued
+
+    def _archive(self, file_id: str, file_unique_id: str):
+        if file_unique_id in self._files:
+            metrics.archive_photos_total.inc(result="duplicate")
+            return
+        try:
+            content = self.download(file_id)
+            size = self._write(self.path(file_unique_id), content)
+        except Exception:
+            metrics.archive_photos_total.inc(result="failed")
+            raise
+        if Image is not None:
+            size += self._make_thumbnail(file_unique_id)
+        self._add(file_unique_id, size)
+        metrics.archive_photos_total.inc(result="archived")
+
+    # Write a file at once; readers never see a partly written file
+    def _write(self, path: str, content: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix=".part", delete=False
+        ) as file:
+            file.write(content)
+        os.replace(file.name, path)
+        return len(content)
+
+    def _make_thumbnail(self, file_unique_id: str):
+        try:
+            with Image.open(self.path(file_unique_id)) as image:
+                image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                buffer = BytesIO()
+                image.convert("RGB").save(buffer, "JPEG", quality=80)
+        except Exception:
+            logger.exception("Thumbnail of selfie %s failed", file_unique_id)
+            return 0
+        return self._write(self.path(file_unique_id, THUMBNAILS), buffer.getvalue())
+
+    def _add(self, file_unique_id: str, size: int):
+        with self._lock:
+            self._files[file_unique_id] = self._files.get(file_unique_id, 0) + size
+            self._size += size
+        self._evict()
+
+    # Remove the oldest photos until the archive fits in its maximum size
+    def _evict(self):
+        with self._lock:
+            evicted = []
+            while self._size > self.max_size and len(self._files) > 1:
+                file_unique_id, size = self._files.popitem(last=False)
+                self._size -= size
+                evicted.append(file_unique_id)
+        for file_unique_id in evicted:
+            for folder in (PHOTOS, THUMBNAILS):
+                try:
+                    os.remove(self.path(file_unique_id, folder))
+                except FileNotFoundError:
+                    pass
+        if evicted:
+            metrics.archive_photos_total.inc(len(evicted), result="evicted")
+
+    def photo(self, file_unique_id: str):
+        """
+        Path of an archived photo; None when it's not archived
+        :param file_unique_id: Telegram file_unique_id of the photo
+        """
+        if file_unique_id not in self._files:
+            return None
+        return self.path(file_unique_id)
+
+    def thumbnail(self, file_unique_id: str):
+        """
+        Path of the thumbnail of an archived photo; made once when missing
+        :param file_unique_id: Telegram file_unique_id of the photo
+        :return: None when the photo is not archived or Pillow is not installed
+        """
+        if Image is None or file_unique_id not in self._files:
+            return None
+        path = self.path(file_unique_id, THUMBNAILS)
+        if not os.path.exists(path):
+            size = self._make_thumbnail(file_unique_id)
+            if not size:
+                return None
+            self._add(file_unique_id, size)
+        return path
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop downloading; queued photos are archived first when waiting
+        """
+        self._jobs.shutdown(wait=wait)
@@ -0,0 +1,536 @@
+"""
+Asynchronous runtime of the bot on AsyncTeleBot
+
+Updates are received and answered on an event loop, so a slow upload or a report
+being generated never holds back other employees' check-ins. The event loop never
+blocks: Telegram is called through aiohttp, database work runs in a pool of
+BOT_THREADS threads with a session per call and reports are built by the report
+workers. Attendance is paired, written, archived and verified by the same objects
+as main.py; run one of the two, never both.
+
+    python async_main.py
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import sys
+
+from telebot.async_telebot import AsyncTeleBot
+
+from db_backend import db_session
+from helpers import UTC_from_epoch, get_hashed, largest_photo
+from main import (
+    configure_logging,
+    face_verifier,
+    get_report_range,
+    hr_report_request,
+    pairing,
+    report_queue,
+    selfie_archive,
+    start_faces,
+    start_metrics,
+    start_pairing,
+)
+import metrics
+from models import User
+from pairing import EXPIRED, LOCATION, PAIRED, SELFIE, WAITING, PunchResult, other_half
+from reports import (
+    EXPORT_FORMATS,
+    Report,
+    ReportRequest,
+    generate_report,
+    get_cached_report,
+)
+from settings import (
+    BOT_MODE,
+    BOT_THREADS,
+    BOT_TOKEN,
+    SELFIE_KEEP_ALL_SIZES,
+    SELFIE_LOCATION_DELAY,
+)
+
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# Database work of the handlers; the event loop waits for it without blocking
+db_executor = ThreadPoolExecutor(max_workers=BOT_THREADS, thread_name_prefix="db")
+
+
+# Call a function in a session of its own; removed once it's done
+def in_session(function, *args, **kwargs):
+    try:
+        return function(*args, **kwargs)
+    finally:
+        db_session.remove()
+
+
+async def run_db(function, *args, **kwargs):
+    """
+    Run database work in a database thread
+    :param function: function reading or writing through db_session; records it returns
+        are detached, so only use what was loaded before it returned
+    :return: result of function
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        db_executor, partial(in_session, function, *args, **kwargs)
+    )
+
+
+# Generate a report in background; same report requested again is generated only once
+def submit_report(request: ReportRequest) -> asyncio.Future:
+    """
+    :param request: range, user and view of the report
+    :return: future resolved with the report & the error of generating it
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def done(report, error):
+        loop.call_soon_threadsafe(future.set_result, (report, error))
+
+    report_queue.submit(request, lambda: generate_report(request), done)
+    return future
+
+
+# Logged in user of a chat; replies to the message when there's none
+async def logged_in_user(message):
+    known_user = await run_db(User.get_by_chat_id, message.chat.id)
+    if not known_user:
+        await bot.reply_to(message, "You are not yet logged in")
+    return known_user
+
+
+# Logged in HR of a chat; replies to the message when the user is not an HR
+async def logged_in_hr(message):
+    known_user = await logged_in_user(message)
+    if known_user and known_user.role != "HR":
+        await bot.reply_to(message, "Sorry!! you can't use this command")
+        return None
+    return known_user
+
+
+# Log a user in with their employee ID & OTP; OTP can't be used again
+def login(chat_id: int, emp_id: str, pwd: str):
+    """
+    :return: full name of the user; None when credential is not valid
+    """
+    user = User.is_valid_credential(emp_id, pwd)
+    if not user:
+        return None
+    user.last_chat_id = chat_id
+    user.is_pwd_expired = True
+    db_session.commit()
+    User.invalidate_cache(user)
+    return user.fullname
+
+
+# Log out the user of a chat
+def logout(chat_id: int):
+    """
+    :return: whether a user was logged in
+    """
+    user = User.get_by_chat_id(chat_id)
+    if not user:
+        return False
+    user.last_chat_id = None
+    db_session.commit()
+    # After commit; a concurrent update could cache the user again until then
+    User.invalidate_cache(user, chat_id)
+    return True
+
+
+# Add a new user
+def create(emp_id: str, full_name: str, role: str, pwd: str):
+    db_session.add(
+        User(employee_id=emp_id, fullname=full_name, role=role, temp_pwd=get_hashed(pwd))
+    )
+    db_session.commit()
+
+
+# Change a user by their employee ID; cached copies are dropped before & after commit
+def update_user(emp_id: str, only_active: bool = True, **values):
+    """
+    :param emp_id: employee ID of user
+    :param only_active: whether to change only an active user
+    :param values: columns & their new values
+    :return: whether the user exists
+    """
+    user = User.get_by_emp_id(emp_id, only_active=only_active)
+    if not user:
+        return False
+    User.invalidate_cache(user)
+    for name, value in values.items():
+        setattr(user, name, value)
+    db_session.commit()
+    User.invalidate_cache(user)
+    return True
+
+
+# When user starts a flow; welcome them
+@bot.message_handler(commands=["start", "hello"])
+@bot.message_handler(func=lambda msg: msg.text in ["start", "hello"])
+async def welcome_user(message):
+    known_user = await run_db(User.get_by_chat_id, message.chat.id)
+    if known_user:
+        await bot.reply_to(
+            message,
+            f"Hi, *{known_user.fullname}*; Welcome back",
+            parse_mode="MarkdownV2",
+        )
+    else:
+        await bot.reply_to(
+            message,
+            "Please use command /login to interact further; example\n/login\nemployee ID\npassword \n\n"
+            "or /help for other commands",
+            parse_mode="MarkdownV2",
+        )
+
+
+# Show help options to users
+@bot.message_handler(commands=["help"])
+@bot.message_handler(func=lambda msg: msg.text in ["help"])
+async def help_msg(message):
+    await bot.reply_to(
+        message,
+        "/login \\- to login a user with employee ID and OTP followed by command\n"
+        "/logout \\- to logout a user\n"
+        "/create \\- HR can create a new user with their employee ID, name, role, OTP followed by command\n"
+        "/download \\- user can download their monthly attendance by providing the month & year followed by command; "
+        "add pdf, csv or xlsx in last line to choose the format\n"
+        "/rstpwd \\- HR can reset user password by providing employee ID & OTP followed by command\n"
+        "/deactive \\- HR can deactivate an user by providing employee ID followed by command\n"
+        "/reactive \\- HR can reactive an user by providing employee ID followed by command",
+        parse_mode="MarkdownV2",
+    )
+
+
+# Login a user with employeeID & OTP
+@bot.message_handler(commands=["login"])
+@bot.message_handler(func=lambda msg: msg.text in ["login"])
+async def login_user(message):
+    try:
+        _, emp_id, pwd = list(map(lambda x: x.strip(), message.text.split("\n")))
+    except ValueError:
+        await bot.reply_to(
+            message,
+            "Please use command /login to interact further; example\n/login\nemployee ID\npassword",
+            parse_mode="MarkdownV2",
+        )
+        return
+    fullname = await run_db(login, message.chat.id, emp_id, pwd)
+    if not fullname:
+        await bot.reply_to(message, "Sorry, login failed; Try again")
+    else:
+        await bot.reply_to(message, f"Hello *{fullname}*", parse_mode="MarkdownV2")
+
+
+# Logout a logged in user
+@bot.message_handler(commands=["logout"])
+@bot.message_handler(func=lambda msg: msg.text in ["logout"])
+async def logout_user(message):
+    if await run_db(logout, message.chat.id):
+        await bot.reply_to(
+            message,
+            "You have been logged out; to login again ask your HR for a new password",
+        )
+    else:
+        await bot.reply_to(message, "You are not yet logged in")
+
+
+# Create a new user with their employeeID, name, role & OTP
+@bot.message_handler(commands=["create"])
+@bot.message_handler(func=lambda msg: msg.text in ["create"])
+async def create_user(message):
+    if not await logged_in_hr(message):
+        return
+    try:
+        _, emp_id, full_name, role, pwd = list(
+            map(lambda x: x.strip(), message.text.split("\n"))
+        )
+    except ValueError:
+        await bot.reply_to(
+            message,
+            "Please use command /create to create user; "
+            "example\n/create\nemployee ID\nfull name\nrole\nOTP",
+            parse_mode="MarkdownV2",
+        )
+        return
+    if role.title() == "Employee":
+        role = "Employee"
+    elif role.upper() == "HR":
+        role = "HR"
+    else:
+        await bot.reply_to(message, "Please provide Employee/HR as role")
+        return
+    await run_db(create, emp_id, full_name, role, pwd)
+    await bot.reply_to(message, "User has been added ", parse_mode="MarkdownV2")
+
+
+# Reset a password with employeeID & OTP
+@bot.message_handler(commands=["rstpwd"])
+@bot.message_handler(func=lambda msg: msg.text in ["rstpwd"])
+async def reset_password(message):
+    if not await logged_in_hr(message):
+        return
+    try:
+        _, emp_id, pwd = list(map(lambda x: x.strip(), message.text.split("\n")))
+    except ValueError:
+        await bot.reply_to(
+            message,
+            "Please use command /rstpwd to create user; "
+            "example\n/rstpwd\nemployee ID\nOTP",
+            parse_mode="MarkdownV2",
+        )
+        return
+    if await run_db(update_user, emp_id, temp_pwd=get_hashed(pwd), is_pwd_expired=False):
+        await bot.reply_to(message, "New OTP has been updated", parse_mode="MarkdownV2")
+    else:
+        await bot.reply_to(
+            message, "Employee doesn't exist or deactivated", parse_mode="MarkdownV2"
+        )
+
+
+# Deactivate or reactivate a user by their employee ID
+async def set_user_active(message, command: str, active: bool):
+    if not await logged_in_hr(message):
+        return
+    try:
+        _, emp_id = list(map(lambda x: x.strip(), message.text.split("\n")))
+    except ValueError:
+        await bot.reply_to(
+            message,
+            f"Please use command /{command} to create user; "
+            f"example\n/{command}\nemployee ID",
+            parse_mode="MarkdownV2",
+        )
+        return
+    if await run_db(update_user, emp_id, only_active=not active, is_active=active):
+        await bot.reply_to(
+            message,
+            "User has been reactivated" if active else "User has been deactivated",
+            parse_mode="MarkdownV2",
+        )
+    else:
+        await bot.reply_to(
+            message, "Employee doesn't exist or deactivated", parse_mode="MarkdownV2"
+        )
+
+
+# Deactivate user by their employee ID
+@bot.message_handler(commands=["deactive"])
+@bot.message_handler(func=lambda msg: msg.text in ["deactive"])
+async def deactivate_user(message):
+    await set_user_active(message, "deactive", False)
+
+
+# Reactivate user with their employeeID
+@bot.message_handler(commands=["reactive"])
+@bot.message_handler(func=lambda msg: msg.text in ["reactive"])
+async def reactivate_user(message):
+    await set_user_active(message, "reactive", True)
+
+
+# Reply to a selfie or location with what happened to the attendance
+async def reply_punch(message, kind: str, result: PunchResult):
+    delay_minutes = SELFIE_LOCATION_DELAY / 60
+    if result.outcome == PAIRED:
+        await bot.reply_to(message, "Your attendance has been added 👍")
+    elif result.outcome == WAITING:
+        await bot.reply_to(
+            message,
+            f"{kind.capitalize()} has been already received; "
+            f"Please send your {result.missing} in <b>{result.seconds_left / 60:.1f}</b> minutes for attendance",
+            parse_mode="HTML",
+        )
+    elif result.outcome == EXPIRED:
+        await bot.reply_to(
+            message,
+            f"😩 Oops.. You are unable to send {result.missing} with in <b>{delay_minutes:.1f}</b>"
+            " minutes",
+            parse_mode="HTML",
+        )
+        await bot.send_message(
+            message.chat.id,
+            f"We have added your {kind}, Please share your {other_half(kind)} with in "
+            f"<b>{delay_minutes:.1f}</b> minutes for attendance",
+            parse_mode="HTML",
+        )
+    else:
+        await bot.reply_to(
+            message,
+            f"{kind.capitalize()} has been has been added, Please share your {result.missing} for attendance",
+        )
+
+
+# When user send a picture (selfie)
+@bot.message_handler(content_types=["photo"])
+async def handle_attendance_selfie(message):
+    known_user = await logged_in_user(message)
+    if not known_user:
+        return
+    pictures = [
+        {
+            "file_id": pic.file_id,
+            "file_unique_id": pic.file_unique_id,
+            "width": pic.width,
+            "height": pic.height,
+            "file_size": pic.file_size,
+        }
+        for pic in message.photo
+    ]
+    selfie = largest_photo(pictures)
+    result = await run_db(
+        pairing.punch,
+        known_user.id,
+        SELFIE,
+        UTC_from_epoch(message.date),
+        selfie_file_id=selfie["file_id"],
+        selfie_file_unique_id=selfie["file_unique_id"],
+        photos=pictures if SELFIE_KEEP_ALL_SIZES else None,
+    )
+    await reply_punch(message, SELFIE, result)
+    # Only queued here; downloaded & verified by their own workers
+    if selfie_archive and result.outcome != WAITING:
+        selfie_archive.submit(selfie["file_id"], selfie["file_unique_id"])
+    if face_verifier and result.outcome != WAITING:
+        face_verifier.submit(
+            result.attendance_id, known_user.id, selfie["file_id"], selfie["file_unique_id"]
+        )
+
+
+# When user send location
+@bot.message_handler(content_types=["location"])
+async def handle_attendance_location(message):
+    known_user = await logged_in_user(message)
+    if not known_user:
+        return
+    location = {
+        "longitude": message.location.longitude,
+        "latitude": message.location.latitude,
+    }
+    result = await run_db(
+        pairing.punch,
+        known_user.id,
+        LOCATION,
+        UTC_from_epoch(message.date),
+        location=location,
+    )
+    await reply_punch(message, LOCATION, result)
+
+
+# Send the generated report to the user who requested it
+async def send_report(message, report: Report, error: Exception):
+    if error:
+        await bot.reply_to(message, "Sorry, report could not be generated; Try again")
+    elif report.file_id:
+        # Already uploaded once; let Telegram reuse it
+        await bot.send_document(
+            message.chat.id, document=report.file_id, reply_to_message_id=message.id
+        )
+    elif report.document:
+        sent = await bot.send_document(
+            message.chat.id,
+            document=report.document,
+            reply_to_message_id=message.id,
+            visible_file_name=report.file_name,
+        )
+        report.file_id = sent.document.file_id
+    else:
+        await bot.reply_to(message, report.text)
+
+
+# Download attendance report
+@bot.message_handler(commands=["download"])
+@bot.message_handler(func=lambda msg: msg.text in ["download"])
+async def download_report(message):
+    known_user = await logged_in_user(message)
+    if not known_user:
+        return
+    curr_time = UTC_from_epoch(message.date)
+    data = list(map(lambda x: x.strip(), message.text.split("\n")))
+    export_format = "pdf"
+    if len(data) > 1 and data[-1].lower() in EXPORT_FORMATS:
+        export_format = data.pop().lower()
+    if known_user.role == "HR":
+        usage = (
+            "Please use command /download to download report; "
+            "example\n/download\nDate[Optional] Month[Optional] Year[Optional] "
+            "[DD MM YYYY/ MM YYYY/ YYYY]\nemployee ID[Optional]\nformat[Optional] [pdf/csv/xlsx]"
+        )
+        max_lines = 3
+    else:
+        usage = (
+            "Please use command /download to download report; "
+            "example\n/download\nDate[Optional] Month[Optional] Year[Optional] [DD MM YYYY/ MM YYYY/ YYYY]"
+            "\nformat[Optional] [pdf/csv/xlsx]"
+        )
+        max_lines = 2
+
+    if len(data) > max_lines:
+        await bot.reply_to(message, usage, parse_mode="MarkdownV2")
+        return
+    report_range = get_report_range(curr_time, data[1] if len(data) > 1 else None)
+    if not report_range:
+        await bot.reply_to(message, usage, parse_mode="MarkdownV2")
+        return
+    start_date, end_date = report_range
+
+    if known_user.role == "HR":
+        user_id = None
+        if len(data) == 3:
+            user = await run_db(User.get_by_emp_id, data[2])
+            if not user:
+                await bot.reply_to(message, "Employee doesn't exist or deactivated")
+                return
+            user_id = user.id
+        request = hr_report_request(start_date, end_date, user_id, export_format)
+    else:
+        request = ReportRequest(start_date, end_date, known_user.id, "Employee", export_format)
+
+    # Served right away when attendance of the range hasn't changed since last time
+    report = await run_db(get_cached_report, request)
+    if report:
+        await send_report(message, report, None)
+        return
+
+    generated = submit_report(request)
+    await bot.reply_to(message, "Report is being prepared; it will be sent shortly")
+    report, error = await generated
+    await send_report(message, report, error)
+
+
+# When user send any message except the commands, picture or location (Fallback State)
+@bot.message_handler(func=lambda msg: True)
+async def echo_all(message):
+    await bot.reply_to(
+        message,
+        "Sorry I can't help you in this; Please checkout /help or contact your administrator",
+    )
+
+
+# Time every handler & Telegram API call; SQL statements are timed by main
+metrics.instrument_handlers(bot)
+metrics.instrument_async_telegram()
+metrics.add_gauges(
+    "db_executor_queued",
+    "Database calls of the async runtime waiting for a thread",
+    db_executor._work_queue.qsize,
+)
+
+
+async def run():
+    try:
+        await bot.infinity_polling()
+    finally:
+        await bot.close_session()
+        db_executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    if BOT_MODE != "polling":
+        sys.exit("The async runtime only polls for updates; run python main.py for webhook")
+    configure_logging()
+    start_faces()
+    start_metrics()
+    start_pairing()
+    asyncio.run(run())
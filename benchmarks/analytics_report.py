@@ -0,0 +1,60 @@
+"""
+Benchmark HR reports rendered row by row against the vectorised analytics path;
+both must produce the same CSV. Reports are requested as /download does: a day
+of every punch, a month and a year from the daily attendance summary.
+
+    python benchmarks/analytics_report.py [rows ...]
+"""
+from datetime import datetime
+import sys
+import time
+
+import common
+import analytics
+from db_backend import db_session
+from main import get_report_range, hr_report_request
+from models import DailyAttendanceSummary
+import reports
+from reports import ReportRequest, build_report
+
+SIZES = [int(size) for size in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+
+# Date strings of /download; common.populate fills the days up to 31 July 2023
+RANGES = {"day": "31 07 2023", "month": "07 2023", "year": "2023"}
+
+
+def measure(engine: str, request: ReportRequest):
+    reports.REPORT_ENGINE = engine
+    start = time.perf_counter()
+    report = build_report(request, 1)
+    elapsed = time.perf_counter() - start
+    db_session.remove()
+    return report.document, elapsed
+
+
+def main():
+    if not analytics.available():
+        sys.exit("pandas is required; pip install pandas")
+    print(
+        f"{'rows':>10}{'range':>7}{'view':>9}{'lines':>9}"
+        f"{'python':>10}{'pandas':>10}{'speedup':>10}"
+    )
+    for rows in SIZES:
+        common.populate(rows, users=500)
+        DailyAttendanceSummary.rebuild()
+        db_session.remove()
+        for name, dmy in RANGES.items():
+            start_date, end_date = get_report_range(datetime(2023, 8, 1), dmy)
+            request = hr_report_request(start_date, end_date, None, "csv")
+            python_csv, python_time = measure("python", request)
+            pandas_csv, pandas_time = measure("pandas", request)
+            assert python_csv == pandas_csv, f"{name} reports differ"
+            lines = python_csv.count(b"\n") - 1
+            print(
+                f"{rows:>10}{name:>7}{request.view:>9}{lines:>9}"
+                f"{python_time:>9.2f}s{pandas_time:>9.2f}s{python_time / pandas_time:>9.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
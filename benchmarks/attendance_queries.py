@@ -0,0 +1,78 @@
+"""
+Benchmark the attendance lookups against growing table sizes
+
+Compares the old `func.DATE`/`func.DATETIME` filters (full table scan) with the
+indexed range queries of `Attendance`.
+
+    python benchmarks/attendance_queries.py [rows ...]
+"""
+from datetime import datetime
+import sys
+import time
+
+from common import populate  # Keep first; sets up a throw away database
+
+from sqlalchemy import func, or_
+
+from db_backend import db_session, is_sqlite
+from models import Attendance
+
+REPEAT = 200
+
+
+def legacy_last_record(user_id: int, timestamp: datetime):
+    return (
+        db_session.query(Attendance)
+        .filter(
+            Attendance.user_id == user_id,
+            or_(
+                func.DATE(Attendance.selfie_time) == str(timestamp.date()),
+                func.DATE(Attendance.selfie_time) == str(timestamp.date()),
+            ),
+        )
+        .order_by(Attendance.id.desc())
+        .first()
+    )
+
+
+def legacy_records(start_time: datetime, end_time: datetime):
+    return (
+        db_session.query(Attendance)
+        .filter(
+            func.DATETIME(Attendance.selfie_time) >= str(start_time),
+            func.DATETIME(Attendance.selfie_time) < str(end_time),
+            func.DATETIME(Attendance.location_time) >= str(start_time),
+            func.DATETIME(Attendance.location_time) < str(end_time),
+        )
+        .order_by(Attendance.user_id, Attendance.id)
+        .all()
+    )
+
+
+# Average latency of a call in milliseconds; DATE()/DATETIME() filters only run on SQLite
+def timed(fn, *args):
+    if fn in (legacy_last_record, legacy_records) and not is_sqlite:
+        return float("nan")
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn(*args)
+        db_session.expunge_all()
+    return (time.perf_counter() - start) * 1000 / REPEAT
+
+
+def main(sizes):
+    day = datetime(2023, 7, 31, 12)
+    print(f"{'rows':>10} {'last (old)':>12} {'last (new)':>12} {'day (old)':>12} {'day (new)':>12}")
+    for rows in sizes:
+        user_ids = populate(rows)
+        print(
+            f"{rows:>10} "
+            f"{timed(legacy_last_record, user_ids[7], day):>10.3f}ms "
+            f"{timed(Attendance.get_last_attendance_record, user_ids[7], day):>10.3f}ms "
+            f"{timed(legacy_records, day.replace(hour=0), day.replace(hour=23)):>10.3f}ms "
+            f"{timed(Attendance.get_attendance_records, day.replace(hour=0), day.replace(hour=23)):>10.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main([int(rows) for rows in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
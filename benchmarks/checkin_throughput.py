@@ -0,0 +1,86 @@
+"""
+Benchmark the check-in write path under a morning burst
+
+Concurrent workers insert selfie punches and pair a location with a commit
+each, like `new_attendance`, while a reader keeps looking up the last record.
+Run once with SQLite defaults and once with `SQLITE_PRAGMAS` from settings.
+
+    python benchmarks/checkin_throughput.py [default|tuned] [check-ins] [threads]
+"""
+from datetime import datetime
+import statistics
+import sys
+import threading
+import time
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+import settings
+
+MODE = sys.argv[1] if len(sys.argv) > 1 else "tuned"
+CHECKINS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+THREADS = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+if MODE == "default":
+    settings.SQLITE_PRAGMAS.clear()
+    settings.SQLITE_PRAGMAS.update({"journal_mode": "DELETE", "synchronous": "FULL"})
+
+from db_backend import db_session
+from models import Attendance
+
+
+def check_in(worker: int, count: int):
+    for i in range(count):
+        now = datetime.utcnow()
+        attendance = Attendance(
+            user_id=worker * count + i,
+            selfie_file_unique_id=f"{worker}_{i}",
+            selfie_time=now,
+        )
+        db_session.add(attendance)
+        db_session.commit()
+        attendance.location = {"longitude": 0, "latitude": 0}
+        attendance.location_time = now
+        db_session.add(attendance)
+        db_session.commit()
+    db_session.remove()
+
+
+def read_last_records(stop: threading.Event, latencies: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        Attendance.get_last_attendance_record(1, datetime.utcnow())
+        db_session.rollback()
+        latencies.append((time.perf_counter() - start) * 1000)
+    db_session.remove()
+
+
+def main():
+    stop = threading.Event()
+    latencies = []
+    reader = threading.Thread(target=read_last_records, args=(stop, latencies))
+    reader.start()
+
+    workers = [
+        threading.Thread(target=check_in, args=(worker, CHECKINS // THREADS))
+        for worker in range(THREADS)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    reader.join()
+
+    latencies.sort()
+    print(f"pragmas: {MODE}, threads: {THREADS}")
+    print(f"check-ins/s: {CHECKINS / elapsed:.0f}")
+    print(
+        f"reads: {len(latencies)}, median {statistics.median(latencies):.2f}ms, "
+        f"p99 {latencies[int(len(latencies) * 0.99)]:.2f}ms, max {latencies[-1]:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
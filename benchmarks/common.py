@@ -0,0 +1,50 @@
+"""
+Shared setup of the benchmarks; import before any module of the bot
+
+Benchmarks run on a throw away database in a temporary directory unless
+DATABASE_URL is set.
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+os.environ.setdefault("SUPER_HR_EMP_ID", "HR001")
+os.environ.setdefault("SUPER_HR_NAME", "Super HR")
+os.environ.setdefault("SUPER_HR_PWD", "benchmark")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")  # Never used to reach Telegram
+
+
+# Fill attendance table with 2 punches per user per day going back in time from last_day
+def populate(rows: int, users: int = 200, last_day: datetime = datetime(2023, 7, 31)):
+    from db_backend import db_session
+    from models import Attendance, User
+
+    db_session.query(Attendance).delete()
+    db_session.commit()
+    for user_id in range(db_session.query(User).count(), users):
+        db_session.add(User(employee_id=f"EMP{user_id}", fullname=f"Employee {user_id}"))
+    user_ids = [user.id for user in db_session.query(User).limit(users)]
+
+    records = []
+    day = last_day.replace(hour=3, minute=30)
+    while len(records) < rows:
+        for user_id in user_ids:
+            for hours in (0, 9):
+                punch = day + timedelta(hours=hours, minutes=random.randint(0, 59))
+                records.append(
+                    {
+                        "user_id": user_id,
+                        "selfie_time": punch,
+                        "location": {"longitude": 0, "latitude": 0},
+                        "location_time": punch + timedelta(seconds=30),
+                    }
+                )
+        day -= timedelta(days=1)
+    for i in range(0, rows, 10_000):
+        db_session.execute(Attendance.__table__.insert(), records[i : min(i + 10_000, rows)])
+    db_session.commit()
+    return user_ids
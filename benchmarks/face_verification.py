@@ -0,0 +1,143 @@
+"""
+Verify selfies through the face verification worker pool with more processes
+
+Reports how long submitting a selfie takes in the handler, how many selfies per
+second the background path verifies and how many the batch mode of manage.py
+verify_faces does. Selfies are the JPEG files in --images, or made up with
+Pillow; made up ones have no faces, so use real selfies for the model's numbers.
+--model synthetic swaps the model for a stand in that only decodes the image,
+to measure the pipeline itself where no face model is installed.
+
+    python benchmarks/face_verification.py [--images DIR] [--photos 200] [--processes 1 2 4]
+"""
+import argparse
+from io import BytesIO
+import os
+import sys
+import time
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+from PIL import Image
+
+from db_backend import db_session
+import face_model
+from faces import FaceVerifier
+from models import FaceReference
+from settings import FACE_MODEL
+
+# Spawned workers import this script again as __main__, without running main()
+SYNTHETIC = "__main__:synthetic_embedding"
+
+
+# Stand in model; decodes the image like a model would and embeds its downscaled pixels
+def synthetic_embedding(content: bytes):
+    with Image.open(BytesIO(content)) as image:
+        image = image.convert("L").resize((16, 8))
+    return [pixel / 255 for pixel in image.getdata()]
+
+
+def load_photos(images: str, count: int):
+    """
+    file_id: content of the selfies; JPEG files of a directory or made up ones
+    """
+    if images:
+        names = sorted(name for name in os.listdir(images) if name.lower().endswith(".jpg"))
+        photos = {}
+        for index in range(count):
+            with open(os.path.join(images, names[index % len(names)]), "rb") as file:
+                photos[f"F{index:05d}"] = file.read()
+        return photos
+    photos = {}
+    for index in range(count):
+        image = Image.new("RGB", (1280, 960), (index % 256, index * 7 % 256, 90))
+        buffer = BytesIO()
+        image.save(buffer, "JPEG", quality=90)
+        photos[f"F{index:05d}"] = buffer.getvalue()
+    return photos
+
+
+# Apply writes in the benchmark's session; committed once a run is done
+def write(function, *args):
+    return function(*args)
+
+
+def wait(verifier: FaceVerifier):
+    while True:
+        stats = verifier.stats()
+        if not stats["queued"] and not stats["running"]:
+            return
+        time.sleep(0.01)
+
+
+def run(model: str, photos: dict, processes: int):
+    """
+    Submit every selfie as the handler does, then verify them all in batch mode
+    """
+    verifier = FaceVerifier(
+        model,
+        lambda file_id, file_unique_id: photos[file_id],
+        write,
+        processes=processes,
+        queue_size=len(photos),
+    ).start()
+    # Selfies are only verified for enrolled users; enroll the first one as HR would
+    reference = verifier.embed(next(iter(photos.values())))
+    if reference is None:
+        verifier.shutdown()
+        sys.exit("No face in the first selfie to enroll; use real selfies with --images")
+    FaceReference.enroll(1, reference)
+    db_session.commit()
+    submit_times = []
+    start = time.perf_counter()
+    for index, file_id in enumerate(photos):
+        submitted = time.perf_counter()
+        verifier.submit(index + 1, 1, file_id, f"u{file_id}")
+        submit_times.append(time.perf_counter() - submitted)
+    wait(verifier)
+    background = time.perf_counter() - start
+    failed = verifier.stats()["failed"]
+
+    selfies = [(index + 1, 1, file_id, f"u{file_id}") for index, file_id in enumerate(photos)]
+    start = time.perf_counter()
+    results = verifier.verify_many(selfies)
+    batch = time.perf_counter() - start
+    verifier.shutdown()
+    db_session.commit()
+    db_session.remove()
+    counts = {}
+    for _, result, _, _ in results:
+        counts[result] = counts.get(result, 0) + 1
+    return sum(submit_times) / len(submit_times), background, batch, failed, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", help="absolute path of a directory of JPEG selfies")
+    parser.add_argument("--photos", type=int, default=200)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--model",
+        help='"module:function" of the model, or synthetic; FACE_MODEL by default',
+    )
+    args = parser.parse_args()
+
+    model = SYNTHETIC if args.model == "synthetic" else args.model or FACE_MODEL
+    if model == "face_model:face_recognition_embedding" and face_model.face_recognition is None:
+        sys.exit("face_recognition is required; pip install face_recognition, or --model synthetic")
+    photos = load_photos(args.images, args.photos)
+
+    print(f"model: {model}, photos: {len(photos)}, CPUs: {os.cpu_count()}")
+    print(
+        f"{'processes':>10}{'submit us':>11}{'background/s':>14}{'batch/s':>9}"
+        f"{'failed':>8}  results"
+    )
+    for processes in args.processes:
+        submit_time, background, batch, failed, counts = run(model, photos, processes)
+        print(
+            f"{processes:>10}{submit_time * 1e6:>11.1f}{len(photos) / background:>14.1f}"
+            f"{len(photos) / batch:>9.1f}{failed:>8}  {counts}"
+        )
+
+
+if __name__ == "__main__":
+    main()
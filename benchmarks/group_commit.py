@@ -0,0 +1,104 @@
+"""
+Benchmark committing check-ins one by one against committing them in groups
+
+Concurrent workers punch in with a selfie and pair a location through
+`GroupCommitWriter`, like the bot's handlers do, waiting for every write to be
+committed; database commits are counted on the engine.
+
+    python benchmarks/group_commit.py [check-ins] [threads] [batch sizes ...]
+"""
+from datetime import datetime
+import statistics
+import sys
+import threading
+import time
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+from sqlalchemy import event
+
+from db_backend import db_session, engine
+from models import Attendance
+from writer import GroupCommitWriter
+
+CHECKINS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+BATCH_SIZES = [int(size) for size in sys.argv[3:]] or [1, 50]
+
+commits = 0
+
+
+@event.listens_for(engine, "commit")
+def count_commit(conn):
+    global commits
+    commits += 1
+
+
+# Insert a record and return its ID; records are detached once committed
+def insert(attendance: Attendance):
+    db_session.add(attendance)
+    db_session.flush()
+    return attendance.id
+
+
+def check_in(writer: GroupCommitWriter, worker: int, count: int, latencies: list):
+    run = writer.max_batch  # Keeps selfies unique across runs
+    for i in range(count):
+        now = datetime.utcnow()
+        start = time.perf_counter()
+        attendance_id = writer.write(
+            insert,
+            Attendance(
+                user_id=worker * count + i,
+                selfie_file_unique_id=f"{run}_{worker}_{i}",
+                selfie_time=now,
+            ),
+        )
+        writer.write(
+            Attendance.complete,
+            attendance_id,
+            location={"longitude": 0, "latitude": 0},
+            location_time=now,
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        db_session.remove()
+
+
+def measure(batch_size: int):
+    global commits
+    writer = GroupCommitWriter(batch_size)
+    latencies = []
+    workers = [
+        threading.Thread(
+            target=check_in, args=(writer, worker, CHECKINS // THREADS, latencies)
+        )
+        for worker in range(THREADS)
+    ]
+    commits = 0
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    writer.stop()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(
+        f"{batch_size:>6}{CHECKINS / elapsed:>13.0f}{commits:>9}{commits / elapsed:>11.0f}"
+        f"{2 * CHECKINS / commits:>15.1f}{statistics.median(latencies):>11.2f}"
+        f"{latencies[int(len(latencies) * 0.99)]:>11.2f}"
+    )
+
+
+def main():
+    print(f"check-ins: {CHECKINS}, threads: {THREADS}")
+    print(
+        f"{'batch':>6}{'check-ins/s':>13}{'commits':>9}{'commits/s':>11}"
+        f"{'writes/commit':>15}{'p50 ms':>11}{'p99 ms':>11}"
+    )
+    for batch_size in BATCH_SIZES:
+        measure(batch_size)
+
+
+if __name__ == "__main__":
+    main()
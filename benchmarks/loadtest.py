@@ -0,0 +1,236 @@
+"""
+Load test the bot's handlers with synthetic updates and a fake Telegram API
+
+Employees log in and then keep checking in (selfie followed by location) and
+downloading their report. Updates are fed to the handlers registered on
+`main.bot` by a pool of workers, like the webhook workers do; every call to the
+Telegram API is answered locally. At a fixed rate, latency of an update is
+measured from the time it was due, so it includes the time spent waiting for a
+free worker; with rate 0 workers send updates back to back and latency is the
+handling time alone.
+
+    python benchmarks/loadtest.py [--users 50] [--rate 200] [--updates 5000]
+        [--workers 4] [--api-latency 0] [--download-ratio 0.02]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+from telebot import apihelper, types
+
+from db_backend import db_session
+from helpers import get_hashed
+from models import User
+
+api_calls = itertools.count()
+update_ids = itertools.count(1)
+
+
+class FakeResponse:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, result):
+        self.text = json.dumps({"ok": True, "result": result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_telegram_api(latency: float):
+    """
+    Request sender answering every Bot API method locally
+    :param latency: seconds to wait before answering; simulates the network
+    """
+
+    def send(method, url, params=None, files=None, **kwargs):
+        call = next(api_calls)
+        if latency:
+            time.sleep(latency)
+        chat_id = int((params or {}).get("chat_id", 0))
+        result = {
+            "message_id": call,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        if url.endswith("/sendDocument"):
+            result["document"] = {"file_id": f"doc{call}", "file_unique_id": f"udoc{call}"}
+        return FakeResponse(result)
+
+    return send
+
+
+def message_update(chat_id: int, **content):
+    """
+    Update of a message sent by a user
+    :param chat_id: chat ID of the user
+    :param content: text, photo or location of the message
+    """
+    update_id = next(update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"},
+        **content,
+    }
+    text = content.get("text")
+    if text and text.startswith("/"):
+        command = text.split("\n", 1)[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return types.Update.de_json({"update_id": update_id, "message": message})
+
+
+def photo(update_id: int):
+    return [
+        {
+            "file_id": f"photo{update_id}_{size}",
+            "file_unique_id": f"uphoto{update_id}_{size}",
+            "width": size,
+            "height": size,
+            "file_size": size * 100,
+        }
+        for size in (90, 320, 800)
+    ]
+
+
+def create_users(count: int):
+    """
+    Employees with a known password; returns their (chat ID, employee ID)
+    """
+    users = []
+    for i in range(count):
+        employee_id = f"LOAD{i}"
+        if not User.get_by_emp_id(employee_id, only_active=False):
+            db_session.add(
+                User(
+                    employee_id=employee_id,
+                    fullname=f"Load {i}",
+                    role="Employee",
+                    temp_pwd=get_hashed("secret"),
+                )
+            )
+        users.append((100_000 + i, employee_id))
+    db_session.commit()
+    db_session.remove()
+    return users
+
+
+def workload(users: list, download_ratio: float):
+    """
+    Endless stream of (kind, update factory) of the users; each user alternates
+    selfie & location and downloads their report now and then
+    """
+    next_step = {chat_id: "photo" for chat_id, _ in users}
+    while True:
+        chat_id, _ = random.choice(users)
+        if random.random() < download_ratio:
+            yield "download", lambda chat_id=chat_id: message_update(
+                chat_id, text="/download\ncsv"
+            )
+        elif next_step[chat_id] == "photo":
+            next_step[chat_id] = "location"
+            yield "photo", lambda chat_id=chat_id: message_update(
+                chat_id, photo=photo(next(update_ids))
+            )
+        else:
+            next_step[chat_id] = "photo"
+            yield "location", lambda chat_id=chat_id: message_update(
+                chat_id, location={"longitude": 77.59, "latitude": 12.97}
+            )
+
+
+def percentile(values: list, fraction: float):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=200, help="updates per second; 0 for no limit")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--api-latency", type=float, default=0, help="milliseconds per API call")
+    parser.add_argument("--download-ratio", type=float, default=0.02)
+    args = parser.parse_args()
+
+    apihelper.CUSTOM_REQUEST_SENDER = fake_telegram_api(args.api_latency / 1000)
+    import main as bot_main
+
+    bot = bot_main.bot
+    bot.threaded = False  # Workers below play the role of the bot's thread pool
+
+    users = create_users(args.users)
+    for chat_id, employee_id in users:
+        bot.process_new_updates(
+            [message_update(chat_id, text=f"/login\n{employee_id}\nsecret")]
+        )
+
+    latencies = {}
+    lock = threading.Lock()
+
+    def handle(kind: str, make_update, due: float = None):
+        update = make_update()
+        due = due or time.perf_counter()
+        bot.process_new_updates([update])
+        elapsed = time.perf_counter() - due
+        with lock:
+            latencies.setdefault(kind, []).append(elapsed * 1000)
+
+    updates = itertools.islice(workload(users, args.download_ratio), args.updates)
+    start = time.perf_counter()
+    if args.rate:
+        # Open loop; updates arrive on schedule whether or not the bot keeps up
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        for i, (kind, make_update) in enumerate(updates):
+            due = start + i / args.rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(handle, kind, make_update, due)
+        executor.shutdown(wait=True)
+    else:
+        # Closed loop; every worker sends the next update once the previous one is handled
+        updates_lock = threading.Lock()
+
+        def work():
+            while True:
+                with updates_lock:
+                    kind, make_update = next(updates, (None, None))
+                if kind is None:
+                    break
+                handle(kind, make_update)
+
+        workers = [threading.Thread(target=work) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    elapsed = time.perf_counter() - start
+    bot_main.report_queue.shutdown(wait=True)
+
+    print(
+        f"users: {args.users}, workers: {args.workers}, target rate: {args.rate or 'unlimited'}/s, "
+        f"API latency: {args.api_latency}ms"
+    )
+    print(f"updates: {args.updates} in {elapsed:.2f}s, {args.updates / elapsed:.0f} updates/s")
+    print(f"{'kind':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    everything = []
+    for kind, values in sorted(latencies.items()) + [("all", everything)]:
+        if kind != "all":
+            everything.extend(values)
+        values.sort()
+        print(
+            f"{kind:<10}{len(values):>8}{statistics.median(values):>10.2f}"
+            f"{percentile(values, 0.95):>10.2f}{percentile(values, 0.99):>10.2f}{values[-1]:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Count the SQL statements and time spent to render the HR attendance report
+
+Compares looking up the user of every record (N+1 queries) with loading the
+users along with the records in a single query.
+
+    python benchmarks/report_queries.py [employees] [days]
+"""
+from datetime import datetime
+import sys
+import time
+
+from common import populate  # Keep first; sets up a throw away database
+
+from sqlalchemy import event
+
+from db_backend import db_session, engine
+from exporters import export_html
+from models import Attendance, User
+from reports import render_hr_report
+
+statements = 0
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    global statements
+    statements += 1
+
+
+def per_record_lookup(start_date: datetime, end_date: datetime):
+    attendance_records = Attendance.get_attendance_records(start_date, end_date)
+    return [
+        (record, User.get_by_user_id(record.user_id, only_active=False))
+        for record in attendance_records
+    ]
+
+
+def joined_lookup(start_date: datetime, end_date: datetime):
+    return Attendance.get_attendance_records(start_date, end_date, with_user=True)
+
+
+def measure(fn, start_date: datetime, end_date: datetime):
+    global statements
+    db_session.expunge_all()
+    statements = 0
+    start = time.perf_counter()
+    table = render_hr_report(fn(start_date, end_date), start_date, end_date)
+    html_text = "".join(export_html(table))
+    elapsed = time.perf_counter() - start
+    return statements, elapsed * 1000, len(html_text)
+
+
+def main(employees: int, days: int):
+    populate(employees * days * 2, employees)
+    start_date, end_date = datetime(2023, 7, 31 - days + 1), datetime(2023, 8, 1)
+    print(f"{employees} employees, {days} days, {employees * days * 2} records")
+    for name, fn in (("per record", per_record_lookup), ("joined", joined_lookup)):
+        count, elapsed, size = measure(fn, start_date, end_date)
+        print(f"{name:>12}: {count:>6} statements, {elapsed:>9.1f}ms, {size} bytes of HTML")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 30,
+    )
@@ -0,0 +1,71 @@
+"""
+Time and peak memory of rendering a large HR report to a file
+
+Compares loading every record and building the whole HTML string in memory
+with streaming records in batches and writing HTML chunks as they are rendered.
+
+    python benchmarks/report_render.py [rows]
+"""
+from datetime import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+from common import populate  # Keep first; sets up a throw away database
+
+from db_backend import db_session
+from models import Attendance
+from reports import render_hr_report
+from settings import REPORT_BATCH_SIZE
+
+START_DATE, END_DATE = datetime(2000, 1, 1), datetime(2023, 8, 1)
+
+
+def in_memory(file):
+    attendance_records = Attendance.get_attendance_records(
+        START_DATE, END_DATE, with_user=True
+    )
+    html_text = ""
+    for chunk in render_hr_report(attendance_records, START_DATE, END_DATE):
+        html_text += chunk
+    file.write(html_text.encode())
+
+
+def streamed(file):
+    attendance_records = Attendance.get_attendance_records(
+        START_DATE, END_DATE, with_user=True, batch_size=REPORT_BATCH_SIZE
+    )
+    for chunk in render_hr_report(attendance_records, START_DATE, END_DATE):
+        file.write(chunk.encode())
+
+
+# Time taken and, in a second run, the peak of memory traced
+def measure(fn):
+    db_session.expunge_all()
+    start = time.perf_counter()
+    with open(os.devnull, "wb") as file:
+        fn(file)
+    elapsed = time.perf_counter() - start
+    db_session.rollback()
+
+    db_session.expunge_all()
+    tracemalloc.start()
+    with open(os.devnull, "wb") as file:
+        fn(file)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db_session.rollback()
+    return elapsed, peak
+
+
+def main(rows: int):
+    populate(rows)
+    print(f"{rows} records")
+    for name, fn in (("in memory", in_memory), ("streamed", streamed)):
+        elapsed, peak = measure(fn)
+        print(f"{name:>10}: {elapsed:>7.2f}s, peak memory {peak / 1024 / 1024:>7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,156 @@
+"""
+Archive selfies through the bot's download path against a local stub of the
+Telegram getFile method & file download endpoint
+
+Every selfie is submitted twice; it must be downloaded once. Reports how long
+submitting takes in the handler, how long the archive takes to drain with more
+workers, and checks the archived content, the thumbnails, the size cap and that
+the archive is loaded again from disk.
+
+    python benchmarks/selfie_archive.py [--photos 300] [--latency 20] [--workers 1 4 8]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+from telebot import apihelper
+
+import archive
+from archive import THUMBNAILS, SelfieArchive
+
+
+def make_photo(index: int):
+    """
+    JPEG of a selfie when Pillow is installed, random bytes otherwise
+    """
+    if archive.Image is None:
+        return os.urandom(60_000)
+    image = archive.Image.new("RGB", (800, 600), (index % 256, index * 7 % 256, 90))
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class StubTelegram:
+    """
+    Local HTTP server answering getFile & serving the photos
+    """
+
+    def __init__(self, photos: dict, latency: float):
+        self.photos = photos  # file_id: content
+        self.downloads = {}
+        lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                time.sleep(latency)
+                if url.path.endswith("/getFile"):
+                    file_id = parse_qs(url.query)["file_id"][0]
+                    result = {
+                        "file_id": file_id,
+                        "file_unique_id": f"u{file_id}",
+                        "file_path": f"photos/{file_id}.jpg",
+                    }
+                    return self.reply(json.dumps({"ok": True, "result": result}).encode())
+                file_id = os.path.splitext(os.path.basename(url.path))[0]
+                if file_id not in stub.photos:
+                    return self.send_error(404)
+                with lock:
+                    stub.downloads[file_id] = stub.downloads.get(file_id, 0) + 1
+                self.reply(stub.photos[file_id])
+
+            do_POST = do_GET
+
+            def reply(self, body: bytes):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+        apihelper.API_URL = f"http://127.0.0.1:{port}/bot{{0}}/{{1}}"
+        apihelper.FILE_URL = f"http://127.0.0.1:{port}/file/bot{{0}}/{{1}}"
+
+
+def fill(directory: str, photos: dict, workers: int, max_size: int = 1 << 40):
+    """
+    Submit every photo twice and wait for the archive; returns archive & timings
+    """
+    from main import download_photo
+
+    selfie_archive = SelfieArchive(directory, download_photo, max_size, workers=workers)
+    submit_times = []
+    start = time.perf_counter()
+    for _ in range(2):
+        for file_id in photos:
+            submitted = time.perf_counter()
+            selfie_archive.submit(file_id, f"u{file_id}")
+            submit_times.append(time.perf_counter() - submitted)
+    selfie_archive.shutdown(wait=True)
+    elapsed = time.perf_counter() - start
+    return selfie_archive, elapsed, sum(submit_times) / len(submit_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--photos", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds per request")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    photos = {f"F{index:05d}": make_photo(index) for index in range(args.photos)}
+    stub = StubTelegram(photos, args.latency / 1000)
+    root = tempfile.mkdtemp()
+
+    thumbnails = archive.Image is not None
+    print(f"photos: {args.photos}, latency: {args.latency}ms, thumbnails: {thumbnails}")
+    print(f"{'workers':>8}{'submit us':>11}{'drain s':>9}{'photos/s':>10}{'downloads':>11}")
+    for workers in args.workers:
+        stub.downloads.clear()
+        directory = os.path.join(root, f"workers{workers}")
+        selfie_archive, elapsed, submit_time = fill(directory, photos, workers)
+        assert all(count == 1 for count in stub.downloads.values()), "downloaded twice"
+        for file_id, content in photos.items():
+            with open(selfie_archive.photo(f"u{file_id}"), "rb") as file:
+                assert file.read() == content, "archived photo differs"
+            if thumbnails:
+                assert os.path.exists(selfie_archive.path(f"u{file_id}", THUMBNAILS))
+        print(
+            f"{workers:>8}{submit_time * 1e6:>11.1f}{elapsed:>9.2f}"
+            f"{len(photos) / elapsed:>10.0f}{sum(stub.downloads.values()):>11}"
+        )
+
+    # Cap at half the archive; the oldest photos go first
+    full = selfie_archive.stats()["bytes"]
+    directory = os.path.join(root, "capped")
+    selfie_archive, _, _ = fill(directory, photos, max(args.workers), full // 2)
+    stats = selfie_archive.stats()
+    assert stats["bytes"] <= full // 2, "archive over its maximum size"
+    reloaded = SelfieArchive(directory, None, full // 2).stats()
+    assert (reloaded["photos"], reloaded["bytes"]) == (stats["photos"], stats["bytes"])
+    print(
+        f"capped at {full // 2} bytes: kept {stats['photos']} of {len(photos)} photos, "
+        f"{stats['bytes']} bytes; same after reload"
+    )
+    stub.server.shutdown()
+    shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Database size and check-in insert rate with selfies stored as JSON of every size,
+like before, and in the compact format
+
+Check-ins are inserted into the old attendance table, which is then migrated by
+`manage.py migrate_selfies`, and as many check-ins are inserted again. Inserts
+are committed 50 at a time like the attendance writer does; the compact table
+already holds the migrated records when it is measured.
+
+    python benchmarks/selfie_storage.py [check-ins]
+"""
+import base64
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+from sqlalchemy import MetaData, text
+
+from db_backend import engine
+from manage import legacy_attendance_table, migrate_attendance
+from models import Attendance, SelfiePhoto
+from settings import DB_LOCATION
+
+CHECKINS = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+COMMIT_EVERY = 50
+
+SIZES = ((90, 67), (320, 240), (800, 600), (1280, 960))
+
+
+# Random IDs as long as Telegram's; 84 characters file ID and 16 characters unique ID
+def telegram_ids():
+    return (
+        base64.urlsafe_b64encode(os.urandom(63)).decode(),
+        base64.urlsafe_b64encode(os.urandom(12)).decode(),
+    )
+
+
+def selfie_sizes():
+    sizes = []
+    for width, height in SIZES:
+        file_id, file_unique_id = telegram_ids()
+        sizes.append(
+            {
+                "file_id": file_id,
+                "file_unique_id": file_unique_id,
+                "width": width,
+                "height": height,
+                "file_size": width * height // 8,
+            }
+        )
+    return sizes
+
+
+def check_ins(count: int, compact: bool):
+    start = datetime(2023, 7, 31, 3, 30)
+    for i in range(count):
+        sizes = selfie_sizes()
+        row = {
+            "user_id": i % 500,
+            "selfie_time": start + timedelta(seconds=i),
+            "location": {"longitude": 77.59, "latitude": 12.97},
+            "location_time": start + timedelta(seconds=i + 30),
+        }
+        if compact:
+            row["selfie_file_id"] = sizes[-1]["file_id"]
+            row["selfie_file_unique_id"] = sizes[-1]["file_unique_id"]
+        else:
+            row["selfie"] = sizes
+        yield row
+
+
+# Insert one record per statement and commit every COMMIT_EVERY; returns records per second
+def insert(table, rows: list):
+    start = time.perf_counter()
+    for i in range(0, len(rows), COMMIT_EVERY):
+        with engine.begin() as connection:
+            for row in rows[i : i + COMMIT_EVERY]:
+                connection.execute(table.insert(), row)
+    return len(rows) / (time.perf_counter() - start)
+
+
+def database_size():
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM"))
+        connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+    return os.path.getsize(DB_LOCATION) / 1024 / 1024
+
+
+def main():
+    legacy = legacy_attendance_table(MetaData())
+    SelfiePhoto.__table__.drop(engine)
+    Attendance.__table__.drop(engine)
+    legacy.create(engine)
+
+    legacy_rate = insert(legacy, list(check_ins(CHECKINS, compact=False)))
+    legacy_size = database_size()
+
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        migrate_attendance(connection)
+    migration_time = time.perf_counter() - start
+    SelfiePhoto.__table__.create(engine)
+    compact_size = database_size()
+    compact_rate = insert(Attendance.__table__, list(check_ins(CHECKINS, compact=True)))
+
+    print(f"check-ins: {CHECKINS}, {len(SIZES)} sizes per selfie")
+    print(f"{'':<10}{'size MiB':>10}{'inserts/s':>11}")
+    print(f"{'json':<10}{legacy_size:>10.1f}{legacy_rate:>11.0f}")
+    print(f"{'compact':<10}{compact_size:>10.1f}{compact_rate:>11.0f}")
+    print(f"migrated {CHECKINS} records in {migration_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
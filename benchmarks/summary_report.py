@@ -0,0 +1,43 @@
+"""
+Benchmark month and year HR reports read from every punch against the daily
+attendance summary
+
+    python benchmarks/summary_report.py [rows]
+"""
+from datetime import datetime
+import sys
+import time
+
+import common
+from db_backend import db_session
+from models import DailyAttendanceSummary
+from reports import ReportRequest, build_report
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+RANGES = {
+    "month": (datetime(2023, 6, 30, 18, 30), datetime(2023, 7, 31, 18, 29, 59)),
+    "year": (datetime(2022, 12, 31, 18, 30), datetime(2023, 12, 31, 18, 29, 59)),
+}
+
+
+def main():
+    common.populate(ROWS)
+    start = time.perf_counter()
+    days = DailyAttendanceSummary.rebuild()
+    print(f"rows: {ROWS}, backfill of {days} user days: {time.perf_counter() - start:.2f}s")
+
+    print(f"{'range':<8}{'view':<10}{'rows read':>10}{'seconds':>10}")
+    for name, (start_date, end_date) in RANGES.items():
+        for view in ("HR", "Summary"):
+            request = ReportRequest(start_date, end_date, None, view, "csv")
+            start = time.perf_counter()
+            report = build_report(request, 1)
+            elapsed = time.perf_counter() - start
+            lines = report.document.count(b"\n") - 1
+            print(f"{name:<8}{view:<10}{lines:>10}{elapsed:>10.2f}")
+            db_session.remove()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the timezone helpers; time per call in microseconds
+
+The pytz based helpers the bot used before are measured alongside when pytz is
+installed.
+
+    python benchmarks/timezone_helpers.py [calls]
+"""
+from datetime import datetime, timedelta
+import sys
+import timeit
+
+import common  # noqa: F401  # Keep first; sets up a throw away database
+from helpers import (
+    UTC_from_epoch,
+    format_local_all,
+    local_tz,
+    to_local,
+    to_local_all,
+    to_UTC,
+)
+from settings import ORG_TIMEZONE
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+utc_time = datetime(2023, 7, 31, 3, 30)
+local_time = datetime(2023, 7, 31, 9, 0)
+batch = [utc_time + timedelta(minutes=i) for i in range(1000)]
+
+
+def legacy_to_local(timestamp: datetime):
+    tz = pytz.timezone(ORG_TIMEZONE)
+    return tz.normalize(timestamp.replace(tzinfo=pytz.utc).astimezone(tz))
+
+
+def legacy_to_UTC(timestamp: datetime):
+    tz = pytz.timezone(ORG_TIMEZONE)
+    return pytz.utc.normalize(tz.localize(timestamp, is_dst=None).astimezone(pytz.utc))
+
+
+def legacy_UTC_from_epoch(epoch: int):
+    return datetime.utcfromtimestamp(epoch)
+
+
+def measure(fn, calls: int = CALLS):
+    return min(timeit.repeat(fn, number=calls, repeat=3)) / calls * 1e6
+
+
+def main():
+    print(f"timezone: {ORG_TIMEZONE} ({type(local_tz).__name__})")
+    cases = [
+        ("to_local", lambda: to_local(utc_time), lambda: legacy_to_local(utc_time)),
+        ("to_UTC", lambda: to_UTC(local_time), lambda: legacy_to_UTC(local_time)),
+        (
+            "UTC_from_epoch",
+            lambda: UTC_from_epoch(1690774200),
+            lambda: legacy_UTC_from_epoch(1690774200),
+        ),
+        (
+            "format one by one",
+            lambda: to_local(utc_time).strftime("%d-%m-%Y %H:%M"),
+            lambda: legacy_to_local(utc_time).strftime("%d-%m-%Y %H:%M"),
+        ),
+    ]
+    print(f"{'helper':<20}{'us/call':>10}{'pytz':>10}")
+    for name, current, legacy in cases:
+        legacy_time = f"{measure(legacy):>10.2f}" if pytz else f"{'-':>10}"
+        print(f"{name:<20}{measure(current):>10.2f}{legacy_time}")
+
+    calls = max(CALLS // len(batch), 1)
+    for name, fn in (
+        ("to_local_all", lambda: to_local_all(batch)),
+        ("format_local_all", lambda: format_local_all(batch)),
+    ):
+        print(f"{name:<20}{measure(fn, calls) / len(batch):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
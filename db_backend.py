@@ -1,10 +1,44 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
 
-from settings import DB_LOCATION
+from settings import (
+    DATABASE_URL,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    SQLITE_PRAGMAS,
+)
 
-engine = create_engine("sqlite:///" + DB_LOCATION)  # , echo=True, hide_parameters=False
-db_session = sessionmaker(bind=engine)()
+database_url = make_url(DATABASE_URL)
+is_sqlite = database_url.get_backend_name() == "sqlite"
+
+engine = create_engine(
+    database_url,
+    # Connections are handed over between bot worker threads by the pool
+    connect_args={"check_same_thread": False} if is_sqlite else {},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=-1 if is_sqlite else DB_POOL_RECYCLE,
+    pool_pre_ping=not is_sqlite,
+)  # , echo=True, hide_parameters=False
+
+
+# Tune every new SQLite connection; WAL lets readers run along with a writer
+if is_sqlite:
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+# Session per thread; must be removed once an update has been handled
+db_session = scoped_session(sessionmaker(bind=engine))
 
 
 def debug_query(query):
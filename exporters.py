@@ -0,0 +1,254 @@
+import csv
+import io
+import re
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+
+# Characters XML 1.0 doesn't allow even escaped; a single one corrupts the workbook
+XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+class ReportTable:
+    """
+    Tabular report independent of the output format
+    """
+
+    def __init__(self, title: str, details: list, columns: list, rows):
+        """
+        :param title: heading of the report
+        :param details: lines shown below heading; each a list of texts
+        :param columns: list of (column name, width in percent or None for remaining width)
+        :param rows: iterable of rows; each a list of values in column order
+        """
+        self.title = title
+        self.details = details
+        self.columns = columns
+        self.rows = rows
+
+
+# HTML document of the table; generated in chunks
+def export_html(table: ReportTable):
+    col_count = len(table.columns)
+    yield f"""
+    <html>
+    <body>
+    <center>
+    <table width='100%' border='2px solid'>
+    <tr>
+    <td colspan='{col_count}' style='text-align:center;font-weight:bold;'>{escape(table.title)}</td>
+    </tr>
+    """
+    for detail in table.details:
+        yield "<tr>"
+        span = col_count - col_count // 2
+        for text in detail:
+            yield f"<td colspan='{span}'>{escape(text)}</td>"
+            span = col_count // 2
+        yield "</tr>"
+
+    yield "<tr>"
+    for name, width in table.columns:
+        yield f"<th width='{str(width) + '%' if width else '*'}'>{escape(name)}</th>"
+    yield "</tr>"
+
+    for row in table.rows:
+        yield "<tr>" + "".join(f"<td>{escape(str(value))}</td>" for value in row) + "</tr>"
+    yield "</table></center></body></html>"
+
+
+# Comma separated values; UTF-8 with BOM so that spreadsheets detect the encoding
+def export_csv(table: ReportTable, output):
+    text = io.TextIOWrapper(output, encoding="utf-8-sig", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow([name for name, _ in table.columns])
+    for row in table.rows:
+        writer.writerow(row)
+    text.detach()
+
+
+# Excel workbook with a single sheet; written directly as Office Open XML
+def export_xlsx(table: ReportTable, output):
+    def cell(value):
+        if isinstance(value, (int, float)):
+            return f"<c><v>{value}</v></c>"
+        text = escape(XML_ILLEGAL.sub("", str(value)))
+        return f'<c t="inlineStr"><is><t>{text}</t></is></c>'
+
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as xlsx:
+        xlsx.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            "</Types>",
+        )
+        xlsx.writestr(
+            "_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/>'
+            "</Relationships>",
+        )
+        xlsx.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(XML_ILLEGAL.sub("", table.title)[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+            "</workbook>",
+        )
+        xlsx.writestr(
+            "xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/>'
+            "</Relationships>",
+        )
+        with xlsx.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b"<sheetData>"
+            )
+            header = [name for name, _ in table.columns]
+            sheet.write(f"<row>{''.join(map(cell, header))}</row>".encode())
+            for row in table.rows:
+                sheet.write(f"<row>{''.join(map(cell, row))}</row>".encode())
+            sheet.write(b"</sheetData></worksheet>")
+
+
+class PDFWriter:
+    """
+    Minimal PDF writer drawing a table with the standard Helvetica fonts; no external
+    program or font files are required
+    """
+
+    PAGE_WIDTH, PAGE_HEIGHT = 842, 595  # A4 landscape in points
+    MARGIN = 36
+    FONT_SIZE = 9
+    ROW_HEIGHT = 14
+
+    def __init__(self, table: ReportTable):
+        self.table = table
+        usable_width = self.PAGE_WIDTH - 2 * self.MARGIN
+        fixed_width = sum(width or 0 for _, width in table.columns)
+        flexible = [width for _, width in table.columns].count(None) or 1
+        self.column_widths = [
+            usable_width * (width or max(100 - fixed_width, 0) / flexible) / 100
+            for _, width in table.columns
+        ]
+
+    @staticmethod
+    def _text(value):
+        # Standard fonts only cover latin-1 characters
+        text = str(value).encode("latin-1", "replace").decode("latin-1")
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    def _cell(self, value, x, y, width, font="F1"):
+        max_chars = int(width / (self.FONT_SIZE * 0.5)) - 1
+        text = str(value)
+        if len(text) > max_chars:
+            text = text[: max(max_chars - 2, 0)] + ".."
+        return f"BT /{font} {self.FONT_SIZE} Tf {x:.1f} {y:.1f} Td ({self._text(text)}) Tj ET\n"
+
+    def _row(self, row, y, font="F1"):
+        x = self.MARGIN
+        content = ""
+        for value, width in zip(row, self.column_widths):
+            content += self._cell(value, x + 2, y, width, font)
+            x += width
+        return content
+
+    def _line(self, y):
+        return f"{self.MARGIN} {y:.1f} m {self.PAGE_WIDTH - self.MARGIN} {y:.1f} l S\n"
+
+    def _page_header(self, first_page: bool):
+        y = self.PAGE_HEIGHT - self.MARGIN
+        content = ""
+        if first_page:
+            content += f"BT /F2 14 Tf {self.MARGIN} {y - 10:.1f} Td ({self._text(self.table.title)}) Tj ET\n"
+            y -= 28
+            for detail in self.table.details:
+                content += self._cell("    ".join(detail), self.MARGIN, y, self.PAGE_WIDTH)
+                y -= self.ROW_HEIGHT
+            y -= 4
+        content += self._row([name for name, _ in self.table.columns], y, "F2")
+        content += self._line(y - 4)
+        return content, y - self.ROW_HEIGHT - 2
+
+    def _pages(self):
+        content, y = self._page_header(first_page=True)
+        for row in self.table.rows:
+            if y < self.MARGIN:
+                yield content
+                content, y = self._page_header(first_page=False)
+            content += self._row(row, y)
+            y -= self.ROW_HEIGHT
+        yield content
+
+    def write(self, output):
+        """
+        Write the PDF document
+        :param output: binary file-like object
+        """
+        offsets = []
+        position = 0
+
+        def write_object(body: bytes):
+            nonlocal position
+            offsets.append(position)
+            data = f"{len(offsets)} 0 obj\n".encode() + body + b"\nendobj\n"
+            output.write(data)
+            position += len(data)
+
+        header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        output.write(header)
+        position += len(header)
+
+        # 1: catalog, 2: fonts, 3: bold font; pages tree is written last as object 4
+        write_object(b"<< /Type /Catalog /Pages 4 0 R >>")
+        write_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+        write_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")
+        offsets.append(None)  # Reserve object 4 for pages tree
+
+        page_ids = []
+        for content in self._pages():
+            stream = zlib.compress(content.encode("latin-1"))
+            write_object(
+                f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode()
+                + stream
+                + b"\nendstream"
+            )
+            write_object(
+                f"<< /Type /Page /Parent 4 0 R /MediaBox [0 0 {self.PAGE_WIDTH} {self.PAGE_HEIGHT}] "
+                f"/Resources << /Font << /F1 2 0 R /F2 3 0 R >> >> /Contents {len(offsets)} 0 R >>".encode()
+            )
+            page_ids.append(len(offsets))
+
+        kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+        pages = f"4 0 obj\n<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>\nendobj\n".encode()
+        offsets[3] = position
+        output.write(pages)
+        position += len(pages)
+
+        xref = f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n"
+        xref += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+        output.write(xref.encode())
+        output.write(
+            f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n".encode()
+        )
+
+
+# PDF document rendered in process
+def export_pdf(table: ReportTable, output):
+    PDFWriter(table).write(output)
@@ -0,0 +1,53 @@
+"""
+Face embedding models; run in the face verification worker processes
+
+A model is a function taking the content of an image and returning the embedding
+of the face in it as a list of floats, None when there's no face. Models are
+named "module:function" in FACE_MODEL so another model can be plugged in; this
+module must stay free of the bot's database & Telegram imports since it's loaded
+by every worker process.
+"""
+from importlib import import_module
+from io import BytesIO
+
+try:
+    import face_recognition
+except ImportError:  # Optional; face verification is unavailable without a model
+    face_recognition = None
+
+_model = None
+
+
+def load_model(name: str):
+    """
+    :param name: "module:function" of the model
+    """
+    module, function = name.split(":", 1)
+    return getattr(import_module(module), function)
+
+
+# 128 dimensional dlib embedding of the largest face; CPU only, HOG face detector
+def face_recognition_embedding(content: bytes):
+    if face_recognition is None:
+        raise RuntimeError("face_recognition is not installed; pip install face_recognition")
+    image = face_recognition.load_image_file(BytesIO(content))
+    locations = face_recognition.face_locations(image, model="hog")
+    if not locations:
+        return None
+    # (top, right, bottom, left); the employee is the one closest to the camera
+    largest = max(locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+    encoding = face_recognition.face_encodings(image, [largest])[0]
+    return encoding.tolist()
+
+
+# Initializer of worker processes; the model is loaded once per process
+def init_worker(name: str):
+    global _model
+    _model = load_model(name)
+
+
+def embed(content: bytes):
+    """
+    Embedding of the face in an image with the model of this worker process
+    """
+    return _model(content)
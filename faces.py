@@ -0,0 +1,233 @@
+"""
+Face verification of selfies against the enrolled face of every user
+
+Faces are embedded by FACE_MODEL (see face_model) in a pool of worker processes,
+so CPU heavy inference never holds up the handlers. A few threads feed the pool;
+they download the photos, compare embeddings with the user's reference and write
+the results onto the attendance records. A selfie matches when the distance of
+its face from the reference is at most the threshold. References are enrolled by
+HR with manage.py enroll_face; selfies of a user without one are left unverified,
+never taken as their reference, so that an impostor's check-in can't become it.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import math
+import multiprocessing
+import threading
+import time
+
+from db_backend import db_session
+import face_model
+from helpers import LRUCache
+from jobs import JobQueue
+import metrics
+from models import Attendance, FaceReference
+
+logger = logging.getLogger(__name__)
+
+# Results of verifying a selfie
+MATCH = "match"
+MISMATCH = "mismatch"
+NO_FACE = "no_face"
+NOT_ENROLLED = "not_enrolled"
+
+
+class FaceVerifier:
+    """
+    Verify selfies in background with a process pool running the face model
+    """
+
+    def __init__(
+        self,
+        model: str,
+        download,
+        write,
+        threshold: float = 0.6,
+        processes: int = 2,
+        queue_size: int = 1000,
+        cache_size: int = 1024,
+        cache_ttl: float = 300,
+    ):
+        """
+        :param model: "module:function" of the face model
+        :param download: function returning the content of a photo by its file_id &
+            file_unique_id
+        :param write: function applying a database write; e.g. GroupCommitWriter.write
+        :param threshold: maximum distance of a face from the reference to match
+        :param processes: number of worker processes running the model
+        :param queue_size: maximum number of selfies waiting to be verified; more are
+            left for the batch mode instead of piling up
+        :param cache_size: number of reference embeddings cached
+        :param cache_ttl: seconds a reference embedding is cached; a reference enrolled
+            again is used after this long
+        """
+        self.model = model
+        self.download = download
+        self.write = write
+        self.threshold = threshold
+        self.processes = processes
+        self.queue_size = queue_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Downloads overlap inference; twice as many threads keep the processes busy
+        self._jobs = JobQueue(workers=processes * 2, name="face")
+        self._references = LRUCache(cache_size, cache_ttl)
+
+    def start(self):
+        """
+        Start the worker processes & load the model in them. Workers are spawned: fresh
+        interpreters that inherit none of the bot's threads, locks or database
+        connections. Like any spawned process they import the launching script again,
+        e.g. main.py, without running its __main__ block.
+        """
+        with self._pool_lock:
+            self._start_pool()
+        return self
+
+    def _start_pool(self):
+        # Processes are spawned as tasks arrive while none is idle; start them now so the
+        # model is loaded, or fails to, at startup
+        pool = ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=face_model.init_worker,
+            initargs=(self.model,),
+        )
+        for future in [pool.submit(time.sleep, 0) for _ in range(self.processes)]:
+            future.result()
+        self._pool = pool
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """
+        Replace a broken pool once; every job that was running on it fails & asks for this.
+        Workers are spawned, so a pool can be started again safely while the bot runs.
+        """
+        with self._pool_lock:
+            if self._pool is not broken:
+                return  # Already replaced for another job
+            logger.error("Face worker process died; starting them again")
+            broken.shutdown(wait=True, cancel_futures=True)
+            self._start_pool()
+
+    def shutdown(self, wait: bool = True):
+        self._jobs.shutdown(wait=wait)
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        """
+        Number of selfies by state; see JobQueue.stats
+        """
+        return self._jobs.stats()
+
+    def reference(self, user_id: int):
+        """
+        Reference embedding of a user; None when not enrolled
+        :param user_id: user ID of user
+        """
+        embedding = self._references.get(user_id)
+        if embedding is None:
+            embedding = FaceReference.get_embedding(user_id)
+            if embedding is not None:
+                self._references.set(user_id, embedding)
+        return embedding
+
+    def compare(self, user_id: int, embedding: list):
+        """
+        Compare a face with the reference of a user
+        :param user_id: user ID of user
+        :param embedding: embedding of the face; None when there's no face
+        :return: result, distance from the reference & whether it's verified; None when
+            the user is not enrolled
+        """
+        reference = self.reference(user_id)
+        if reference is None:
+            return NOT_ENROLLED, None, None
+        if embedding is None:
+            return NO_FACE, None, False
+        distance = math.dist(embedding, reference)
+        verified = distance <= self.threshold
+        return MATCH if verified else MISMATCH, distance, verified
+
+    def submit(self, attendance_id: int, user_id: int, file_id: str, file_unique_id: str):
+        """
+        Queue a selfie to be verified
+        :param attendance_id: ID of the attendance record of the selfie
+        :param user_id: user ID of user
+        :param file_id: Telegram file_id to download the selfie with
+        :param file_unique_id: Telegram file_unique_id of the selfie
+        :return: whether the selfie has been queued
+        """
+        if self._jobs.stats()["queued"] >= self.queue_size:
+            metrics.faces_total.inc(result="dropped")
+            return False
+        return self._jobs.submit(
+            attendance_id,
+            lambda: self._verify(attendance_id, user_id, file_id, file_unique_id),
+            lambda result, error: None,  # Failures are logged by the job queue
+        )
+
+    def embed(self, content: bytes):
+        """
+        Embedding of the face in an image by a worker process; None when there's no face
+        :param content: content of the image
+        """
+        start = time.perf_counter()
+        pool = self._pool
+        try:
+            return pool.submit(face_model.embed, content).result()
+        except BrokenProcessPool:
+            self._restart(pool)
+            raise
+        finally:
+            metrics.face_seconds.observe(time.perf_counter() - start)
+
+    def _verify(self, attendance_id: int, user_id: int, file_id: str, file_unique_id: str):
+        try:
+            if self.reference(user_id) is None:
+                result = NOT_ENROLLED  # Verified by manage.py verify_faces once enrolled
+            else:
+                embedding = self.embed(self.download(file_id, file_unique_id))
+                result, distance, verified = self.compare(user_id, embedding)
+                self.write(Attendance.set_face_result, attendance_id, distance, verified)
+        except Exception:
+            metrics.faces_total.inc(result="failed")
+            raise
+        finally:
+            db_session.remove()
+        metrics.faces_total.inc(result=result)
+        return result
+
+    def verify_many(self, selfies, download_workers: int = 8):
+        """
+        Verify a batch of selfies; photos are downloaded concurrently and embedded by
+        all the worker processes at once
+        :param selfies: (attendance ID, user ID, file_id, file_unique_id) of selfies
+        :param download_workers: number of concurrent downloads
+        :return: (attendance ID, result, distance, verified) of every selfie; photos
+            that can't be downloaded and selfies of users not enrolled are skipped
+        """
+        selfies = [selfie for selfie in selfies if self.reference(selfie[1]) is not None]
+
+        def download(selfie):
+            try:
+                return self.download(selfie[2], selfie[3])
+            except Exception as e:
+                logger.warning("Selfie of attendance %s not downloaded: %s", selfie[0], e)
+
+        with ThreadPoolExecutor(download_workers) as executor:
+            contents = list(executor.map(download, selfies))
+        downloaded = [(selfie, content) for selfie, content in zip(selfies, contents) if content]
+        chunksize = max(len(downloaded) // (self.processes * 4), 1)
+        embeddings = self._pool.map(
+            face_model.embed, [content for _, content in downloaded], chunksize=chunksize
+        )
+        results = []
+        for (selfie, _), embedding in zip(downloaded, embeddings):
+            attendance_id, user_id, _, _ = selfie
+            result, distance, verified = self.compare(user_id, embedding)
+            metrics.faces_total.inc(result=result)
+            results.append((attendance_id, result, distance, verified))
+        return results
@@ -1,6 +1,11 @@
-from datetime import datetime
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
 import hashlib
-import pytz
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+from settings import ORG_TIMEZONE
 
 
 # Takes an object and return its hash ( SHA512 )
@@ -14,28 +19,98 @@ def get_hashed(message: str):
     return str(hash_hex)
 
 
-# Change UTC datetime to IST datetime
-def to_IST(timestamp: datetime):
+EPOCH = datetime(1970, 1, 1)
+local_tz = ZoneInfo(ORG_TIMEZONE)  # Resolved once; conversions use its cached transitions
+
+
+# Change UTC datetime to organisation's local datetime
+def to_local(timestamp: datetime):
     """
-    Convert UTC datetime to IST datetime
-    :param timestamp: UTC timestamp
-    :return: IST timestamp
+    Convert UTC datetime to local datetime of the organisation
+    :param timestamp: UTC timestamp; naive timestamps are taken as UTC
+    :return: local timestamp
     """
-    local_tz = pytz.timezone("Asia/Kolkata")
-    local_dt = timestamp.replace(tzinfo=pytz.utc).astimezone(local_tz)
-    return local_tz.normalize(local_dt)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(local_tz)
+
 
+to_IST = to_local  # Organisation's timezone used to be fixed to IST
 
-# Change IST datetime to UTC datetime
+
+# Change organisation's local datetime to UTC datetime
 def to_UTC(timestamp: datetime):
     """
-    Convert IST datetime to UTC datetime
-    :param timestamp: IST timestamp
+    Convert local datetime of the organisation to UTC datetime
+    :param timestamp: local timestamp; naive timestamps are taken as local
     :return: UTC timestamp
     """
-    local_tz = pytz.timezone("Asia/Kolkata")
-    utc_dt = local_tz.localize(timestamp, is_dst=None).astimezone(pytz.utc)
-    return pytz.utc.normalize(utc_dt)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=local_tz)
+    return timestamp.astimezone(timezone.utc)
+
+
+# UTC bounds of organisation's local days; queries compare stored UTC timestamps with them
+def local_days_bounds(start_day: date, end_day: date = None):
+    """
+    Time range of local days from midnight of start day to midnight after end day
+    :param start_day: first local date
+    :param end_day: last local date; same as start day if not provided
+    :return: UTC start (inclusive) & UTC end (exclusive) as naive timestamps
+    """
+    end_day = end_day or start_day
+    start_time = datetime.combine(start_day, datetime.min.time(), local_tz)
+    end_time = datetime.combine(end_day + timedelta(days=1), datetime.min.time(), local_tz)
+    return (
+        start_time.astimezone(timezone.utc).replace(tzinfo=None),
+        end_time.astimezone(timezone.utc).replace(tzinfo=None),
+    )
+
+
+# UTC bounds of the organisation's local day of a UTC timestamp
+def local_day_bounds(timestamp: datetime):
+    """
+    :param timestamp: UTC timestamp
+    :return: UTC start (inclusive) & UTC end (exclusive) of the local day as naive timestamps
+    """
+    return local_days_bounds(to_local(timestamp).date())
+
+
+# Convert a batch of UTC datetimes; e.g. all the punches of a report
+def to_local_all(timestamps):
+    """
+    Convert UTC datetimes to local datetimes of the organisation
+    :param timestamps: iterable of UTC timestamps; naive timestamps are taken as UTC
+    :return: list of local timestamps
+    """
+    utc, tz = timezone.utc, local_tz
+    return [
+        (ts if ts.tzinfo else ts.replace(tzinfo=utc)).astimezone(tz) for ts in timestamps
+    ]
+
+
+# Format a batch of UTC datetimes in organisation's local time
+def format_local_all(timestamps, fmt: str = "%d-%m-%Y %H:%M"):
+    """
+    :param timestamps: iterable of UTC timestamps; None is formatted as empty string
+    :param fmt: strftime format
+    :return: list of formatted local timestamps
+    """
+    utc, tz = timezone.utc, local_tz
+    return [
+        (ts if ts.tzinfo else ts.replace(tzinfo=utc)).astimezone(tz).strftime(fmt)
+        if ts is not None
+        else ""
+        for ts in timestamps
+    ]
+
+
+# Largest of the sizes Telegram sends of a photo
+def largest_photo(sizes: list):
+    """
+    :param sizes: dicts of file_id, file_unique_id, width, height & file_size
+    """
+    return max(sizes, key=lambda size: (size.get("width") or 0) * (size.get("height") or 0))
 
 
 # Get timestamp from epoch
@@ -43,9 +118,9 @@ def UTC_from_epoch(epoch: int):
     """
     Convert UNIX epoch to UTC timestamp
     :param epoch: UNIX epoch
-    :return: UTC timestamp
+    :return: naive UTC timestamp
     """
-    return datetime.utcfromtimestamp(epoch)
+    return EPOCH + timedelta(seconds=epoch)
 
 
 def time_difference(
@@ -63,3 +138,72 @@ def time_difference(
         time_diff_minutes = (time_diff.seconds - (time_diff_hours * 3600)) // 60
         time_diff = f"{str(time_diff_hours).rjust(2, '0')}:{str(time_diff_minutes).rjust(2, '0')}"
     return time_diff
+
+
+class LRUCache:
+    """
+    Thread safe in-memory cache with a bounded size and time to live;
+    least recently used entries are evicted first
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        """
+        :param max_size: maximum number of entries to keep
+        :param ttl: seconds after which an entry expires
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a cached value; expired entries are dropped
+        :param key: key of the entry
+        :param default: value to return when key is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Cache a value and evict the least recently used entries beyond max size
+        :param key: key of the entry
+        :param value: value to be cached
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry from the cache
+        :param key: key of the entry
+        :param default: value to return when key is not cached
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def discard_where(self, predicate):
+        """
+        Remove all the entries whose value matches the predicate
+        :param predicate: function taking the cached value; return True to remove it
+        """
+        with self._lock:
+            for key in [k for k, (v, _) in self._entries.items() if predicate(v)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
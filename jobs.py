@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Run jobs in a pool of worker threads; a job submitted again while it is still
+    pending or running is coalesced and its result is shared with every requester
+    """
+
+    def __init__(self, workers: int = 2, name: str = "job"):
+        """
+        :param workers: maximum number of jobs running concurrently
+        :param name: prefix of worker thread names
+        """
+        self.name = name
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._queued = 0
+        self._running = 0
+        self._submitted = 0
+        self._coalesced = 0
+        self._completed = 0
+        self._failed = 0
+
+    def submit(self, key, job, callback) -> bool:
+        """
+        Queue a job unless the same job is already pending
+        :param key: hashable identity of the job; used for coalescing
+        :param job: function without arguments producing the result
+        :param callback: function called with (result, error) once job is done
+        :return: whether a new job has been queued
+        """
+        with self._lock:
+            self._submitted += 1
+            if key in self._callbacks:
+                self._callbacks[key].append(callback)
+                self._coalesced += 1
+                return False
+            self._callbacks[key] = [callback]
+            self._queued += 1
+        self._executor.submit(self._run, key, job)
+        logger.debug("%s queued: %s", self.name, self.stats())
+        return True
+
+    def _run(self, key, job):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+
+        result, error = None, None
+        try:
+            result = job()
+        except Exception as e:
+            logger.exception("%s failed: %s", self.name, key)
+            error = e
+
+        with self._lock:
+            self._running -= 1
+            if error is None:
+                self._completed += 1
+            else:
+                self._failed += 1
+            callbacks = self._callbacks.pop(key)
+
+        for callback in callbacks:
+            try:
+                callback(result, error)
+            except Exception:
+                logger.exception("%s callback failed: %s", self.name, key)
+
+    def stats(self) -> dict:
+        """
+        Queue depth and counters of the jobs
+        """
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "running": self._running,
+                "submitted": self._submitted,
+                "coalesced": self._coalesced,
+                "completed": self._completed,
+                "failed": self._failed,
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
@@ -1,38 +1,147 @@
 from datetime import datetime, timedelta
-import os
-import pdfkit
+import atexit
+import logging
+import sys
 import telebot
-
-from db_backend import db_session
-from helpers import UTC_from_epoch, get_hashed, time_difference, to_IST, to_UTC
-from models import Attendance, User
-from settings import BOT_TOKEN, SELFIE_LOCATION_DELAY
-
-bot = telebot.TeleBot(BOT_TOKEN)
+from telebot.handler_backends import BaseMiddleware
+
+from archive import SelfieArchive
+from db_backend import db_session, engine
+from faces import FaceVerifier
+from helpers import (
+    UTC_from_epoch,
+    get_hashed,
+    largest_photo,
+    local_day_bounds,
+    local_days_bounds,
+    to_local,
+)
+from jobs import JobQueue
+import metrics
+from models import LEGACY_SELFIES, User
+from pairing import (
+    EXPIRED,
+    LOCATION,
+    PAIRED,
+    SELFIE,
+    WAITING,
+    PairingEngine,
+    PunchResult,
+    other_half,
+)
+from reports import (
+    EXPORT_FORMATS,
+    Report,
+    ReportRequest,
+    generate_report,
+    get_cached_report,
+)
+from settings import (
+    BOT_MODE,
+    BOT_THREADS,
+    BOT_TOKEN,
+    FACE_MATCH_THRESHOLD,
+    FACE_MODEL,
+    FACE_PROCESSES,
+    FACE_QUEUE_SIZE,
+    FACE_VERIFICATION,
+    LOG_LEVEL,
+    METRICS_HOST,
+    METRICS_LOG_INTERVAL,
+    METRICS_PORT,
+    PAIRING_SWEEP_INTERVAL,
+    REPORT_WORKERS,
+    SELFIE_ARCHIVE_DIR,
+    SELFIE_ARCHIVE_MAX_SIZE,
+    SELFIE_ARCHIVE_QUEUE_SIZE,
+    SELFIE_ARCHIVE_WORKERS,
+    SELFIE_KEEP_ALL_SIZES,
+    SELFIE_LOCATION_DELAY,
+    SELFIE_THUMBNAIL_SIZE,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WRITE_BATCH_DELAY,
+    WRITE_BATCH_SIZE,
+)
+from webhook import WebhookServer
+from writer import GroupCommitWriter
+
+
+# Attendance can't be queried until selfies in the old format are migrated
+if LEGACY_SELFIES:
+    sys.exit("Attendance has selfies in the old format; run python manage.py migrate_selfies")
+
+
+# Give every update its own database session; closed once the handler is done
+class DBSessionMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message"]
+
+    def pre_process(self, message, data):
+        pass
+
+    def post_process(self, message, data, exception):
+        db_session.remove()
+
+
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=BOT_THREADS, use_class_middlewares=True)
+bot.setup_middleware(DBSessionMiddleware())
+
+# Reports are generated in background; same report requested again is generated only once
+report_queue = JobQueue(workers=REPORT_WORKERS, name="report")
+
+# Check-ins are committed as they come, or together with WRITE_BATCH_SIZE; queued ones are
+# committed on exit
+attendance_writer = GroupCommitWriter(WRITE_BATCH_SIZE, WRITE_BATCH_DELAY / 1000)
+atexit.register(attendance_writer.stop)
+
+# Selfies & locations waiting for their other half; see start_pairing
+pairing = PairingEngine(attendance_writer, SELFIE_LOCATION_DELAY)
+
+
+# Content of a photo sent to the bot
+def download_photo(file_id: str):
+    return bot.download_file(bot.get_file(file_id).file_path)
+
+
+# Selfies are archived in background when configured; Telegram's copies can expire
+selfie_archive = None
+if SELFIE_ARCHIVE_DIR:
+    selfie_archive = SelfieArchive(
+        SELFIE_ARCHIVE_DIR,
+        download_photo,
+        SELFIE_ARCHIVE_MAX_SIZE,
+        workers=SELFIE_ARCHIVE_WORKERS,
+        queue_size=SELFIE_ARCHIVE_QUEUE_SIZE,
+        thumbnail_size=SELFIE_THUMBNAIL_SIZE,
+    )
 
 
-# Create a new attendance record
-def new_attendance(
-    user_id: int,
-    selfie: list = None,
-    selfie_time: datetime = None,
-    location: dict = None,
-    location_time: datetime = None,
-):
-    if selfie_time or location_time:
-        if selfie_time:
-            attendance = Attendance(
-                user_id=user_id, selfie=selfie, selfie_time=selfie_time
-            )
-        else:
-            attendance = Attendance(
-                user_id=user_id, location=location, location_time=location_time
-            )
-
-        db_session.add(attendance)
-        db_session.commit()
-    else:
-        AssertionError("Either selfie or location required")
+# Content of a selfie; from the archive when it's there already
+def selfie_content(file_id: str, file_unique_id: str):
+    path = selfie_archive.photo(file_unique_id) if selfie_archive else None
+    if path:
+        with open(path, "rb") as file:
+            return file.read()
+    return download_photo(file_id)
+
+
+# Faces of selfies are verified in background when enabled; see start_faces
+face_verifier = None
+if FACE_VERIFICATION:
+    face_verifier = FaceVerifier(
+        FACE_MODEL,
+        selfie_content,
+        attendance_writer.write,
+        threshold=FACE_MATCH_THRESHOLD,
+        processes=FACE_PROCESSES,
+        queue_size=FACE_QUEUE_SIZE,
+    )
 
 
 # When user starts a flow; welcome them
@@ -65,7 +174,8 @@ def help_msg(message):
         "/login \\- to login a user with employee ID and OTP followed by command\n"
         "/logout \\- to logout a user\n"
         "/create \\- HR can create a new user with their employee ID, name, role, OTP followed by command\n"
-        "/download \\- user can download their monthly attendance by providing the month & year followed by command\n"
+        "/download \\- user can download their monthly attendance by providing the month & year followed by command; "
+        "add pdf, csv or xlsx in last line to choose the format\n"
         "/rstpwd \\- HR can reset user password by providing employee ID & OTP followed by command\n"
         "/deactive \\- HR can deactivate an user by providing employee ID followed by command\n"
         "/reactive \\- HR can reactive an user by providing employee ID followed by command",
@@ -85,10 +195,11 @@ def login_user(message):
             bot.reply_to(message, "Sorry, login failed; Try again")
         else:
             logged_in_user = User.get_by_emp_id(emp_id)
-            logged_in_user.last_chat_id = str(chat_id)
+            logged_in_user.last_chat_id = chat_id
             logged_in_user.is_pwd_expired = True
             db_session.add(logged_in_user)
             db_session.commit()
+            User.invalidate_cache(logged_in_user)
             bot.reply_to(
                 message, f"Hello *{known_user.fullname}*", parse_mode="MarkdownV2"
             )
@@ -110,6 +221,8 @@ def logout_user(message):
         known_user.last_chat_id = None
         db_session.add(known_user)
         db_session.commit()
+        # After commit; a concurrent update could cache the user again until then
+        User.invalidate_cache(known_user, chat_id)
         bot.reply_to(
             message,
             "You have been logged out; to login again ask your HR for a new password",
@@ -175,6 +288,7 @@ def reset_password(message):
                     user.is_pwd_expired = False
                     db_session.add(user)
                     db_session.commit()
+                    User.invalidate_cache(user)
                     bot.reply_to(
                         message, "New OTP has been updated", parse_mode="MarkdownV2"
                     )
@@ -209,9 +323,12 @@ def deactivate_user(message):
                 _, emp_id = list(map(lambda x: x.strip(), message.text.split("\n")))
                 user = User.get_by_emp_id(emp_id)
                 if user:
+                    User.invalidate_cache(user)
                     user.is_active = False
                     db_session.add(user)
                     db_session.commit()
+                    # Again; a concurrent update could have cached the user before commit
+                    User.invalidate_cache(user)
                     bot.reply_to(
                         message, "User has been deactivated", parse_mode="MarkdownV2"
                     )
@@ -249,6 +366,7 @@ def reactivate_user(message):
                     user.is_active = True
                     db_session.add(user)
                     db_session.commit()
+                    User.invalidate_cache(user)
                     bot.reply_to(
                         message, "User has been reactivated", parse_mode="MarkdownV2"
                     )
@@ -271,6 +389,38 @@ def reactivate_user(message):
         bot.reply_to(message, "You are not yet logged in")
 
 
+# Reply to a selfie or location with what happened to the attendance
+def reply_punch(message, kind: str, result: PunchResult):
+    delay_minutes = SELFIE_LOCATION_DELAY / 60
+    if result.outcome == PAIRED:
+        bot.reply_to(message, "Your attendance has been added 👍")
+    elif result.outcome == WAITING:
+        bot.reply_to(
+            message,
+            f"{kind.capitalize()} has been already received; "
+            f"Please send your {result.missing} in <b>{result.seconds_left / 60:.1f}</b> minutes for attendance",
+            parse_mode="HTML",
+        )
+    elif result.outcome == EXPIRED:
+        bot.reply_to(
+            message,
+            f"😩 Oops.. You are unable to send {result.missing} with in <b>{delay_minutes:.1f}</b>"
+            " minutes",
+            parse_mode="HTML",
+        )
+        bot.send_message(
+            message.chat.id,
+            f"We have added your {kind}, Please share your {other_half(kind)} with in "
+            f"<b>{delay_minutes:.1f}</b> minutes for attendance",
+            parse_mode="HTML",
+        )
+    else:
+        bot.reply_to(
+            message,
+            f"{kind.capitalize()} has been has been added, Please share your {result.missing} for attendance",
+        )
+
+
 # When user send a picture (selfie)
 @bot.message_handler(content_types=["photo"])
 def handle_attendance_selfie(message):
@@ -278,9 +428,6 @@ def handle_attendance_selfie(message):
     known_user = User.get_by_chat_id(chat_id)
     if known_user:
         curr_time = UTC_from_epoch(message.date)
-        last_attendance = Attendance.get_last_attendance_record(
-            known_user.id, curr_time
-        )
         pictures = []
         for pic in message.photo:
             pictures.append(
@@ -293,93 +440,22 @@ def handle_attendance_selfie(message):
                 }
             )
 
-        # Add face recognition on message.photo[2]; which is a good quality image
-
-        if last_attendance:
-            # if a attendance is already present for today
-            if last_attendance.selfie_time and last_attendance.location_time:
-                # if the last record already have a selfie & location; create a new record
-                new_attendance(
-                    user_id=known_user.id, selfie=pictures, selfie_time=curr_time
-                )
-                bot.reply_to(
-                    message,
-                    "Selfie has been has been added, Please share your location for attendance",
-                )
-
-            elif last_attendance.selfie_time:
-                # if already selfie is present
-                if (
-                    curr_time - last_attendance.selfie_time
-                ).seconds > SELFIE_LOCATION_DELAY:
-                    # but the slack time is already passed
-                    new_attendance(
-                        user_id=known_user.id, selfie=pictures, selfie_time=curr_time
-                    )
-                    bot.reply_to(
-                        message,
-                        f"😩 Oops.. You are unable to send location with in <b>{SELFIE_LOCATION_DELAY / 60:.1f}</b>"
-                        " minutes",
-                        parse_mode="HTML",
-                    )
-                    bot.send_message(
-                        chat_id,
-                        f"We have added your selfie, Please share your location with in "
-                        f"<b>{SELFIE_LOCATION_DELAY / 60:.1f}</b> minutes for attendance",
-                        parse_mode="HTML",
-                    )
-                else:
-                    # if still have some time left
-                    time_left = (
-                        SELFIE_LOCATION_DELAY
-                        - (curr_time - last_attendance.selfie_time).seconds
-                    )
-                    bot.reply_to(
-                        message,
-                        "Selfie has been already received; "
-                        f"Please send your location in <b>{time_left/60:.1f}</b> minutes for attendance",
-                        parse_mode="HTML",
-                    )
-
-            elif last_attendance.location_time:
-                # if location is already exists
-                if (
-                    curr_time - last_attendance.location_time
-                ).seconds > SELFIE_LOCATION_DELAY:
-                    # but slack time passed
-                    new_attendance(
-                        user_id=known_user.id, selfie=pictures, selfie_time=curr_time
-                    )
-                    bot.reply_to(
-                        message,
-                        f"😩 Oops.. You are unable to send selfie with in <b>{SELFIE_LOCATION_DELAY / 60:.1f}</b>"
-                        " minutes",
-                        parse_mode="HTML",
-                    )
-                    bot.send_message(
-                        chat_id,
-                        "We have added your selfie, Please share your location with in "
-                        f"<b>{SELFIE_LOCATION_DELAY / 60:.1f}</b> minutes for attendance",
-                        parse_mode="HTML",
-                    )
-                else:
-                    # selfie sent with in the slack time
-                    last_attendance.selfie = pictures
-                    last_attendance.selfie_time = curr_time
-                    db_session.add(last_attendance)
-                    db_session.commit()
-                    bot.reply_to(message, "Your attendance has been added 👍")
-
-        else:
-            # if there are no record create a new record
-            new_attendance(
-                user_id=known_user.id, selfie=pictures, selfie_time=curr_time
-            )
-            bot.reply_to(
-                message,
-                "Selfie has been has been added, Please share your location for attendance",
+        selfie = largest_photo(pictures)
+        result = pairing.punch(
+            known_user.id,
+            SELFIE,
+            curr_time,
+            selfie_file_id=selfie["file_id"],
+            selfie_file_unique_id=selfie["file_unique_id"],
+            photos=pictures if SELFIE_KEEP_ALL_SIZES else None,
+        )
+        reply_punch(message, SELFIE, result)
+        if selfie_archive and result.outcome != WAITING:
+            selfie_archive.submit(selfie["file_id"], selfie["file_unique_id"])
+        if face_verifier and result.outcome != WAITING:
+            face_verifier.submit(
+                result.attendance_id, known_user.id, selfie["file_id"], selfie["file_unique_id"]
             )
-
     else:
         bot.reply_to(message, "You are not yet logged in")
 
@@ -391,102 +467,75 @@ def handle_attendance_location(message):
     known_user = User.get_by_chat_id(chat_id)
     if known_user:
         curr_time = UTC_from_epoch(message.date)
-        last_attendance = Attendance.get_last_attendance_record(
-            known_user.id, curr_time
-        )
         location = {
             "longitude": message.location.longitude,
             "latitude": message.location.latitude,
         }
-        if last_attendance:
-            # if a attendance is already present for today
-            if last_attendance.selfie_time and last_attendance.location_time:
-                # but both selfie and location has been added; create a new record
-                new_attendance(
-                    user_id=known_user.id, location=location, location_time=curr_time
-                )
-                bot.reply_to(
-                    message,
-                    "Location has been has been added, Please share your selfie for attendance",
-                )
-            elif last_attendance.selfie_time:
-                # and selfie is already present
-                if (
-                    curr_time - last_attendance.selfie_time
-                ).seconds > SELFIE_LOCATION_DELAY:
-                    # location is sent after slack time is over
-                    new_attendance(
-                        user_id=known_user.id,
-                        location=location,
-                        location_time=curr_time,
-                    )
-                    bot.reply_to(
-                        message,
-                        f"😩 Oops.. You are unable to send location with in <b>{SELFIE_LOCATION_DELAY / 60:.1f}</b>"
-                        " minutes",
-                        parse_mode="HTML",
-                    )
-                    bot.send_message(
-                        chat_id,
-                        "We have added your location, Please share your selfie with in "
-                        f"<b>{SELFIE_LOCATION_DELAY / 60:.1f}</b> minutes for attendance",
-                        parse_mode="HTML",
-                    )
-                else:
-                    # location sent with in the slack time
-                    last_attendance.location = location
-                    last_attendance.location_time = curr_time
-                    db_session.add(last_attendance)
-                    db_session.commit()
-                    bot.reply_to(message, "Your attendance has been added 👍")
-            elif last_attendance.location_time:
-                # and location is already present
-                if (
-                    curr_time - last_attendance.location_time
-                ).seconds > SELFIE_LOCATION_DELAY:
-                    # if location is sent after slack time
-                    new_attendance(
-                        user_id=known_user.id,
-                        location=location,
-                        location_time=curr_time,
-                    )
-                    bot.reply_to(
-                        message,
-                        f"😩 Oops.. You are unable to send selfie with in <b>{SELFIE_LOCATION_DELAY / 60:.1f}</b>"
-                        " minutes",
-                        parse_mode="HTML",
-                    )
-                    bot.send_message(
-                        chat_id,
-                        "We have added your location, Please share your selfie with in "
-                        f"<b>{SELFIE_LOCATION_DELAY / 60:.1f}</b> minutes for attendance",
-                        parse_mode="HTML",
-                    )
-                else:
-                    # if still have some time left
-                    time_left = (
-                        SELFIE_LOCATION_DELAY
-                        - (curr_time - last_attendance.selfie_time).seconds
-                    )
-                    bot.reply_to(
-                        message,
-                        "Location has been already received; "
-                        f"Please send your selfie in <b>{time_left / 60:.1f}</b> minutes for attendance",
-                        parse_mode="HTML",
-                    )
-        else:
-            # if there are no record create a new record
-            new_attendance(
-                user_id=known_user.id, location=location, location_time=curr_time
-            )
-            bot.reply_to(
-                message,
-                "Location has been has been added, Please share your selfie for attendance",
-            )
+        result = pairing.punch(known_user.id, LOCATION, curr_time, location=location)
+        reply_punch(message, LOCATION, result)
     else:
         bot.reply_to(message, "You are not yet logged in")
 
 
+# Get UTC start & end time of report from DD MM YYYY, MM YYYY or YYYY in organisation's time
+def get_report_range(curr_time: datetime, dmy: str = None):
+    """
+    Start & end time of a report; current day when no date is provided
+    :param curr_time: UTC timestamp of the request
+    :param dmy: date string
+    :return: UTC start (inclusive) & end time (exclusive) or None when date string is invalid
+    """
+    if dmy is None:
+        return local_day_bounds(curr_time)
+
+    try:
+        start_date = datetime.strptime(dmy, "%d %m %Y")
+        end_date = start_date
+    except ValueError:
+        try:
+            start_date = datetime.strptime(dmy, "%m %Y")
+            next_month = start_date.replace(day=28) + timedelta(days=4)
+            end_date = next_month - timedelta(days=next_month.day)
+        except ValueError:
+            try:
+                start_date = datetime.strptime(dmy, "%Y")
+                end_date = start_date.replace(month=12, day=31)
+            except ValueError:
+                return None
+    return local_days_bounds(start_date.date(), end_date.date())
+
+
+# Report of all users or an employee for HR; month & year reports are read from the day
+# wise summary instead of every punch
+def hr_report_request(
+    start_date: datetime, end_date: datetime, user_id: int, export_format: str
+):
+    days = to_local(end_date).date() - to_local(start_date).date()
+    view = "Summary" if days > timedelta(days=1) else "HR"
+    return ReportRequest(start_date, end_date, user_id, view, export_format)
+
+
+# Send the generated report to the user who requested it
+def send_report(message, report: Report, error: Exception):
+    if error:
+        bot.reply_to(message, "Sorry, report could not be generated; Try again")
+    elif report.file_id:
+        # Already uploaded once; let Telegram reuse it
+        bot.send_document(
+            message.chat.id, document=report.file_id, reply_to_message_id=message.id
+        )
+    elif report.document:
+        sent = bot.send_document(
+            message.chat.id,
+            document=report.document,
+            reply_to_message_id=message.id,
+            visible_file_name=report.file_name,
+        )
+        report.file_id = sent.document.file_id
+    else:
+        bot.reply_to(message, report.text)
+
+
 # Download attendance report
 @bot.message_handler(commands=["download"])
 @bot.message_handler(func=lambda msg: msg.text in ["download"])
@@ -496,343 +545,59 @@ def download_report(message):
     if known_user:
         curr_time = UTC_from_epoch(message.date)
         data = list(map(lambda x: x.strip(), message.text.split("\n")))
+        export_format = "pdf"
+        if len(data) > 1 and data[-1].lower() in EXPORT_FORMATS:
+            export_format = data.pop().lower()
         if known_user.role == "HR":
-            if len(data) == 1:
-                start_date = datetime(
-                    year=curr_time.year, month=curr_time.month, day=curr_time.day
-                )
-                end_date = datetime(
-                    year=curr_time.year,
-                    month=curr_time.month,
-                    day=curr_time.day,
-                    hour=23,
-                    minute=59,
-                    second=59,
-                )
-                start_date = to_UTC(start_date)
-                end_date = to_UTC(end_date)
-                attendance_records = Attendance.get_attendance_records(
-                    start_date, end_date
-                )
-            elif len(data) == 2 or len(data) == 3:
-                emp_id = None
-                try:
-                    _, dmy = data
-                except ValueError:
-                    _, dmy, emp_id = data
-
-                try:
-                    start_date = datetime.strptime(dmy, "%d %m %Y")
-                    end_date = datetime(
-                        year=start_date.year,
-                        month=start_date.month,
-                        day=start_date.day,
-                        hour=23,
-                        minute=59,
-                        second=59,
-                    )
-                except ValueError:
-                    try:
-                        start_date = datetime.strptime(dmy, "%m %Y")
-                        next_month = start_date.replace(day=28) + timedelta(days=4)
-                        last_day = next_month - timedelta(days=next_month.day)
-                        end_date = datetime(
-                            year=start_date.year,
-                            month=start_date.month,
-                            day=last_day.day,
-                            hour=23,
-                            minute=59,
-                            second=59,
-                        )
-                    except ValueError:
-                        try:
-                            start_date = datetime.strptime(dmy, "%Y")
-                            end_date = datetime(
-                                year=start_date.year,
-                                month=12,
-                                day=31,
-                                hour=23,
-                                minute=59,
-                                second=59,
-                            )
-                        except ValueError:
-                            bot.reply_to(
-                                message,
-                                "Please use command /download to download report; "
-                                "example\n/download\nDate[Optional] Month[Optional] Year[Optional] "
-                                "[DD MM YYYY/ MM YYYY/ YYYY]\nemployee ID[Optional]",
-                                parse_mode="MarkdownV2",
-                            )
-                            return
-
-                start_date = to_UTC(start_date)
-                end_date = to_UTC(end_date)
-                if emp_id:
-                    user = User.get_by_emp_id(emp_id)
-                    emp_id = user.id
-                attendance_records = Attendance.get_attendance_records(
-                    start_date, end_date, emp_id
-                )
-
-            else:
-                bot.reply_to(
-                    message,
-                    "Please use command /download to download report; "
-                    "example\n/download\nDate[Optional] Month[Optional] Year[Optional] [DD MM YYYY/ MM YYYY/ YYYY]"
-                    "\nemployee ID[Optional]",
-                    parse_mode="MarkdownV2",
-                )
-                return
-
-            if len(attendance_records) < 1:
-                bot.reply_to(message, "No attendance record to download")
-                return
-
-            start_date = to_IST(start_date)
-            end_date = to_IST(end_date)
-
-            html_text = f"""
-            <html>
-            <body>
-            <center>
-            <table width='100%' border='2px solid'>
-            <tr>
-            <td colspan='6' style='text-align:center;font-weight:bold;'>Attendance Report</td>
-            </tr>
-            <tr>
-            <td colspan='3'>Start Date: {start_date.strftime('%d-%B-%Y')}</td>
-            <td colspan='3'>End Date: {end_date.strftime('%d-%B-%Y')}</td>
-            </tr>
-            <tr>
-            <th width='5%'>Sl. No.</td>
-            <th width='20%'>Employee ID</td>
-            <th width='20%'>Selfie Time</td>
-            <th width='20%'>Location Time</td>
-            <th width='20%'>Location</td>
-            <th width='*'>Time Diff</td>
-            </tr>
-            """
-
-            file_name = f"Attendance-{message.date}"
-            ctr = 0
-            last_record = None
-            for record in attendance_records:
-                if ctr % 2 == 0:
-                    last_record = record
-                    user = User.get_by_user_id(last_record.user_id, only_active=False)
-                    html_text += f"""
-                    <tr>
-                        <td>{ctr+1}</td>
-                        <td>{user.employee_id}</td>
-                        <td>{to_IST(last_record.selfie_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>{to_IST(last_record.location_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>Long: {last_record.location["longitude"]}, Lat: {last_record.location["latitude"]}</td>
-                        <td></td>
-                    </tr>
-                    """
-                else:
-                    user = User.get_by_user_id(record.user_id, only_active=False)
-                    time_diff = time_difference(
-                        to_IST(record.selfie_time),
-                        to_IST(last_record.selfie_time),
-                        formatted=True,
-                    )
-                    time_diff = (
-                        None  # Remove when records are aggregated by employee ID
-                    )
-
-                    html_text += f"""
-                    <tr>
-                        <td>{ctr + 1}</td>
-                        <td>{user.employee_id}</td>
-                        <td>{to_IST(record.selfie_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>{to_IST(record.location_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>Long: {record.location["longitude"]}, Lat: {record.location["latitude"]}</td>
-                        <td>{time_diff}</td>
-                    </tr>
-                    """
-                ctr += 1
-            html_text += "</table></center></body></html>"
-
-            file = open(f"{file_name}.html", "wb")
-            file.write(html_text.encode())
-            file.close()
-            pdfkit.from_file(f"{file_name}.html", f"{file_name}.pdf")
-            file = open(f"{file_name}.pdf", "rb")
-            bot.send_document(
-                known_user.last_chat_id, document=file, reply_to_message_id=message.id
+            usage = (
+                "Please use command /download to download report; "
+                "example\n/download\nDate[Optional] Month[Optional] Year[Optional] "
+                "[DD MM YYYY/ MM YYYY/ YYYY]\nemployee ID[Optional]\nformat[Optional] [pdf/csv/xlsx]"
             )
-            file.close()
-            os.remove(f"{file_name}.html")
-            os.remove(f"{file_name}.pdf")
+            max_lines = 3
         else:
-            if len(data) == 1:
-                start_date = datetime(
-                    year=curr_time.year, month=curr_time.month, day=curr_time.day
-                )
-                end_date = datetime(
-                    year=curr_time.year,
-                    month=curr_time.month,
-                    day=curr_time.day,
-                    hour=23,
-                    minute=59,
-                    second=59,
-                )
-                start_date = to_UTC(start_date)
-                end_date = to_UTC(end_date)
-            elif len(data) == 2:
-                _, dmy = data
-
-                try:
-                    start_date = datetime.strptime(dmy, "%d %m %Y")
-                    end_date = datetime(
-                        year=start_date.year,
-                        month=start_date.month,
-                        day=start_date.day,
-                        hour=23,
-                        minute=59,
-                        second=59,
-                    )
-                except ValueError:
-                    try:
-                        start_date = datetime.strptime(dmy, "%m %Y")
-                        next_month = start_date.replace(day=28) + timedelta(days=4)
-                        last_day = next_month - timedelta(days=next_month.day)
-                        end_date = datetime(
-                            year=start_date.year,
-                            month=start_date.month,
-                            day=last_day.day,
-                            hour=23,
-                            minute=59,
-                            second=59,
-                        )
-                    except ValueError:
-                        try:
-                            start_date = datetime.strptime(dmy, "%Y")
-                            end_date = datetime(
-                                year=start_date.year,
-                                month=12,
-                                day=31,
-                                hour=23,
-                                minute=59,
-                                second=59,
-                            )
-                        except ValueError:
-                            bot.reply_to(
-                                message,
-                                "Please use command /download to download report; "
-                                "example\n/download\nDate[Optional] Month[Optional] Year[Optional] "
-                                "[DD MM YYYY/ MM YYYY/ YYYY]\nemployee ID[Optional]",
-                                parse_mode="MarkdownV2",
-                            )
-                            return
-
-                start_date = to_UTC(start_date)
-                end_date = to_UTC(end_date)
-            else:
-                bot.reply_to(
-                    message,
-                    "Please use command /download to download report; "
-                    "example\n/download\nDate[Optional] Month[Optional] Year[Optional] [DD MM YYYY/ MM YYYY/ YYYY]",
-                    parse_mode="MarkdownV2",
-                )
-                return
+            usage = (
+                "Please use command /download to download report; "
+                "example\n/download\nDate[Optional] Month[Optional] Year[Optional] [DD MM YYYY/ MM YYYY/ YYYY]"
+                "\nformat[Optional] [pdf/csv/xlsx]"
+            )
+            max_lines = 2
+
+        if len(data) > max_lines:
+            bot.reply_to(message, usage, parse_mode="MarkdownV2")
+            return
+        report_range = get_report_range(curr_time, data[1] if len(data) > 1 else None)
+        if not report_range:
+            bot.reply_to(message, usage, parse_mode="MarkdownV2")
+            return
+        start_date, end_date = report_range
 
-            attendance_records = Attendance.get_attendance_records(
-                start_date, end_date, known_user.id
+        if known_user.role == "HR":
+            user_id = None
+            if len(data) == 3:
+                user = User.get_by_emp_id(data[2])
+                if not user:
+                    bot.reply_to(message, "Employee doesn't exist or deactivated")
+                    return
+                user_id = user.id
+            request = hr_report_request(start_date, end_date, user_id, export_format)
+        else:
+            request = ReportRequest(
+                start_date, end_date, known_user.id, "Employee", export_format
             )
 
-            start_date = to_IST(start_date)
-            end_date = to_IST(end_date)
-
-            if len(attendance_records) == 0:
-                bot.reply_to(message, "No attendance record found")
-            elif attendance_records <= 2:
-                msg = "Attendance report\n"
-                msg += f"Start Date: {start_date.strftime('%d-%B-%Y')}\n"
-                msg += f"End Date: {end_date.strftime('%d-%B-%Y')}\n\n"
-                msg += f"IN: {to_IST(attendance_records[0].selfie_time).strftime('%d-%m-%Y %H:%M')}\n"
-                if len(attendance_records) == 2:
-                    time_diff = time_difference(
-                        to_IST(attendance_records[1].selfie_time),
-                        to_IST(attendance_records[0].selfie_time),
-                        formatted=True,
-                    )
-                    msg += f"OUT: {to_IST(attendance_records[1].selfie_time).strftime('%d-%m-%Y %H:%M')}\n"
-                    msg += f"Duration: {time_diff}"
-                bot.reply_to(message, msg, parse_mode="MarkdownV2")
-            else:
-                html_text = f"""
-                <html>
-                <body>
-                <center>
-                <table width='100%' border='2px solid'>
-                <tr>
-                <td colspan='5' style='text-align:center;font-weight:bold;'>Attendance Report</td>
-                </tr>
-                <tr style='text-align:center;font-weight:bold;'>
-                <td colspan='3'>Employee Name: {known_user.fullname}</td>
-                <td colspan='2'>Employee ID: {known_user.employee_id}</td>
-                </tr>
-                <tr>
-                <td colspan='3'>Start Date: {start_date.strftime('%d-%B-%Y')}</td>
-                <td colspan='2'>End Date: {end_date.strftime('%d-%B-%Y')}</td>
-                </tr>
-                <tr>
-                <th width='5%'>Sl. No.</td>
-                <th width='25%'>Selfie Time</td>
-                <th width='25%'>Location Time</td>
-                <th width='25%'>Location</td>
-                <th width='*'>Time Diff</td>
-                </tr>
-                """
-
-                file_name = f"Attendance-{message.date}"
-                ctr = 0
-                last_record = None
-                for record in attendance_records:
-                    if ctr % 2 == 0:
-                        last_record = record
-                        html_text += f"""
-                        <tr>
-                        <td>{ctr + 1}</td>
-                        <td>{to_IST(last_record.selfie_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>{to_IST(last_record.location_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>Long: {last_record.location["longitude"]}, Lat: {last_record.location["latitude"]}</td>
-                        <td></td>
-                        </tr>
-                        """
-                    else:
-                        time_diff = time_difference(
-                            to_IST(record.selfie_time),
-                            to_IST(last_record.selfie_time),
-                            formatted=True,
-                        )
-                        html_text += f"""
-                        <tr>
-                        <td>{ctr + 1}</td>
-                        <td>{to_IST(record.selfie_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>{to_IST(record.location_time).strftime("%d-%m-%Y %H:%M")}</td>
-                        <td>Long: {record.location["longitude"]}, Lat: {record.location["latitude"]}</td>
-                        <td>{time_diff}</td>
-                        </tr>
-                        """
-                    ctr += 1
-                html_text += "</table></center></body></html>"
-
-                file = open(f"{file_name}.html", "wb")
-                file.write(html_text.encode())
-                file.close()
-                pdfkit.from_file(f"{file_name}.html", f"{file_name}.pdf")
-                file = open(f"{file_name}.pdf", "rb")
-                bot.send_document(
-                    known_user.last_chat_id,
-                    document=file,
-                    reply_to_message_id=message.id,
-                )
-                file.close()
-                os.remove(f"{file_name}.html")
-                os.remove(f"{file_name}.pdf")
+        # Served right away when attendance of the range hasn't changed since last time
+        report = get_cached_report(request)
+        if report:
+            send_report(message, report, None)
+            return
+
+        report_queue.submit(
+            request,
+            lambda: generate_report(request),
+            lambda report, error: send_report(message, report, error),
+        )
+        bot.reply_to(message, "Report is being prepared; it will be sent shortly")
     else:
         bot.reply_to(message, "You are not yet logged in")
 
@@ -846,7 +611,98 @@ def echo_all(message):
     )
 
 
-bot.infinity_polling()
+# Time every handler, SQL statement & Telegram API call; handlers must be registered above
+metrics.instrument_handlers(bot)
+metrics.instrument_engine(engine)
+metrics.instrument_telegram()
+metrics.add_gauges(
+    "report_jobs", "Report jobs by state", report_queue.stats, labelname="state"
+)
+metrics.add_gauges(
+    "attendance_pending_punches",
+    "Selfies & locations waiting for their other half",
+    pairing.__len__,
+)
+if selfie_archive:
+    metrics.add_gauges(
+        "selfie_archive",
+        "Archived selfies, their size in bytes & selfies waiting to be downloaded",
+        selfie_archive.stats,
+        labelname="stat",
+    )
+
+if face_verifier:
+    metrics.add_gauges(
+        "face_jobs", "Face verification jobs by state", face_verifier.stats, labelname="state"
+    )
+
+
+# Start the face verification workers; the model is loaded before updates are handled
+def start_faces():
+    if face_verifier:
+        face_verifier.start()
+        atexit.register(face_verifier.shutdown)
+
+
+# Load punches pending since before a restart and forget expired ones periodically
+def start_pairing():
+    # Updates queued while the bot was down may arrive late; keep expired punches a while
+    pairing.warm(grace=PAIRING_SWEEP_INTERVAL)
+    pairing.start_sweeper(PAIRING_SWEEP_INTERVAL, grace=PAIRING_SWEEP_INTERVAL)
+
+
+# Log to stderr; nothing is logged below WARNING until this is called, metrics dumps included
+def configure_logging():
+    logging.basicConfig(
+        level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+
+# Expose the metrics as configured in settings
+def start_metrics():
+    if METRICS_PORT:
+        metrics.start_server(METRICS_HOST, METRICS_PORT)
+    if METRICS_LOG_INTERVAL:
+        metrics.start_log_dump(METRICS_LOG_INTERVAL)
+
+
+# Receive updates pushed by Telegram instead of polling for them
+def run_webhook():
+    if not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise ValueError("WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode")
+    # Updates are handled by webhook workers; don't queue them again in bot's own pool
+    bot.threaded = False
+    server = WebhookServer(
+        bot.process_new_updates,
+        WEBHOOK_SECRET,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        workers=BOT_THREADS,
+    )
+    metrics.add_gauges(
+        "webhook_queued_updates", "Updates waiting to be handled", server.updates.qsize
+    )
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=BOT_THREADS,
+        allowed_updates=["message"],
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    start_faces()
+    start_metrics()
+    start_pairing()
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        bot.infinity_polling()
 
 
 # @bot.message_handler(commands=['menu'])
@@ -0,0 +1,356 @@
+"""
+Maintenance commands of the attendance bot
+
+    python manage.py backfill_summary
+    python manage.py migrate_selfies
+    python manage.py enroll_face
+    python manage.py verify_faces
+"""
+import argparse
+from datetime import datetime
+
+from sqlalchemy import (
+    JSON,
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB
+from telebot import apihelper
+
+from db_backend import db_session, engine, is_sqlite
+from archive import SelfieArchive
+from faces import FaceVerifier
+from helpers import largest_photo, local_days_bounds
+from models import (
+    Attendance,
+    DailyAttendanceSummary,
+    FaceReference,
+    SelfiePhoto,
+    UTCDateTime,
+    User,
+)
+from settings import (
+    BOT_TOKEN,
+    FACE_MATCH_THRESHOLD,
+    FACE_MODEL,
+    FACE_PROCESSES,
+    REPORT_BATCH_SIZE,
+    SELFIE_ARCHIVE_DIR,
+    SELFIE_ARCHIVE_MAX_SIZE,
+    SELFIE_KEEP_ALL_SIZES,
+)
+
+
+# Recompute the daily attendance summary from existing attendance records
+def backfill_summary(args):
+    days = DailyAttendanceSummary.rebuild(batch_size=args.batch_size)
+    print(f"Daily attendance summary rebuilt; {days} user days")
+
+
+# Attendance table as it was when every size of a selfie was stored as JSON
+def legacy_attendance_table(metadata: MetaData):
+    return Table(
+        "attendance",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer),
+        Column("selfie", JSON().with_variant(JSONB, "postgresql"), unique=True),
+        Column("selfie_time", UTCDateTime),
+        Column("location", JSON),
+        Column("location_time", UTCDateTime),
+        Index("ix_attendance_user_selfie_time", "user_id", "selfie_time"),
+        Index("ix_attendance_user_location_time", "user_id", "location_time"),
+        Index("ix_attendance_selfie_time_user", "selfie_time", "user_id"),
+    )
+
+
+# Columns of the largest size of a selfie and rows of every size for selfie_photo
+def compact_selfie(attendance_id: int, sizes: list, keep_sizes: bool):
+    if not sizes:
+        return {"selfie_file_id": None, "selfie_file_unique_id": None}, []
+    selfie = largest_photo(sizes)
+    columns = {
+        "selfie_file_id": selfie.get("file_id"),
+        "selfie_file_unique_id": selfie.get("file_unique_id"),
+    }
+    if not keep_sizes:
+        return columns, []
+    photos = [
+        {
+            "attendance_id": attendance_id,
+            "file_id": size.get("file_id"),
+            "file_unique_id": size.get("file_unique_id"),
+            "width": size.get("width"),
+            "height": size.get("height"),
+            "file_size": size.get("file_size"),
+        }
+        for size in sizes
+    ]
+    return columns, photos
+
+
+def migrate_attendance(
+    connection, keep_sizes: bool = False, batch_size: int = REPORT_BATCH_SIZE
+):
+    """
+    Store the largest size of every selfie in its own columns instead of every size as
+    JSON. SQLite can't drop a unique column, so there the table is rebuilt: records are
+    copied to a new table which then replaces the old one. Other databases add the
+    columns, fill them and drop the JSON column.
+    :param connection: connection in a transaction
+    :param keep_sizes: also keep every size in selfie_photo
+    :param batch_size: records rewritten at a time
+    :return: number of records migrated
+    """
+    metadata = MetaData()
+    User.__table__.to_metadata(metadata)
+    legacy = legacy_attendance_table(metadata)
+    if is_sqlite:
+        target = Attendance.__table__.to_metadata(metadata, name="attendance_new")
+        target.indexes.clear()  # Created with their names once the old table is gone
+        target.drop(connection, checkfirst=True)  # Left over by an interrupted migration
+        target.create(connection)
+        query = select(legacy)
+    else:
+        connection.execute(text("ALTER TABLE attendance ADD COLUMN selfie_file_id VARCHAR(255)"))
+        connection.execute(
+            text("ALTER TABLE attendance ADD COLUMN selfie_file_unique_id VARCHAR(64)")
+        )
+        query = select(legacy.c.id, legacy.c.selfie).where(legacy.c.selfie.isnot(None))
+
+    count = 0
+    query = query.order_by(legacy.c.id)
+    result = connection.execution_options(yield_per=batch_size).execute(query)
+    for records in result.mappings().partitions():
+        rows, photos = [], []
+        for record in records:
+            columns, sizes = compact_selfie(record["id"], record["selfie"], keep_sizes)
+            if is_sqlite:
+                row = {name: value for name, value in record.items() if name != "selfie"}
+                rows.append({**row, **columns})
+            else:
+                rows.append({"attendance_id": record["id"], **columns})
+            photos.extend(sizes)
+        if is_sqlite:
+            connection.execute(target.insert(), rows)
+        else:
+            connection.execute(
+                text(
+                    "UPDATE attendance SET selfie_file_id = :selfie_file_id, "
+                    "selfie_file_unique_id = :selfie_file_unique_id WHERE id = :attendance_id"
+                ),
+                rows,
+            )
+        if photos:
+            connection.execute(SelfiePhoto.__table__.insert(), photos)
+        count += len(records)
+
+    if is_sqlite:
+        connection.execute(text("DROP TABLE attendance"))
+        connection.execute(text("ALTER TABLE attendance_new RENAME TO attendance"))
+        for index in Attendance.__table__.indexes:
+            index.create(connection)
+    else:
+        connection.execute(text("ALTER TABLE attendance DROP COLUMN selfie"))
+        connection.execute(text("ALTER TABLE attendance ADD UNIQUE (selfie_file_unique_id)"))
+    return count
+
+
+# Rewrite attendance stored with every size of a selfie as JSON into the compact format
+def migrate_selfies(args):
+    columns = {column["name"] for column in inspect(engine).get_columns("attendance")}
+    if "selfie" not in columns:
+        print("Selfies are already stored in the compact format")
+        return
+    with engine.begin() as connection:
+        records = migrate_attendance(connection, args.keep_sizes, args.batch_size)
+    if is_sqlite:
+        # Give the space of the old table back to the file system
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("VACUUM"))
+    print(f"Selfies of {records} attendance records migrated")
+
+
+# Content of a selfie; from the archive when it's there, from Telegram otherwise
+def selfie_downloader():
+    selfie_archive = None
+    if SELFIE_ARCHIVE_DIR:
+        selfie_archive = SelfieArchive(SELFIE_ARCHIVE_DIR, None, SELFIE_ARCHIVE_MAX_SIZE)
+
+    def download(file_id: str, file_unique_id: str):
+        path = selfie_archive.photo(file_unique_id) if selfie_archive else None
+        if path:
+            with open(path, "rb") as file:
+                return file.read()
+        file_path = apihelper.get_file(BOT_TOKEN, file_id)["file_path"]
+        return apihelper.download_file(BOT_TOKEN, file_path)
+
+    return download
+
+
+# Verifier with its worker processes started; writes are applied in the command's session
+def start_verifier(processes: int = FACE_PROCESSES):
+    return FaceVerifier(
+        FACE_MODEL,
+        selfie_downloader(),
+        lambda function, *params: function(*params),
+        threshold=FACE_MATCH_THRESHOLD,
+        processes=processes,
+    ).start()
+
+
+# Enroll the reference face of an employee from a selfie checked by HR, or remove it
+def enroll_face(args):
+    user = User.get_by_emp_id(args.employee_id, only_active=False)
+    if not user:
+        raise SystemExit(f"Employee {args.employee_id} doesn't exist")
+    if args.reset:
+        removed = FaceReference.reset(user.id)
+        db_session.commit()
+        state = "removed" if removed else "was not enrolled"
+        print(f"Reference face of {user.employee_id} {state}")
+        return
+    file_unique_id = None
+    if args.photo:
+        with open(args.photo, "rb") as file:
+            content = file.read()
+    else:
+        attendance = db_session.get(Attendance, args.attendance)
+        if not attendance or attendance.user_id != user.id or not attendance.selfie_file_id:
+            raise SystemExit(f"Attendance {args.attendance} has no selfie of this employee")
+        file_unique_id = attendance.selfie_file_unique_id
+        content = selfie_downloader()(attendance.selfie_file_id, file_unique_id)
+
+    verifier = start_verifier(processes=1)
+    try:
+        embedding = verifier.embed(content)
+    finally:
+        verifier.shutdown()
+    if embedding is None:
+        raise SystemExit("No face found in the photo; enroll another one")
+    FaceReference.enroll(user.id, embedding, file_unique_id)
+    db_session.commit()
+    print(
+        f"Reference face of {user.employee_id} enrolled; verify their selfies with "
+        f"python manage.py verify_faces --employee-id {user.employee_id} --reverify"
+    )
+
+
+# Verify the faces of selfies sent before verification was enabled, or all of them again
+def verify_faces(args):
+    since = None
+    if args.since:
+        since = local_days_bounds(datetime.strptime(args.since, "%Y-%m-%d").date())[0]
+    user_id = None
+    if args.employee_id:
+        user = User.get_by_emp_id(args.employee_id, only_active=False)
+        if not user:
+            raise SystemExit(f"Employee {args.employee_id} doesn't exist")
+        user_id = user.id
+    # Results are committed once per batch instead of through the bot's writer
+    verifier = start_verifier(args.processes)
+    counts = {}
+    last_id = 0
+    try:
+        while True:
+            selfies = Attendance.get_selfies_to_verify(
+                last_id, args.batch_size, args.reverify, since, user_id
+            )
+            if not selfies:
+                break
+            last_id = selfies[-1][0]
+            for attendance_id, result, distance, verified in verifier.verify_many(selfies):
+                Attendance.set_face_result(attendance_id, distance, verified)
+                counts[result] = counts.get(result, 0) + 1
+            db_session.commit()
+            print(f"Verified up to attendance {last_id}; {counts}")
+    finally:
+        verifier.shutdown()
+    print(f"Faces of {sum(counts.values())} selfies verified; {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser(
+        "backfill_summary", help="rebuild daily attendance summary from attendance"
+    )
+    backfill.add_argument(
+        "--batch-size",
+        type=int,
+        default=REPORT_BATCH_SIZE,
+        help="attendance records fetched at a time",
+    )
+    backfill.set_defaults(handler=backfill_summary)
+
+    migrate = commands.add_parser(
+        "migrate_selfies", help="store selfies of existing attendance in the compact format"
+    )
+    migrate.add_argument(
+        "--batch-size",
+        type=int,
+        default=REPORT_BATCH_SIZE,
+        help="attendance records rewritten at a time",
+    )
+    migrate.add_argument(
+        "--keep-sizes",
+        action="store_true",
+        default=SELFIE_KEEP_ALL_SIZES,
+        help="also keep every size of the selfies in selfie_photo",
+    )
+    migrate.set_defaults(handler=migrate_selfies)
+
+    enroll = commands.add_parser(
+        "enroll_face", help="enroll the reference face of an employee, or remove it"
+    )
+    enroll.add_argument("employee_id", help="employee ID of the employee")
+    source = enroll.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--attendance", type=int, help="ID of an attendance with a selfie of the employee"
+    )
+    source.add_argument("--photo", help="path of a photo of the employee")
+    source.add_argument(
+        "--reset", action="store_true", help="remove the reference; selfies stay unverified"
+    )
+    enroll.set_defaults(handler=enroll_face)
+
+    faces = commands.add_parser(
+        "verify_faces", help="verify the faces of selfies not verified yet"
+    )
+    faces.add_argument(
+        "--reverify",
+        action="store_true",
+        help="verify every selfie again; e.g. after changing the model or threshold",
+    )
+    faces.add_argument("--since", help="only selfies sent since this day; YYYY-MM-DD")
+    faces.add_argument("--employee-id", help="only selfies of this employee")
+    faces.add_argument(
+        "--batch-size",
+        type=int,
+        default=200,
+        help="selfies downloaded & verified at a time; committed together",
+    )
+    faces.add_argument(
+        "--processes",
+        type=int,
+        default=FACE_PROCESSES,
+        help="worker processes running the face model",
+    )
+    faces.set_defaults(handler=verify_faces)
+
+    args = parser.parse_args()
+    try:
+        args.handler(args)
+    finally:
+        db_session.remove()
+
+
+if __name__ == "__main__":
+    main()
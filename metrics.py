@@ -0,0 +1,423 @@
+"""
+Counters and latency histograms of the hot paths in Prometheus text format
+
+Handlers, SQL statements and Telegram API calls are timed once instrumented;
+metrics are served on /metrics and can be logged periodically.
+"""
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import inspect
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(labelnames: tuple, values: tuple, extra: str = ""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    Monotonically increasing count per combination of label values
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_labels_text(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets per combination of label values
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labelnames: tuple = (), buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values: [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(value) for key, value in self._values.items()}
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels_text(self.labelnames, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels_text(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {counts[-2]}"
+            yield f"{self.name}_count{_labels_text(self.labelnames, key)} {counts[-2]}"
+            yield f"{self.name}_sum{_labels_text(self.labelnames, key)} {counts[-1]:.6f}"
+
+
+class Gauge:
+    """
+    Current values read from a function when metrics are collected
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, function, labelname: str = None):
+        """
+        :param function: returns a number, or a dict of label value to number when
+            labelname is given
+        :param labelname: name of the label of the values
+        """
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labelname = labelname
+
+    def samples(self):
+        try:
+            values = self.function()
+        except Exception:
+            logger.exception("Failed to read gauge %s", self.name)
+            return
+        if self.labelname is None:
+            yield f"{self.name} {values}"
+        else:
+            for label, value in sorted(values.items()):
+                yield f"{self.name}{_labels_text((self.labelname,), (label,))} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """
+        All the metrics in Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+updates_total = registry.register(
+    Counter(
+        "bot_updates_total",
+        "Messages handled by handler and content type or command",
+        ("handler", "content_type"),
+    )
+)
+handler_errors_total = registry.register(
+    Counter("bot_handler_errors_total", "Handlers failed with an exception", ("handler",))
+)
+handler_seconds = registry.register(
+    Histogram("bot_handler_seconds", "Time spent in message handlers", ("handler",))
+)
+sql_queries_total = registry.register(
+    Counter("db_queries_total", "SQL statements executed by statement type", ("statement",))
+)
+sql_seconds = registry.register(
+    Histogram("db_query_seconds", "Time spent executing SQL statements", ("statement",))
+)
+telegram_errors_total = registry.register(
+    Counter("telegram_api_errors_total", "Failed Telegram Bot API calls", ("method",))
+)
+telegram_seconds = registry.register(
+    Histogram(
+        "telegram_api_seconds",
+        "Time spent calling the Telegram Bot API, including uploads",
+        ("method",),
+        buckets=LATENCY_BUCKETS + (30, 60),
+    )
+)
+
+report_seconds = registry.register(
+    Histogram(
+        "report_build_seconds",
+        "Time spent querying and rendering reports not served from cache",
+        ("view", "format"),
+        buckets=LATENCY_BUCKETS + (30, 60, 120),
+    )
+)
+
+write_batch_size = registry.register(
+    Histogram(
+        "db_write_batch_size",
+        "Attendance writes committed together in a group commit",
+        buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+    )
+)
+
+archive_photos_total = registry.register(
+    Counter(
+        "selfie_archive_photos_total",
+        "Selfies archived, skipped as duplicates, dropped, failed or evicted",
+        ("result",),
+    )
+)
+
+faces_total = registry.register(
+    Counter(
+        "face_verifications_total",
+        "Selfies verified by result; match, mismatch, no_face, not_enrolled, failed "
+        "or dropped",
+        ("result",),
+    )
+)
+face_seconds = registry.register(
+    Histogram(
+        "face_embedding_seconds",
+        "Time spent embedding a selfie in a worker process, including waiting for one",
+        buckets=LATENCY_BUCKETS + (30, 60),
+    )
+)
+
+
+# Command of a message or its content type; e.g. /download, photo, location
+def _message_kind(message, commands):
+    text = getattr(message, "text", None)
+    if text and text.startswith("/"):
+        command = text.split(None, 1)[0].split("@", 1)[0][1:]
+        # Unknown commands are counted as text to keep the number of label values bounded
+        if command in commands:
+            return f"/{command}"
+    return getattr(message, "content_type", "unknown")
+
+
+def timed_handler(handler, commands=()):
+    """
+    Wrap a message handler to count its messages and time it
+    :param handler: function or coroutine function handling a message
+    :param commands: commands handled by it; counted separately from other text
+    """
+    name = handler.__name__
+
+    if inspect.iscoroutinefunction(handler):
+
+        @wraps(handler)
+        async def async_wrapper(message, *args, **kwargs):
+            updates_total.inc(handler=name, content_type=_message_kind(message, commands))
+            start = time.perf_counter()
+            try:
+                return await handler(message, *args, **kwargs)
+            except Exception:
+                handler_errors_total.inc(handler=name)
+                raise
+            finally:
+                handler_seconds.observe(time.perf_counter() - start, handler=name)
+
+        return async_wrapper
+
+    @wraps(handler)
+    def wrapper(message, *args, **kwargs):
+        updates_total.inc(handler=name, content_type=_message_kind(message, commands))
+        start = time.perf_counter()
+        try:
+            return handler(message, *args, **kwargs)
+        except Exception:
+            handler_errors_total.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler=name)
+
+    return wrapper
+
+
+def instrument_handlers(bot):
+    """
+    Time every message handler registered on the bot so far
+    :param bot: TeleBot or AsyncTeleBot
+    """
+    for handler in bot.message_handlers:
+        if not getattr(handler["function"], "_timed", False):
+            commands = handler["filters"].get("commands") or ()
+            handler["function"] = timed_handler(handler["function"], commands)
+            handler["function"]._timed = True
+
+
+def instrument_engine(engine):
+    """
+    Count & time every SQL statement executed through the engine
+    :param engine: SQLAlchemy engine
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        sql_queries_total.inc(statement=kind)
+        sql_seconds.observe(elapsed, statement=kind)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+
+def instrument_telegram():
+    """
+    Time every call to the Telegram Bot API
+    """
+    make_request = apihelper._make_request
+    if getattr(make_request, "_timed", False):
+        return
+
+    @wraps(make_request)
+    def timed_make_request(token, method_name, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception:
+            telegram_errors_total.inc(method=method_name)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, method=method_name)
+
+    timed_make_request._timed = True
+    apihelper._make_request = timed_make_request
+
+
+def instrument_async_telegram():
+    """
+    Time every call to the Telegram Bot API made by AsyncTeleBot
+    """
+    from telebot import asyncio_helper  # Needs aiohttp; only used by the async runtime
+
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, "_timed", False):
+        return
+
+    @wraps(process_request)
+    async def timed_process_request(token, method_name, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await process_request(token, method_name, *args, **kwargs)
+        except Exception:
+            telegram_errors_total.inc(method=method_name)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, method=method_name)
+
+    timed_process_request._timed = True
+    asyncio_helper._process_request = timed_process_request
+
+
+def add_gauges(name: str, help: str, function, labelname: str = None):
+    """
+    Report values read when metrics are collected; e.g. queue depth
+    :param name: metric name
+    :param help: description
+    :param function: returns a number or a dict of label value to number
+    :param labelname: name of the label of the values when function returns a dict
+    """
+    registry.register(Gauge(name, help, function, labelname))
+
+
+def start_server(host: str = "127.0.0.1", port: int = 9100, path: str = "/metrics"):
+    """
+    Serve metrics over HTTP in background
+    :param host: interface to listen on; keep local unless protected otherwise
+    :param port: port to listen on
+    :param path: URL path of the metrics
+    :return: HTTP server; shutdown() to stop
+    """
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != path:
+                return self.send_error(404)
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    return httpd
+
+
+def start_log_dump(interval: float):
+    """
+    Log all the metrics periodically in background
+    :param interval: time in seconds between dumps
+    :return: event; set() to stop
+    """
+    stop = threading.Event()
+
+    def dump():
+        while not stop.wait(interval):
+            logger.info("Metrics\n%s", registry.render())
+
+    threading.Thread(target=dump, name="metrics-log", daemon=True).start()
+    return stop
@@ -1,35 +1,69 @@
-from datetime import datetime
+from datetime import date, datetime, timezone
+import logging
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
+    Date,
     ForeignKey,
+    Index,
     Integer,
     JSON,
     String,
     DateTime,
+    Float,
+    TypeDecorator,
+    and_,
     func,
+    inspect,
     or_,
+    text,
 )
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, make_transient_to_detached
 
+from aggregation import aggregate, pair_punch
 from db_backend import db_session, engine
-from helpers import get_hashed
-from settings import SUPER_HR
+from helpers import LRUCache, get_hashed, local_day_bounds, to_local
+from settings import SUPER_HR, USER_CACHE_SIZE, USER_CACHE_TTL
+
+logger = logging.getLogger(__name__)
 
 
 class Base(DeclarativeBase):
     pass
 
 
+class UTCDateTime(TypeDecorator):
+    """
+    Timestamp stored in UTC on every database; always read back as a naive UTC datetime
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            value = value.astimezone(timezone.utc)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+
 class User(Base):
     __tablename__ = "user_account"
+    _chat_id_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
     id = Column(Integer, primary_key=True)
     employee_id = Column(String(30), unique=True)
     fullname = Column(String(30))
     role = Column(String(10))
-    temp_pwd = Column(String(10))
-    last_chat_id = Column(String(10))
+    temp_pwd = Column(String(128))  # SHA512 hex digest
+    last_chat_id = Column(BigInteger, index=True)
     is_active = Column(Boolean, default=True)
     is_pwd_expired = Column(Boolean, default=False)
 
@@ -58,16 +92,47 @@ class User(Base):
         return query.first()
 
     @classmethod
-    def get_by_chat_id(cls, chat_id: str, only_active: bool = True):
+    def get_by_chat_id(cls, chat_id: int, only_active: bool = True):
         """
-        Get user record by their chat ID
+        Get user record by their chat ID; active users are served from cache
         :param chat_id: chat ID of user
         :param only_active: whether to fetch only active user or not
         """
+        if only_active:
+            cached_user = cls._chat_id_cache.get(chat_id)
+            if cached_user is not None:
+                # Attach a copy of cached user to the session without querying
+                return db_session.merge(cached_user, load=False)
+
         query = db_session.query(cls).filter(cls.last_chat_id == chat_id)
         if only_active:
             query = query.filter(cls.is_active.isnot(False))
-        return query.first()
+        user = query.first()
+
+        if user and only_active:
+            cls._chat_id_cache.set(chat_id, user.detached_copy())
+        return user
+
+    @classmethod
+    def invalidate_cache(cls, user: "User", chat_id: int = None):
+        """
+        Remove a user from chat ID cache; required whenever chat ID, status or credential changes
+        :param user: user to be removed
+        :param chat_id: chat ID the user was cached by; when it's no longer their last_chat_id
+        """
+        for cached_chat_id in {chat_id, user.last_chat_id} - {None}:
+            cls._chat_id_cache.pop(int(cached_chat_id))
+        cls._chat_id_cache.discard_where(lambda cached_user: cached_user.id == user.id)
+
+    def detached_copy(self):
+        """
+        Copy of loaded user, not bound to any session; safe to be kept in cache
+        """
+        user = User(
+            **{column.key: getattr(self, column.key) for column in User.__table__.columns}
+        )
+        make_transient_to_detached(user)
+        return user
 
     @classmethod
     def is_valid_credential(cls, employee_id: str, temp_pwd: str):
@@ -90,67 +155,434 @@ class Attendance(Base):
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("user_account.id"))
-    selfie = Column(JSON, unique=True)
-    selfie_time = Column(DateTime(timezone=True))
+    # Largest size of the selfie; a photo can't be used for two attendances
+    selfie_file_id = Column(String(255))
+    selfie_file_unique_id = Column(String(64), unique=True)
+    selfie_time = Column(UTCDateTime)
     location = Column(JSON)
-    location_time = Column(DateTime(timezone=True))
+    location_time = Column(UTCDateTime)
+    # Distance of the selfie's face from the user's reference; None when not verified
+    face_distance = Column(Float)
+    # False when the face doesn't match or there is none; None until the user is enrolled
+    face_verified = Column(Boolean)
+
+    __table_args__ = (
+        # Per user lookups; last record of a day for selfie/location
+        Index("ix_attendance_user_selfie_time", "user_id", "selfie_time"),
+        Index("ix_attendance_user_location_time", "user_id", "location_time"),
+        # Date range reports of all users
+        Index("ix_attendance_selfie_time_user", "selfie_time", "user_id"),
+    )
 
     @classmethod
     def get_last_attendance_record(cls, user_id: int, timestamp: datetime):
         """
-        Get the last attendance record of a date
+        Get the last attendance record of a day in organisation's local time; the bot
+        pairs punches through pairing.PairingEngine, this is kept for the benchmarks
         :param user_id: user ID of user
         :param timestamp: UTC timestamp
         """
-        # For other databases -- not tested yet
-        # return db_session.query(cls).filter(
-        #     cls.user_id == user_id,
-        #     or_(
-        #         cls.selfie_time.date() == timestamp.date(),
-        #         cls.selfie_time.date() == timestamp.date()
-        #     )
-        # ).desc().first()
-
-        # For sqlite
+        day_start, day_end = local_day_bounds(timestamp)
         return (
             db_session.query(cls)
             .filter(
                 cls.user_id == user_id,
                 or_(
-                    func.DATE(cls.selfie_time) == str(timestamp.date()),
-                    func.DATE(cls.selfie_time) == str(timestamp.date()),
+                    and_(cls.selfie_time >= day_start, cls.selfie_time < day_end),
+                    and_(cls.location_time >= day_start, cls.location_time < day_end),
                 ),
             )
             .order_by(cls.id.desc())
             .first()
         )
 
+    @classmethod
+    def get_records_since(cls, timestamp: datetime):
+        """
+        Get records of all users with a selfie or location since a time, oldest first
+        :param timestamp: UTC timestamp
+        """
+        return (
+            db_session.query(cls)
+            .filter(or_(cls.selfie_time >= timestamp, cls.location_time >= timestamp))
+            .order_by(cls.id)
+            .all()
+        )
+
+    @classmethod
+    def open(cls, user_id: int, photos: list = None, **fields):
+        """
+        Add a record with either a selfie or a location
+        :param user_id: user ID of user
+        :param photos: sizes of the selfie to keep in selfie_photo; see SelfiePhoto.add_all
+        :param fields: selfie_file_id, selfie_file_unique_id & selfie_time or location &
+            location_time
+        :return: ID of the record
+        """
+        attendance = cls(user_id=user_id, **fields)
+        db_session.add(attendance)
+        db_session.flush()
+        SelfiePhoto.add_all(attendance.id, photos)
+        return attendance.id
+
+    @classmethod
+    def complete(cls, attendance_id: int, photos: list = None, **fields):
+        """
+        Add the missing selfie or location to a record and count it in the daily summary
+        :param attendance_id: ID of the attendance record
+        :param photos: sizes of the selfie to keep in selfie_photo; see SelfiePhoto.add_all
+        :param fields: selfie_file_id, selfie_file_unique_id & selfie_time or location &
+            location_time
+        """
+        attendance = db_session.get(cls, attendance_id)
+        for name, value in fields.items():
+            setattr(attendance, name, value)
+        SelfiePhoto.add_all(attendance_id, photos)
+        DailyAttendanceSummary.record_punch(attendance.user_id, attendance.selfie_time)
+        return attendance
+
+    @classmethod
+    def set_face_result(cls, attendance_id: int, distance: float, verified: bool):
+        """
+        Store the result of verifying the face of a selfie
+        :param attendance_id: ID of the attendance record
+        :param distance: distance from the reference face; None when there's no face
+        :param verified: whether the face matches the user's reference
+        """
+        db_session.query(cls).filter(cls.id == attendance_id).update(
+            {cls.face_distance: distance, cls.face_verified: verified},
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def get_selfies_to_verify(
+        cls,
+        after_id: int = 0,
+        limit: int = 1000,
+        reverify: bool = False,
+        since: datetime = None,
+        user_id: int = None,
+    ):
+        """
+        Get the ID, user ID, file_id & file_unique_id of the next selfies to verify in
+        order of ID; paged by ID so results can be committed between pages
+        :param after_id: ID of the last record of the previous page
+        :param limit: number of selfies
+        :param reverify: include the selfies already verified
+        :param since: UTC timestamp; only selfies sent since then
+        :param user_id: user ID of user; all users if not provided
+        """
+        query = db_session.query(
+            cls.id, cls.user_id, cls.selfie_file_id, cls.selfie_file_unique_id
+        ).filter(cls.id > after_id, cls.selfie_file_id.isnot(None))
+        if not reverify:
+            query = query.filter(cls.face_verified.is_(None))
+        if since:
+            query = query.filter(cls.selfie_time >= since)
+        if user_id:
+            query = query.filter(cls.user_id == user_id)
+        return query.order_by(cls.id).limit(limit).all()
+
     @classmethod
     def get_attendance_records(
-        cls, start_time: datetime, end_time: datetime, user_id: str = None
+        cls,
+        start_time: datetime,
+        end_time: datetime,
+        user_id: str = None,
+        with_user: bool = False,
+        batch_size: int = None,
     ):
         """
-        :param start_time:
-        :param end_time:
-        :param user_id:
+        Get the completed attendance records with in a time range [start_time, end_time)
+        ordered by user & selfie time
+        :param start_time: UTC timestamp; inclusive
+        :param end_time: UTC timestamp; exclusive
+        :param user_id: user ID of user; all users if not provided
+        :param with_user: whether to load user of each record in the same query;
+            records are returned as (attendance, user) pairs
+        :param batch_size: stream records from database in batches of this size
+            instead of loading them all at once; returns an iterator
         """
-        attendance_records = db_session.query(cls).filter(
-            func.DATETIME(cls.selfie_time) >= str(start_time),
-            func.DATETIME(cls.selfie_time) < str(end_time),
-            func.DATETIME(cls.location_time) >= str(start_time),
-            func.DATETIME(cls.location_time) < str(end_time),
+        if with_user:
+            attendance_records = db_session.query(cls, User).join(
+                User, User.id == cls.user_id
+            )
+        else:
+            attendance_records = db_session.query(cls)
+        attendance_records = attendance_records.filter(
+            cls.selfie_time >= start_time,
+            cls.selfie_time < end_time,
+            cls.location_time >= start_time,
+            cls.location_time < end_time,
         )
         if user_id:
             attendance_records = attendance_records.filter(cls.user_id == user_id)
-        return attendance_records.order_by(cls.user_id, cls.id).all()
+        attendance_records = attendance_records.order_by(
+            cls.user_id, cls.selfie_time
+        )
+        if batch_size:
+            return attendance_records.yield_per(batch_size)
+        return attendance_records.all()
+
+    @classmethod
+    def get_data_version(
+        cls, start_time: datetime, end_time: datetime, user_id: str = None
+    ):
+        """
+        Version of the completed attendance records with in a time range; changes whenever a
+        record is added or completed in the range
+        :param start_time: UTC timestamp; inclusive
+        :param end_time: UTC timestamp; exclusive
+        :param user_id: user ID of user; all users if not provided
+        :return: number of records & highest record ID
+        """
+        query = db_session.query(func.count(cls.id), func.max(cls.id)).filter(
+            cls.selfie_time >= start_time,
+            cls.selfie_time < end_time,
+            cls.location_time >= start_time,
+            cls.location_time < end_time,
+        )
+        if user_id:
+            query = query.filter(cls.user_id == user_id)
+        return tuple(query.one())
+
+
+class SelfiePhoto(Base):
+    """
+    Every size Telegram sent of a selfie; only kept when SELFIE_KEEP_ALL_SIZES is set
+    """
+
+    __tablename__ = "selfie_photo"
+
+    attendance_id = Column(Integer, ForeignKey("attendance.id"), primary_key=True)
+    file_unique_id = Column(String(64), primary_key=True)
+    file_id = Column(String(255))
+    width = Column(Integer)
+    height = Column(Integer)
+    file_size = Column(Integer)
+
+    @classmethod
+    def add_all(cls, attendance_id: int, photos: list = None):
+        """
+        Add the sizes of a selfie
+        :param attendance_id: ID of the attendance record
+        :param photos: dicts of file_id, file_unique_id, width, height & file_size
+        """
+        for photo in photos or ():
+            db_session.add(cls(attendance_id=attendance_id, **photo))
+
+
+class FaceReference(Base):
+    """
+    Enrolled face of a user; selfies are verified against it
+    """
+
+    __tablename__ = "face_reference"
+
+    user_id = Column(Integer, ForeignKey("user_account.id"), primary_key=True)
+    embedding = Column(JSON)  # List of floats from FACE_MODEL
+    file_unique_id = Column(String(64))  # Photo the face was enrolled from
+    enrolled_at = Column(UTCDateTime)
+
+    @classmethod
+    def get_embedding(cls, user_id: int):
+        """
+        Get the reference embedding of a user; None when not enrolled
+        :param user_id: user ID of user
+        """
+        return db_session.query(cls.embedding).filter(cls.user_id == user_id).scalar()
+
+    @classmethod
+    def enroll(cls, user_id: int, embedding: list, file_unique_id: str = None):
+        """
+        Set the reference face of a user, replacing the one enrolled before
+        :param user_id: user ID of user
+        :param embedding: embedding of the face
+        :param file_unique_id: Telegram file_unique_id of the photo, if any
+        """
+        db_session.merge(
+            cls(
+                user_id=user_id,
+                embedding=embedding,
+                file_unique_id=file_unique_id,
+                enrolled_at=datetime.utcnow(),
+            )
+        )
+
+    @classmethod
+    def reset(cls, user_id: int):
+        """
+        Remove the reference face of a user; their selfies are left unverified
+        :param user_id: user ID of user
+        :return: whether the user was enrolled
+        """
+        return db_session.query(cls).filter(cls.user_id == user_id).delete() > 0
+
+
+class DailyAttendanceSummary(Base):
+    __tablename__ = "daily_attendance_summary"
+
+    user_id = Column(Integer, ForeignKey("user_account.id"), primary_key=True)
+    day = Column(Date, primary_key=True)  # Local date of the organisation
+    first_in = Column(UTCDateTime)
+    last_out = Column(UTCDateTime)
+    open_since = Column(UTCDateTime)  # IN punch not yet paired with an OUT punch
+    sessions = Column(Integer, default=0)  # Number of completed punches
+    worked_seconds = Column(Integer, default=0)
+
+    __table_args__ = (
+        # Date range reports of all users
+        Index("ix_daily_attendance_summary_day_user", "day", "user_id"),
+    )
+
+    def add_punch(self, punch_time: datetime):
+        """
+        Count a completed punch; punches alternate IN & OUT in order of time
+        :param punch_time: UTC timestamp of punch
+        """
+        self.open_since, duration = pair_punch(
+            self.sessions or 0, self.open_since, punch_time
+        )
+        self.sessions = (self.sessions or 0) + 1
+        if duration is None:
+            if self.first_in is None:
+                self.first_in = punch_time
+        else:
+            self.last_out = punch_time
+            self.worked_seconds = (self.worked_seconds or 0) + int(
+                duration.total_seconds()
+            )
+
+    @classmethod
+    def record_punch(cls, user_id: int, punch_time: datetime):
+        """
+        Update summary of the day with a completed attendance record; committed along with it
+        :param user_id: user ID of user
+        :param punch_time: UTC timestamp of punch
+        """
+        day = to_local(punch_time).date()
+        summary = db_session.get(cls, (user_id, day))
+        if summary is None:
+            summary = cls(user_id=user_id, day=day)
+            db_session.add(summary)
+        summary.add_punch(punch_time)
+
+    @classmethod
+    def get_summaries(
+        cls,
+        start_day: date,
+        end_day: date,
+        user_id: int = None,
+        batch_size: int = None,
+    ):
+        """
+        Get day wise summaries with their user with in a range of dates
+        :param start_day: local date; inclusive
+        :param end_day: local date; inclusive
+        :param user_id: user ID of user; all users if not provided
+        :param batch_size: stream summaries from database in batches of this size
+        :return: (summary, user) pairs
+        """
+        query = (
+            db_session.query(cls, User)
+            .join(User, User.id == cls.user_id)
+            .filter(cls.day >= start_day, cls.day <= end_day)
+        )
+        if user_id:
+            query = query.filter(cls.user_id == user_id)
+        query = query.order_by(cls.user_id, cls.day)
+        if batch_size:
+            return query.yield_per(batch_size)
+        return query.all()
+
+    @classmethod
+    def rebuild(cls, batch_size: int = 1000):
+        """
+        Recompute all the summaries from attendance records
+        :param batch_size: number of attendance records fetched at a time
+        """
+        attendance_records = (
+            db_session.query(Attendance.user_id, Attendance.selfie_time)
+            .filter(
+                Attendance.selfie_time.isnot(None),
+                Attendance.location_time.isnot(None),
+            )
+            .order_by(Attendance.user_id, Attendance.selfie_time)
+            .yield_per(batch_size)
+        )
+        rows = [
+            {
+                "user_id": day_attendance.user_id,
+                "day": day_attendance.day,
+                "first_in": day_attendance.first_in,
+                "last_out": day_attendance.last_out,
+                "open_since": day_attendance.open_since,
+                "sessions": len(day_attendance.punches),
+                "worked_seconds": int(day_attendance.worked.total_seconds()),
+            }
+            for day_attendance in aggregate(attendance_records)
+        ]
+        db_session.query(cls).delete()
+        for i in range(0, len(rows), batch_size):
+            db_session.execute(cls.__table__.insert(), rows[i : i + batch_size])
+        db_session.commit()
+        return len(rows)
+
+    @classmethod
+    def is_missing(cls):
+        """
+        Whether there's completed attendance but no summary; e.g. just after an upgrade
+        """
+        completed = db_session.query(Attendance.id).filter(
+            Attendance.selfie_time.isnot(None), Attendance.location_time.isnot(None)
+        )
+        return (
+            db_session.query(cls.user_id).first() is None
+            and completed.first() is not None
+        )
 
 
 # Create/Update models
 Base.metadata.create_all(engine)
 
+# Selfies used to be stored with every size as JSON; those databases must be migrated first
+LEGACY_SELFIES = "selfie" in {
+    column["name"] for column in inspect(engine).get_columns("attendance")
+}
+if LEGACY_SELFIES:
+    logger.warning(
+        "Attendance has selfies in the old format; run python manage.py migrate_selfies"
+    )
+else:
+    # Columns are only created along with a new table; add the missing nullable ones
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable or column.unique:
+                continue
+            column_type = column.type.compile(engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+
+# Indexes are only created along with a new table; add the missing ones to an existing database
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+# Summary is kept up to date as attendance is completed; attendance from before has to be
+# filled in once, which reads all of it, so it's left to manage.py instead of every import
+if not LEGACY_SELFIES and DailyAttendanceSummary.is_missing():
+    logger.warning(
+        "Daily attendance summary is empty; month & year reports miss existing attendance "
+        "until python manage.py backfill_summary is run"
+    )
+
 # Create Super HR if not exists
 if not User.get_by_emp_id(SUPER_HR["employee_id"]):
     SUPER_HR["temp_pwd"] = get_hashed(SUPER_HR["temp_pwd"])
     super_hr = User(**SUPER_HR)
     db_session.add(super_hr)
     db_session.commit()
+db_session.remove()
@@ -0,0 +1,164 @@
+"""
+Pairing of selfies & locations into attendance records
+
+Every user has at most one pending half punch: an attendance record with either a
+selfie or a location, waiting for the other within SELFIE_LOCATION_DELAY. Pending
+punches are kept in memory, so a punch is resolved without reading the database;
+the bot must be the only process writing attendance.
+"""
+from datetime import datetime, timedelta
+import logging
+import threading
+from typing import NamedTuple
+
+from db_backend import db_session
+from models import Attendance
+
+logger = logging.getLogger(__name__)
+
+SELFIE = "selfie"
+LOCATION = "location"
+
+# Outcomes of a punch
+OPENED = "opened"  # New record waiting for the other half
+PAIRED = "paired"  # Pending record completed
+WAITING = "waiting"  # Same half already received; punch ignored
+EXPIRED = "expired"  # Pending record timed out; new record waiting for the other half
+
+
+class PendingPunch(NamedTuple):
+    attendance_id: int
+    kind: str  # SELFIE or LOCATION received
+    time: datetime  # UTC time of the received half
+    expires_at: datetime  # UTC time after which the other half opens a new record
+
+
+class PunchResult(NamedTuple):
+    outcome: str
+    missing: str  # Half still to be sent; of the timed out record when EXPIRED
+    seconds_left: float  # Time left to send the missing half
+    attendance_id: int = None  # Record the punch was stored in; None when WAITING
+
+
+# Other half of a punch
+def other_half(kind: str):
+    return LOCATION if kind == SELFIE else SELFIE
+
+
+class PairingEngine:
+    """
+    State machine pairing selfies & locations of every user; records are written
+    through a GroupCommitWriter
+    """
+
+    def __init__(self, writer, delay: int):
+        """
+        :param writer: GroupCommitWriter committing attendance records
+        :param delay: time in seconds allowed between selfie & location
+        """
+        self.writer = writer
+        self.delay = timedelta(seconds=delay)
+        self._pending = {}  # user ID: PendingPunch
+        self._user_locks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Punches of a user are resolved one at a time; others go on concurrently
+    def _user_lock(self, user_id: int):
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def punch(self, user_id: int, kind: str, punch_time: datetime, **fields) -> PunchResult:
+        """
+        Add a selfie or location of a user
+        :param user_id: user ID of user
+        :param kind: SELFIE or LOCATION
+        :param punch_time: UTC time of the punch
+        :param fields: the selfie or the location; see Attendance.open
+        """
+        fields[f"{kind}_time"] = punch_time
+        with self._user_lock(user_id):
+            pending = self._pending.get(user_id)
+            if pending and punch_time <= pending.expires_at:
+                seconds_left = (pending.expires_at - punch_time).total_seconds()
+                if pending.kind == kind:
+                    return PunchResult(WAITING, other_half(kind), seconds_left)
+                self.writer.write(Attendance.complete, pending.attendance_id, **fields)
+                with self._lock:
+                    self._pending.pop(user_id, None)
+                return PunchResult(PAIRED, None, seconds_left, pending.attendance_id)
+
+            attendance_id = self.writer.write(Attendance.open, user_id, **fields)
+            with self._lock:
+                self._pending[user_id] = PendingPunch(
+                    attendance_id, kind, punch_time, punch_time + self.delay
+                )
+            if pending:
+                return PunchResult(EXPIRED, other_half(pending.kind), 0, attendance_id)
+            return PunchResult(
+                OPENED, other_half(kind), self.delay.total_seconds(), attendance_id
+            )
+
+    def warm(self, now: datetime = None, grace: float = 0):
+        """
+        Load the pending punches from the database; call once at startup
+        :param now: current UTC time
+        :param grace: seconds expired punches are kept, as in sweep
+        """
+        now = now or datetime.utcnow()
+        since = now - self.delay - timedelta(seconds=grace)
+        pending = {}
+        for attendance in Attendance.get_records_since(since):
+            if attendance.selfie_time and attendance.location_time:
+                pending.pop(attendance.user_id, None)
+            else:
+                kind = SELFIE if attendance.selfie_time else LOCATION
+                time = attendance.selfie_time or attendance.location_time
+                pending[attendance.user_id] = PendingPunch(
+                    attendance.id, kind, time, time + self.delay
+                )
+        db_session.remove()
+        with self._lock:
+            self._pending.update(pending)
+        logger.info("Pending punches loaded: %d", len(pending))
+
+    def sweep(self, now: datetime = None, grace: float = 0):
+        """
+        Forget the punches that expired more than grace seconds ago
+        :param now: current UTC time
+        :param grace: seconds an expired punch is kept to tell a late other half
+            from a new punch; updates may be handled a while after they were sent
+        """
+        before = (now or datetime.utcnow()) - timedelta(seconds=grace)
+        with self._lock:
+            expired = [
+                user_id
+                for user_id, pending in self._pending.items()
+                if pending.expires_at < before
+            ]
+            for user_id in expired:
+                del self._pending[user_id]
+        return len(expired)
+
+    def start_sweeper(self, interval: float, grace: float = 0):
+        """
+        Sweep expired punches periodically in background
+        :param interval: time in seconds between sweeps
+        :param grace: seconds expired punches are kept
+        :return: event; set() to stop
+        """
+        stop = threading.Event()
+
+        def sweep():
+            while not stop.wait(interval):
+                swept = self.sweep(grace=grace)
+                if swept:
+                    logger.debug("Expired punches swept: %d", swept)
+
+        threading.Thread(target=sweep, name="pairing-sweeper", daemon=True).start()
+        return stop
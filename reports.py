@@ -0,0 +1,411 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import NamedTuple
+import io
+import threading
+import time
+import pdfkit
+
+from aggregation import DayAttendance, aggregate, day_remarks
+import analytics
+from db_backend import db_session
+from exporters import ReportTable, export_csv, export_html, export_pdf, export_xlsx
+from helpers import format_local_all, to_local
+import metrics
+from models import Attendance, DailyAttendanceSummary, User
+from settings import (
+    REPORT_BATCH_SIZE,
+    REPORT_CACHE_SIZE,
+    REPORT_ENGINE,
+    REPORT_PDF_ENGINE,
+)
+
+EXPORT_FORMATS = {
+    "pdf": export_pdf,
+    "csv": export_csv,
+    "xlsx": export_xlsx,
+}
+
+
+class ReportRequest(NamedTuple):
+    """
+    What a report contains; equal requests produce the same report
+    """
+
+    start_date: datetime  # UTC; inclusive
+    end_date: datetime  # UTC; exclusive
+    user_id: int = None  # Only attendance of this user; all users if not provided
+    view: str = "HR"  # HR report of all users, day wise HR Summary or Employee's own report
+    export_format: str = "pdf"  # One of EXPORT_FORMATS
+
+
+class Report:
+    """
+    Generated report; either a short text message or a document
+    """
+
+    def __init__(self, text: str = None, document: bytes = None, file_name: str = None):
+        self.text = text
+        self.document = document
+        self.file_name = file_name
+        self.file_id = None  # Telegram file ID once the document has been sent
+
+    @property
+    def size(self):
+        return len(self.document or b"") + len(self.text or "")
+
+
+class ReportCache:
+    """
+    Generated reports kept in memory until the attendance of their range changes;
+    least recently used reports are evicted beyond the maximum size
+    """
+
+    def __init__(self, max_size: int):
+        """
+        :param max_size: maximum size in bytes of cached reports
+        """
+        self.max_size = max_size
+        self._reports = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, request: ReportRequest, version: tuple):
+        """
+        Get a cached report
+        :param request: range, user and view of the report
+        :param version: current data version of the range
+        """
+        with self._lock:
+            entry = self._reports.get(request)
+            if entry is None or entry[0] != version:
+                return None
+            self._reports.move_to_end(request)
+            return entry[1]
+
+    def set(self, request: ReportRequest, version: tuple, report: Report):
+        """
+        Cache a report and evict the least recently used reports beyond max size
+        :param request: range, user and view of the report
+        :param version: data version of the range the report is generated from
+        :param report: generated report
+        """
+        if report.size > self.max_size:
+            return
+        with self._lock:
+            entry = self._reports.pop(request, None)
+            if entry:
+                self._size -= entry[1].size
+            self._reports[request] = (version, report)
+            self._size += report.size
+            while self._size > self.max_size:
+                _, (_, evicted) = self._reports.popitem(last=False)
+                self._size -= evicted.size
+
+
+report_cache = ReportCache(REPORT_CACHE_SIZE)
+
+
+def get_data_version(request: ReportRequest):
+    return Attendance.get_data_version(
+        request.start_date, request.end_date, request.user_id
+    )
+
+
+def get_cached_report(request: ReportRequest):
+    """
+    Report generated earlier from the same attendance data, if any
+    :param request: range, user and view of the report
+    """
+    return report_cache.get(request, get_data_version(request))
+
+
+# Duration as HH:MM
+def format_duration(duration: timedelta):
+    minutes = int(duration.total_seconds()) // 60
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+# Rows of a day; local selfie & location time, session duration on each OUT punch and
+# remarks on the last punch of the day
+def day_rows(day_attendance: DayAttendance):
+    records = [record for record, _ in day_attendance.punches]
+    selfie_times = format_local_all(record.selfie_time for record in records)
+    location_times = format_local_all(record.location_time for record in records)
+    last = len(records) - 1
+    for i, (record, duration) in enumerate(day_attendance.punches):
+        remarks = ""
+        if i == last:
+            remarks = ", ".join(
+                [f"Worked {format_duration(day_attendance.worked)}"]
+                + day_attendance.remarks
+            )
+        yield (
+            record,
+            selfie_times[i],
+            location_times[i],
+            "" if duration is None else format_duration(duration),
+            remarks,
+        )
+
+
+# Attendance of all users from (attendance, user) pairs
+def render_hr_report(attendance_records, start_date: datetime, end_date: datetime):
+    def rows():
+        ctr = 0
+        for day_attendance in aggregate(attendance_records, with_user=True):
+            for record, selfie_time, location_time, time_diff, remarks in day_rows(
+                day_attendance
+            ):
+                yield [
+                    ctr + 1,
+                    day_attendance.user.employee_id,
+                    selfie_time,
+                    location_time,
+                    f'Long: {record.location["longitude"]}, Lat: {record.location["latitude"]}',
+                    time_diff,
+                    remarks,
+                ]
+                ctr += 1
+
+    return ReportTable(
+        "Attendance Report",
+        [
+            [
+                f"Start Date: {start_date.strftime('%d-%B-%Y')}",
+                f"End Date: {end_date.strftime('%d-%B-%Y')}",
+            ]
+        ],
+        [
+            ("Sl. No.", 5),
+            ("Employee ID", 12),
+            ("Selfie Time", 14),
+            ("Location Time", 14),
+            ("Location", 25),
+            ("Time Diff", 8),
+            ("Remarks", None),
+        ],
+        rows(),
+    )
+
+
+# Day wise attendance of all users from (summary, user) pairs
+def render_summary_report(summaries, start_date: datetime, end_date: datetime):
+    def rows():
+        ctr = 0
+        for summary, user in summaries:
+            yield [
+                ctr + 1,
+                user.employee_id,
+                summary.day.strftime("%d-%m-%Y"),
+                to_local(summary.first_in).strftime("%H:%M") if summary.first_in else "",
+                to_local(summary.last_out).strftime("%H:%M") if summary.last_out else "",
+                summary.sessions,
+                format_duration(timedelta(seconds=summary.worked_seconds or 0)),
+                ", ".join(day_remarks(summary.first_in, summary.sessions)),
+            ]
+            ctr += 1
+
+    return ReportTable(
+        "Attendance Summary",
+        [
+            [
+                f"Start Date: {start_date.strftime('%d-%B-%Y')}",
+                f"End Date: {end_date.strftime('%d-%B-%Y')}",
+            ]
+        ],
+        [
+            ("Sl. No.", 5),
+            ("Employee ID", 15),
+            ("Date", 12),
+            ("First IN", 10),
+            ("Last OUT", 10),
+            ("Punches", 8),
+            ("Worked", 10),
+            ("Remarks", None),
+        ],
+        rows(),
+    )
+
+
+# Attendance of an employee
+def render_employee_report(
+    user: User, attendance_records, start_date: datetime, end_date: datetime
+):
+    def rows():
+        ctr = 0
+        for day_attendance in aggregate(attendance_records):
+            for record, selfie_time, location_time, time_diff, remarks in day_rows(
+                day_attendance
+            ):
+                yield [
+                    ctr + 1,
+                    selfie_time,
+                    location_time,
+                    f'Long: {record.location["longitude"]}, Lat: {record.location["latitude"]}',
+                    time_diff,
+                    remarks,
+                ]
+                ctr += 1
+
+    return ReportTable(
+        "Attendance Report",
+        [
+            [f"Employee Name: {user.fullname}", f"Employee ID: {user.employee_id}"],
+            [
+                f"Start Date: {start_date.strftime('%d-%B-%Y')}",
+                f"End Date: {end_date.strftime('%d-%B-%Y')}",
+            ],
+        ],
+        [
+            ("Sl. No.", 5),
+            ("Selfie Time", 16),
+            ("Location Time", 16),
+            ("Location", 25),
+            ("Time Diff", 8),
+            ("Remarks", None),
+        ],
+        rows(),
+    )
+
+
+# Short text report of up to 2 punches, paired per day like the full reports
+def render_text_report(attendance_records: list, start_date: datetime, end_date: datetime):
+    msg = "Attendance report\n"
+    msg += f"Start Date: {start_date.strftime('%d-%B-%Y')}\n"
+    msg += f"End Date: {end_date.strftime('%d-%B-%Y')}\n"
+    # Punches are paired within their own day; a month may hold an IN of one day & another's
+    for day_attendance in aggregate(attendance_records):
+        msg += "\n"
+        for record, duration in day_attendance.punches:
+            punch_time = to_local(record.selfie_time).strftime("%d-%m-%Y %H:%M")
+            if duration is None:
+                msg += f"IN: {punch_time}\n"
+            else:
+                msg += f"OUT: {punch_time}\nDuration: {format_duration(duration)}\n"
+    return msg.rstrip("\n")
+
+
+# Convert HTML to PDF in memory; wkhtmltopdf reads HTML from stdin and writes PDF to stdout
+def html_to_pdf(html_chunks):
+    html = io.StringIO()
+    for chunk in html_chunks:
+        html.write(chunk)
+    html.seek(0)
+    return pdfkit.from_file(html, False)
+
+
+# Write the report in one of EXPORT_FORMATS
+def export_report(table: ReportTable, export_format: str):
+    if export_format == "pdf" and REPORT_PDF_ENGINE == "wkhtmltopdf":
+        return html_to_pdf(export_html(table))
+    output = io.BytesIO()
+    EXPORT_FORMATS[export_format](table, output)
+    return output.getvalue()
+
+
+# Whether to render reports vectorised; only when pandas is installed
+def use_analytics():
+    return REPORT_ENGINE == "pandas" and analytics.available()
+
+
+def generate_report(request: ReportRequest):
+    """
+    Get the report from cache or build it; runs in a report worker
+    :param request: range, user and view of the report
+    """
+    try:
+        version = get_data_version(request)
+        report = report_cache.get(request, version)
+        if report:
+            return report
+        start = time.perf_counter()
+        report = build_report(request, version[0])
+        metrics.report_seconds.observe(
+            time.perf_counter() - start,
+            view=request.view,
+            format=request.export_format,
+        )
+        report_cache.set(request, version, report)
+        return report
+    finally:
+        db_session.remove()
+
+
+def build_report(request: ReportRequest, record_count: int):
+    """
+    Query attendance and build the report
+    :param request: range, user and view of the report
+    :param record_count: number of attendance records in the report
+    """
+    start_date = to_local(request.start_date)
+    end_date = to_local(request.end_date - timedelta(seconds=1))  # Last day of the range
+
+    # Short reports are replied as text unless a specific format is asked
+    text_only = request.export_format == "pdf"
+
+    if request.view == "HR":
+        if record_count < 1:
+            return Report(text="No attendance record to download")
+        if use_analytics():
+            frame = analytics.load_attendance(
+                request.start_date, request.end_date, request.user_id
+            )
+            table = analytics.render_hr_report(frame, start_date, end_date)
+        else:
+            attendance_records = Attendance.get_attendance_records(
+                request.start_date,
+                request.end_date,
+                request.user_id,
+                with_user=True,
+                batch_size=REPORT_BATCH_SIZE,
+            )
+            table = render_hr_report(attendance_records, start_date, end_date)
+    elif request.view == "Summary":
+        if record_count < 1:
+            return Report(text="No attendance record to download")
+        if use_analytics():
+            frame = analytics.load_summaries(
+                start_date.date(), end_date.date(), request.user_id
+            )
+            table = analytics.render_summary_report(frame, start_date, end_date)
+        else:
+            summaries = DailyAttendanceSummary.get_summaries(
+                start_date.date(),
+                end_date.date(),
+                request.user_id,
+                batch_size=REPORT_BATCH_SIZE,
+            )
+            table = render_summary_report(summaries, start_date, end_date)
+    else:
+        if record_count == 0:
+            return Report(text="No attendance record found")
+        elif record_count <= 2 and text_only:
+            attendance_records = Attendance.get_attendance_records(
+                request.start_date, request.end_date, request.user_id
+            )
+            return Report(
+                text=render_text_report(attendance_records, start_date, end_date)
+            )
+        user = User.get_by_user_id(request.user_id, only_active=False)
+        if use_analytics():
+            frame = analytics.load_attendance(
+                request.start_date, request.end_date, request.user_id
+            )
+            table = analytics.render_employee_report(user, frame, start_date, end_date)
+        else:
+            attendance_records = Attendance.get_attendance_records(
+                request.start_date,
+                request.end_date,
+                request.user_id,
+                batch_size=REPORT_BATCH_SIZE,
+            )
+            table = render_employee_report(
+                user, attendance_records, start_date, end_date
+            )
+
+    file_name = f"Attendance-{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}"
+    return Report(
+        document=export_report(table, request.export_format),
+        file_name=f"{file_name}.{request.export_format}",
+    )
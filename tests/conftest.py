@@ -0,0 +1,53 @@
+"""
+Shared setup of the tests; runs before any module of the bot is imported
+
+Tests run on a throw away SQLite database in a temporary directory unless
+DATABASE_URL is set, e.g. to a local PostgreSQL:
+
+    DATABASE_URL=postgresql+psycopg2://postgres@localhost/test python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+os.environ.setdefault("SUPER_HR_EMP_ID", "HR001")
+os.environ.setdefault("SUPER_HR_NAME", "Super HR")
+os.environ.setdefault("SUPER_HR_PWD", "test")
+os.environ.setdefault("BOT_TOKEN", "0:test")  # Never used to reach Telegram
+
+
+@pytest.fixture
+def db():
+    """
+    Database session; attendance & employees added by the test are removed after it
+    """
+    from db_backend import db_session
+    from models import (
+        Attendance,
+        DailyAttendanceSummary,
+        FaceReference,
+        SelfiePhoto,
+        User,
+    )
+
+    yield db_session
+    db_session.rollback()
+    for model in (SelfiePhoto, FaceReference, DailyAttendanceSummary, Attendance):
+        db_session.query(model).delete()
+    db_session.query(User).filter(User.employee_id != os.environ["SUPER_HR_EMP_ID"]).delete()
+    db_session.commit()
+    db_session.remove()
+
+
+@pytest.fixture
+def employee(db):
+    from models import User
+
+    user = User(employee_id="EMP1", fullname="Employee 1", role="Employee")
+    db.add(user)
+    db.commit()
+    return user
@@ -0,0 +1,148 @@
+import hashlib
+from io import BytesIO
+import os
+import threading
+import time
+
+import pytest
+
+import archive
+from archive import PHOTOS, THUMBNAILS, SelfieArchive
+
+
+class StubDownload:
+    """
+    Photos by file_id as Telegram serves them; counts downloads and can hold them
+    """
+
+    def __init__(self, photos: dict):
+        self.photos = photos
+        self.downloads = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, file_id: str):
+        self.release.wait(timeout=10)
+        self.downloads.append(file_id)
+        return self.photos[file_id]
+
+
+def jpeg(color: tuple):
+    image = archive.Image.new("RGB", (640, 480), color)
+    buffer = BytesIO()
+    image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def drain(selfie_archive: SelfieArchive):
+    while True:
+        stats = selfie_archive._jobs.stats()
+        if not stats["queued"] and not stats["running"]:
+            return
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "archive")
+
+
+def test_duplicate_file_unique_ids_are_skipped(directory):
+    # Telegram gives the same photo another file_id when it's sent again
+    download = StubDownload({"F1": b"selfie 1", "F1-again": b"selfie 1"})
+    selfie_archive = SelfieArchive(directory, download, max_size=10_000, workers=2)
+
+    download.release.clear()
+    assert selfie_archive.submit("F1", "U1")
+    assert not selfie_archive.submit("F1-again", "U1")  # Still downloading
+    download.release.set()
+    drain(selfie_archive)
+    assert not selfie_archive.submit("F1-again", "U1")  # Archived already
+    drain(selfie_archive)
+
+    assert download.downloads == ["F1"]
+    assert "U1" in selfie_archive
+    assert selfie_archive.stats()["photos"] == 1
+    selfie_archive.shutdown()
+
+
+def test_invalid_file_unique_id_is_not_archived(directory):
+    download = StubDownload({"F1": b"selfie"})
+    selfie_archive = SelfieArchive(directory, download, max_size=10_000)
+    assert not selfie_archive.submit("F1", "../../U1")
+    assert not selfie_archive.submit("F1", "")
+    drain(selfie_archive)
+    assert download.downloads == []
+    selfie_archive.shutdown()
+
+
+def test_path_is_content_addressed(directory):
+    content = jpeg((200, 120, 90))
+    download = StubDownload({"F1": content})
+    selfie_archive = SelfieArchive(directory, download, max_size=10_000_000)
+    selfie_archive.submit("F1", "AgADq1")
+    drain(selfie_archive)
+
+    # Stored under the file_unique_id, in a sub directory by its hash; not the file_id
+    shard = hashlib.sha1(b"AgADq1").hexdigest()[:2]
+    path = os.path.join(directory, PHOTOS, shard, "AgADq1.jpg")
+    assert selfie_archive.photo("AgADq1") == path
+    with open(path, "rb") as file:
+        assert file.read() == content
+    thumbnail = selfie_archive.thumbnail("AgADq1")
+    assert thumbnail == os.path.join(directory, THUMBNAILS, shard, "AgADq1.jpg")
+    with archive.Image.open(thumbnail) as image:
+        assert max(image.size) <= selfie_archive.thumbnail_size
+    assert selfie_archive.stats()["bytes"] == len(content) + os.path.getsize(thumbnail)
+    assert selfie_archive.photo("missing") is None
+    selfie_archive.shutdown()
+
+
+def test_eviction_respects_max_size(directory, monkeypatch):
+    monkeypatch.setattr(archive, "Image", None)  # No thumbnails; sizes are the photos'
+    photos = {f"F{i}": bytes([i]) * 100 for i in range(5)}
+    download = StubDownload(photos)
+    selfie_archive = SelfieArchive(directory, download, max_size=250, workers=1)
+    for i in range(5):
+        selfie_archive.submit(f"F{i}", f"U{i}")
+        drain(selfie_archive)
+        assert selfie_archive.stats()["bytes"] <= 250
+
+    # Oldest are removed from disk first
+    assert selfie_archive.stats() == {"photos": 2, "bytes": 200, "queued": 0}
+    for i in range(3):
+        assert selfie_archive.photo(f"U{i}") is None
+        assert not os.path.exists(selfie_archive.path(f"U{i}"))
+    for i in (3, 4):
+        assert os.path.getsize(selfie_archive.photo(f"U{i}")) == 100
+    selfie_archive.shutdown()
+
+    # Loaded again from disk
+    reloaded = SelfieArchive(directory, download, max_size=250)
+    assert reloaded.stats()["photos"] == 2
+    assert "U4" in reloaded and "U0" not in reloaded
+    # Lowering the limit evicts right away
+    smaller = SelfieArchive(directory, download, max_size=150)
+    assert smaller.stats()["photos"] == 1
+    reloaded.shutdown()
+    smaller.shutdown()
+
+
+def test_only_stale_partial_files_are_removed(directory):
+    download = StubDownload({})
+    SelfieArchive(directory, download, max_size=10_000).shutdown()
+    shard = os.path.join(directory, PHOTOS, "ab")
+    os.makedirs(shard)
+    stale, recent = os.path.join(shard, "stale.part"), os.path.join(shard, "recent.part")
+    for path in (stale, recent):
+        with open(path, "wb") as file:
+            file.write(b"partly downloaded")
+    an_hour_ago = time.time() - archive.PARTIAL_FILE_AGE - 1
+    os.utime(stale, (an_hour_ago, an_hour_ago))
+
+    # Recent ones may still be written by the running bot
+    selfie_archive = SelfieArchive(directory, download, max_size=10_000)
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)
+    assert selfie_archive.stats()["photos"] == 0
+    selfie_archive.shutdown()
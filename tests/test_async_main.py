@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from telebot import asyncio_helper, types
+
+from helpers import get_hashed
+
+CHAT_ID = 42
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """
+    Bot API calls made by the async runtime, answered without reaching Telegram
+    """
+    calls = []
+
+    async def process_request(token, url, method="get", params=None, files=None, **kwargs):
+        calls.append((url, params, files))
+        await asyncio.sleep(0)
+        message = {
+            "message_id": len(calls),
+            "date": int(time.time()),
+            "chat": {"id": CHAT_ID, "type": "private"},
+        }
+        if url == "sendDocument":
+            message["document"] = {"file_id": "D1", "file_unique_id": "UD1"}
+        return message
+
+    monkeypatch.setattr(asyncio_helper, "_process_request", process_request)
+    return calls
+
+
+@pytest.fixture
+def async_main(db):
+    import async_main
+
+    return async_main
+
+
+def update(update_id: int, **fields):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": CHAT_ID, "type": "private"},
+        "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Employee"},
+        **fields,
+    }
+    return types.Update.de_json({"update_id": update_id, "message": message})
+
+
+def handle(async_main, *updates):
+    asyncio.run(async_main.bot.process_new_updates(list(updates)))
+
+
+def replies(calls):
+    return [params["text"] for url, params, files in calls if url == "sendMessage"]
+
+
+def test_database_work_runs_off_the_event_loop(async_main):
+    async def thread_names():
+        return threading.current_thread().name, await async_main.run_db(
+            lambda: threading.current_thread().name
+        )
+
+    loop_thread, db_thread = asyncio.run(thread_names())
+    assert loop_thread == threading.current_thread().name
+    assert db_thread.startswith("db")
+
+
+def test_login_check_in_and_report(db, async_main, telegram):
+    from models import Attendance, User
+
+    db.add(
+        User(
+            employee_id="EMP1", fullname="Employee 1", role="Employee", temp_pwd=get_hashed("otp")
+        )
+    )
+    db.commit()
+    db.remove()
+
+    handle(async_main, update(1, text="/download"))
+    assert replies(telegram) == ["You are not yet logged in"]
+
+    handle(async_main, update(2, text="/login\nEMP1\notp"))
+    assert replies(telegram)[-1] == "Hello *Employee 1*"
+    # OTP can't be used again
+    handle(async_main, update(3, text="/login\nEMP1\notp"))
+    assert replies(telegram)[-1] == "Sorry, login failed; Try again"
+
+    photo = {"file_id": "F1", "file_unique_id": "U1", "width": 640, "height": 480, "file_size": 1}
+    handle(async_main, update(4, photo=[photo]))
+    handle(async_main, update(5, location={"latitude": 12.97, "longitude": 77.59}))
+    assert replies(telegram)[-1] == "Your attendance has been added 👍"
+    attendance = db.query(Attendance).one()
+    assert attendance.selfie_file_id == "F1"
+    assert attendance.location_time is not None
+
+    # Sent once generated by the report workers
+    handle(async_main, update(6, text="/download\ncsv"))
+    assert replies(telegram)[-1] == "Report is being prepared; it will be sent shortly"
+    url, params, files = telegram[-1]
+    assert url == "sendDocument"
+    assert params["reply_to_message_id"] == 6
+
+    handle(async_main, update(7, text="/logout"))
+    assert replies(telegram)[-1].startswith("You have been logged out")
+    handle(async_main, update(8, text="/logout"))
+    assert replies(telegram)[-1] == "You are not yet logged in"
+
+
+def test_hr_commands_need_an_hr(db, employee, async_main, telegram):
+    employee.temp_pwd = get_hashed("otp")
+    db.commit()
+    db.remove()
+
+    handle(async_main, update(1, text="/login\nEMP1\notp"))
+    handle(async_main, update(2, text="/deactive\nEMP1"))
+    assert replies(telegram)[-1] == "Sorry!! you can't use this command"
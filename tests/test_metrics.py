@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Logging set up as `python main.py` does, then metrics dumped every 50 ms
+DUMP = """
+import time
+import main
+import metrics
+main.configure_logging()
+metrics.start_log_dump(0.05)
+time.sleep(0.5)
+"""
+
+
+def test_log_dump_is_emitted():
+    # In a process of its own; logging is configured once per process
+    env = dict(os.environ, PYTHONPATH=ROOT, LOG_LEVEL="INFO")
+    result = subprocess.run(
+        [sys.executable, "-c", DUMP], env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    assert "INFO metrics: Metrics" in result.stderr
+    assert "# TYPE bot_handler_seconds histogram" in result.stderr
+
+
+def test_log_dump_follows_log_level():
+    env = dict(os.environ, PYTHONPATH=ROOT, LOG_LEVEL="WARNING")
+    result = subprocess.run(
+        [sys.executable, "-c", DUMP], env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Metrics" not in result.stderr
@@ -0,0 +1,157 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import Attendance
+from pairing import EXPIRED, LOCATION, OPENED, PAIRED, SELFIE, WAITING, PairingEngine
+from writer import GroupCommitWriter
+
+DELAY = 60
+NOW = datetime(2023, 7, 2, 3, 30)
+LOCATION_FIELDS = {"location": {"latitude": 12.97, "longitude": 77.59}}
+
+
+@pytest.fixture
+def engine(db):
+    return PairingEngine(GroupCommitWriter(max_batch=1), DELAY)
+
+
+def selfie(engine, user_id, punch_time, file_id="F1"):
+    return engine.punch(
+        user_id,
+        SELFIE,
+        punch_time,
+        selfie_file_id=file_id,
+        selfie_file_unique_id=f"U{file_id}",
+    )
+
+
+def location(engine, user_id, punch_time):
+    return engine.punch(user_id, LOCATION, punch_time, **LOCATION_FIELDS)
+
+
+def test_selfie_then_location_is_paired(db, employee, engine):
+    opened = selfie(engine, employee.id, NOW)
+    assert opened.outcome == OPENED
+    assert opened.missing == LOCATION
+    assert opened.seconds_left == DELAY
+    assert len(engine) == 1
+
+    paired = location(engine, employee.id, NOW + timedelta(seconds=20))
+    assert paired == (PAIRED, None, 40, opened.attendance_id)
+    assert len(engine) == 0
+
+    db.remove()
+    attendance = db.get(Attendance, opened.attendance_id)
+    assert attendance.selfie_file_id == "F1"
+    assert attendance.selfie_time == NOW
+    assert attendance.location == LOCATION_FIELDS["location"]
+    assert attendance.location_time == NOW + timedelta(seconds=20)
+
+
+def test_location_then_selfie_is_paired(db, employee, engine):
+    opened = location(engine, employee.id, NOW)
+    assert (opened.outcome, opened.missing) == (OPENED, SELFIE)
+    paired = selfie(engine, employee.id, NOW + timedelta(seconds=5))
+    assert (paired.outcome, paired.attendance_id) == (PAIRED, opened.attendance_id)
+    assert db.query(Attendance).count() == 1
+
+
+def test_same_half_twice_is_waiting(db, employee, engine):
+    opened = selfie(engine, employee.id, NOW)
+    waiting = selfie(engine, employee.id, NOW + timedelta(seconds=10), "F2")
+    assert waiting == (WAITING, LOCATION, 50, None)
+    # Ignored; the pending record keeps its first selfie
+    assert db.query(Attendance).count() == 1
+    paired = location(engine, employee.id, NOW + timedelta(seconds=15))
+    assert (paired.outcome, paired.attendance_id) == (PAIRED, opened.attendance_id)
+
+
+def test_expiry_boundary(db, employee, engine):
+    # The other half is accepted up to expires_at included
+    opened = selfie(engine, employee.id, NOW)
+    paired = location(engine, employee.id, NOW + timedelta(seconds=DELAY))
+    assert paired == (PAIRED, None, 0, opened.attendance_id)
+
+    # One second later it opens a new record
+    opened = selfie(engine, employee.id, NOW + timedelta(hours=1), "F2")
+    late = location(engine, employee.id, NOW + timedelta(hours=1, seconds=DELAY + 1))
+    assert late.outcome == EXPIRED
+    assert late.missing == LOCATION  # Of the timed out record
+    assert late.seconds_left == 0
+    assert late.attendance_id != opened.attendance_id
+
+    # The new record waits for its own other half
+    paired = selfie(engine, employee.id, NOW + timedelta(hours=1, seconds=DELAY + 2), "F3")
+    assert (paired.outcome, paired.attendance_id) == (PAIRED, late.attendance_id)
+    db.remove()
+    assert db.get(Attendance, opened.attendance_id).location_time is None
+
+
+def test_users_are_paired_separately(db, employee, engine):
+    from models import User
+
+    other = User(employee_id="EMP2", fullname="Employee 2", role="Employee")
+    db.add(other)
+    db.commit()
+    first = selfie(engine, employee.id, NOW)
+    second = location(engine, other.id, NOW)
+    assert first.outcome == second.outcome == OPENED
+    assert location(engine, employee.id, NOW).attendance_id == first.attendance_id
+    assert selfie(engine, other.id, NOW, "F2").attendance_id == second.attendance_id
+
+
+def test_warm_loads_pending_punches(db, employee, engine):
+    user_id = employee.id  # warm() removes the session
+    selfie(engine, user_id, NOW - timedelta(minutes=30))  # Expired before the window
+    completed = selfie(engine, user_id, NOW - timedelta(seconds=50), "F2")
+    location(engine, user_id, NOW - timedelta(seconds=45))
+    pending = location(engine, user_id, NOW - timedelta(seconds=20))
+
+    restarted = PairingEngine(GroupCommitWriter(max_batch=1), DELAY)
+    restarted.warm(NOW)
+    assert len(restarted) == 1
+    paired = selfie(restarted, user_id, NOW, "F3")
+    assert paired == (PAIRED, None, 40, pending.attendance_id)
+    assert paired.attendance_id != completed.attendance_id
+
+
+def test_warm_skips_completed_records(db, employee, engine):
+    user_id = employee.id  # warm() removes the session
+    selfie(engine, user_id, NOW - timedelta(seconds=30))
+    location(engine, user_id, NOW - timedelta(seconds=25))
+
+    restarted = PairingEngine(GroupCommitWriter(max_batch=1), DELAY)
+    restarted.warm(NOW)
+    assert len(restarted) == 0
+    assert selfie(restarted, user_id, NOW, "F2").outcome == OPENED
+
+
+def test_warm_with_grace_keeps_recently_expired_punches(db, employee, engine):
+    user_id = employee.id  # warm() removes the session
+    opened = selfie(engine, user_id, NOW - timedelta(seconds=DELAY + 30))
+
+    restarted = PairingEngine(GroupCommitWriter(max_batch=1), DELAY)
+    restarted.warm(NOW, grace=0)
+    assert len(restarted) == 0
+    restarted.warm(NOW, grace=60)
+    assert len(restarted) == 1
+    # Still expired, so the late half is told apart from a new punch
+    late = location(restarted, user_id, NOW)
+    assert (late.outcome, late.missing) == (EXPIRED, LOCATION)
+    assert late.attendance_id != opened.attendance_id
+
+
+def test_sweep(db, employee, engine):
+    selfie(engine, employee.id, NOW)
+    expires_at = NOW + timedelta(seconds=DELAY)
+
+    assert engine.sweep(expires_at) == 0  # Not expired yet at expires_at
+    assert engine.sweep(expires_at + timedelta(seconds=30), grace=60) == 0
+    assert len(engine) == 1
+    assert engine.sweep(expires_at + timedelta(seconds=61), grace=60) == 1
+    assert len(engine) == 0
+
+    # Once swept, a late other half opens a new record instead of EXPIRED
+    late = location(engine, employee.id, expires_at + timedelta(seconds=62))
+    assert late.outcome == OPENED
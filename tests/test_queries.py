@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+from models import Attendance, User
+
+START = datetime(2023, 7, 1, 18, 30)
+END = datetime(2023, 7, 2, 18, 30)
+
+
+def add_attendance(db, user_id, selfie_time, location_time="same"):
+    attendance = Attendance(
+        user_id=user_id,
+        selfie_time=selfie_time,
+        location_time=selfie_time if location_time == "same" else location_time,
+    )
+    db.add(attendance)
+    db.commit()
+    return attendance.id
+
+
+def test_attendance_records_in_range(db, employee):
+    inside = [
+        add_attendance(db, employee.id, START),  # Start is inclusive
+        add_attendance(db, employee.id, END - timedelta(seconds=1)),
+        add_attendance(db, employee.id, START + timedelta(hours=9)),
+    ]
+    add_attendance(db, employee.id, START - timedelta(seconds=1))
+    add_attendance(db, employee.id, END)  # End is exclusive
+    add_attendance(db, employee.id, START + timedelta(hours=1), None)  # Not completed
+    add_attendance(db, employee.id, END - timedelta(minutes=1), END)  # Location after end
+
+    records = Attendance.get_attendance_records(START, END, employee.id)
+    assert [record.id for record in records] == [inside[0], inside[2], inside[1]]
+
+    streamed = Attendance.get_attendance_records(START, END, employee.id, batch_size=2)
+    assert [record.id for record in streamed] == [inside[0], inside[2], inside[1]]
+
+    pairs = Attendance.get_attendance_records(START, END, with_user=True)
+    assert [(record.id, user.employee_id) for record, user in pairs] == [
+        (inside[0], "EMP1"),
+        (inside[2], "EMP1"),
+        (inside[1], "EMP1"),
+    ]
+
+
+def test_records_of_other_users_are_filtered(db, employee):
+    other = User(employee_id="EMP2", fullname="Employee 2", role="Employee")
+    db.add(other)
+    db.commit()
+    add_attendance(db, other.id, START)
+    add_attendance(db, employee.id, START + timedelta(hours=1))
+    add_attendance(db, other.id, START + timedelta(hours=2))
+
+    records = Attendance.get_attendance_records(START, END)
+    # Ordered by user & selfie time
+    assert [record.user_id for record in records] == [employee.id, other.id, other.id]
+    assert len(Attendance.get_attendance_records(START, END, employee.id)) == 1
+
+
+def test_utc_datetime_round_trip(db, employee):
+    local = timezone(timedelta(hours=5, minutes=30))
+    aware_id = add_attendance(db, employee.id, datetime(2023, 7, 2, 9, 0, 15, tzinfo=local))
+    naive_id = add_attendance(db, employee.id, datetime(2023, 7, 2, 3, 30, 15, 250000))
+    db.remove()
+
+    aware = db.get(Attendance, aware_id)
+    naive = db.get(Attendance, naive_id)
+    # Read back as naive UTC whatever the offset it was written with
+    assert aware.selfie_time == datetime(2023, 7, 2, 3, 30, 15)
+    assert aware.selfie_time.tzinfo is None
+    assert naive.selfie_time == datetime(2023, 7, 2, 3, 30, 15, 250000)
+    # Compared in UTC by the range predicates
+    records = Attendance.get_attendance_records(
+        datetime(2023, 7, 2, 3, 30), datetime(2023, 7, 2, 3, 31)
+    )
+    assert {record.id for record in records} == {aware_id, naive_id}
+
+
+def test_data_version(db, employee):
+    empty = Attendance.get_data_version(START, END)
+    assert empty == (0, None)
+
+    first = add_attendance(db, employee.id, START + timedelta(hours=1))
+    assert Attendance.get_data_version(START, END) == (1, first)
+
+    # Records outside the range or not completed don't change the version
+    add_attendance(db, employee.id, END + timedelta(hours=1))
+    pending = add_attendance(db, employee.id, START + timedelta(hours=2), None)
+    assert Attendance.get_data_version(START, END) == (1, first)
+
+    # Completing a record does
+    Attendance.complete(pending, location_time=START + timedelta(hours=2))
+    db.commit()
+    assert Attendance.get_data_version(START, END) == (2, pending)
+    assert Attendance.get_data_version(START, END, employee.id) == (2, pending)
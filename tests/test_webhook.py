@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from webhook import WebhookServer
+
+SECRET = "test_secret-1"
+
+# Update as Telegram posts it when an employee shares their location
+PAYLOAD = os.path.join(os.path.dirname(__file__), "payloads", "location_update.json")
+with open(PAYLOAD, "rb") as file:
+    UPDATE = file.read()
+
+
+@pytest.fixture
+def server():
+    received = []
+    release = threading.Event()
+    release.set()
+
+    def dispatch(updates):
+        release.wait(timeout=10)
+        received.extend(updates)
+
+    server = WebhookServer(
+        dispatch, SECRET, host="127.0.0.1", port=0, queue_size=1, workers=1
+    )
+    server.received = received
+    server.release = release
+    server.start()
+    yield server
+    release.set()
+    server.stop()
+
+
+def post(server, body: bytes = UPDATE, secret: str = SECRET, path: str = "/webhook"):
+    host, port = server.address
+    request = urllib.request.Request(
+        f"http://{host}:{port}{path}",
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": secret,
+        },
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_update_is_dispatched(server):
+    assert post(server) == 200
+    server.updates.join()
+    [update] = server.received
+    assert update.update_id == 815309741
+    assert update.message.chat.id == 1887658587
+    assert update.message.location.latitude == pytest.approx(22.572646)
+
+
+def test_bad_secret_is_rejected(server):
+    assert post(server, secret="wrong") == 403
+    assert post(server, secret="") == 403
+    assert server.updates.empty() and not server.received
+
+
+def test_wrong_path_is_not_found(server):
+    assert post(server, path="/other") == 404
+    assert server.updates.empty() and not server.received
+
+
+@pytest.mark.parametrize(
+    "body",
+    [b"not json", b"null", b"[1, 2]", b'"update"', json.dumps({"message": {}}).encode()],
+)
+def test_bad_body_is_rejected(server, body):
+    assert post(server, body=body) == 400
+    assert server.updates.empty() and not server.received
+
+
+def test_full_queue_asks_telegram_to_retry(server):
+    server.release.clear()
+    assert post(server) == 200  # Taken by the only worker, which waits
+    while not server.updates.empty():
+        time.sleep(0.01)
+    assert post(server) == 200  # Waits in the queue
+    assert post(server) == 503  # Queue is full; Telegram delivers it again later
+    server.release.set()
+    server.updates.join()
+    assert len(server.received) == 2
+
+
+def test_null_body_does_not_stop_workers(server):
+    for _ in range(3):
+        assert post(server, body=b"null") == 400
+    # The only worker is still there to handle real updates
+    assert post(server) == 200
+    server.updates.join()
+    assert len(server.received) == 1
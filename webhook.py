@@ -0,0 +1,126 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import json
+import logging
+import queue
+import threading
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # Tells a worker to stop
+
+
+class WebhookServer:
+    """
+    HTTP server accepting Telegram updates pushed to the webhook; updates are put on a
+    bounded queue and dispatched to the handlers by a fixed number of worker threads
+    """
+
+    def __init__(
+        self,
+        dispatch,
+        secret_token: str,
+        host: str = "0.0.0.0",
+        port: int = 8443,
+        path: str = "/webhook",
+        queue_size: int = 100,
+        workers: int = 4,
+    ):
+        """
+        :param dispatch: function processing a list of updates; e.g. bot.process_new_updates
+        :param secret_token: secret sent by Telegram in X-Telegram-Bot-Api-Secret-Token header
+        :param host: interface to listen on
+        :param port: port to listen on
+        :param path: URL path of the webhook
+        :param queue_size: maximum number of updates waiting to be handled
+        :param workers: number of updates handled concurrently
+        """
+        self.dispatch = dispatch
+        self.secret_token = secret_token
+        self.path = path
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.workers = [
+            threading.Thread(target=self._work, name=f"webhook-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self.httpd = ThreadingHTTPServer((host, port), self._request_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def _request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self.send_error(404)
+                secret_token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(secret_token, server.secret_token):
+                    return self.send_error(403)
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    data = json.loads(self.rfile.read(length))
+                    # de_json returns None for null; anything but an object isn't an update
+                    update = types.Update.de_json(data) if isinstance(data, dict) else None
+                except (ValueError, TypeError, KeyError):
+                    update = None
+                if update is None:
+                    return self.send_error(400)
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    # Telegram will deliver the update again later
+                    return self.send_error(503)
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return WebhookRequestHandler
+
+    def _work(self):
+        while True:
+            update = self.updates.get()
+            if update is _STOP:
+                break
+            try:
+                self.dispatch([update])
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+            finally:
+                self.updates.task_done()
+
+    def start(self):
+        """
+        Start dispatching updates and serving requests in background
+        """
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        for worker in self.workers:
+            worker.start()
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop accepting updates and finish the ones already queued
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in self.workers:
+            self.updates.put(_STOP)
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
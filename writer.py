@@ -0,0 +1,127 @@
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+
+from db_backend import db_session, engine
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """
+    Apply database writes of concurrent handlers in a single writer thread and commit
+    them together; a batch is committed once it has max_batch writes or when no more
+    writes arrive with in max_delay. Writes are applied in the order they are submitted.
+    """
+
+    def __init__(self, max_batch: int = 50, max_delay: float = 0.002, name: str = "writer"):
+        """
+        :param max_batch: maximum number of writes committed together; 1 applies and
+            commits every write right away in the caller's thread
+        :param max_delay: time in seconds to wait for more writes before committing
+        :param name: name of the writer thread
+        """
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._writes = queue.Queue()
+        self._thread = None
+        self._connection = None
+        self._stopping = False
+        self._lock = threading.Lock()  # Nothing is queued after the writer is told to stop
+        if max_batch > 1:
+            # Handlers wait for their writes while holding connections; the writer keeps
+            # one of its own so that it never waits for them
+            self._connection = engine.connect()
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+
+    def submit(self, write, *args, **kwargs) -> Future:
+        """
+        Queue a write
+        :param write: function adding or changing records through db_session; called with
+            args & kwargs in the writer thread
+        :return: future resolved with result of write once it has been committed; records
+            are detached from the writer's session by then, so return plain values
+        """
+        future = Future()
+        with self._lock:
+            queued = self._thread is not None and not self._stopping
+            if queued:
+                self._writes.put((future, write, args, kwargs))
+        if not queued:
+            # Caller's session is kept; it may still hold records the caller uses
+            self._flush([(future, write, args, kwargs)], expunge=False)
+        return future
+
+    def write(self, write, *args, **kwargs):
+        """
+        Apply a write and wait until it has been committed; the next read sees it
+        :return: result of write
+        """
+        return self.submit(write, *args, **kwargs).result()
+
+    def _run(self):
+        db_session(bind=self._connection)
+        while True:
+            item = self._writes.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._writes.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+            if stopping:
+                break
+
+    def _flush(self, batch: list, expunge: bool = True):
+        try:
+            results = [write(*args, **kwargs) for _, write, args, kwargs in batch]
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            if len(batch) == 1:
+                batch[0][0].set_exception(e)
+            else:
+                # Commit one by one so that a failing write doesn't fail the others
+                logger.warning("Group commit of %d writes failed; retrying one by one", len(batch))
+                for item in batch:
+                    self._flush([item])
+            return
+
+        if expunge:
+            db_session.expunge_all()
+        metrics.write_batch_size.observe(len(batch))
+        for (future, _, _, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def stop(self):
+        """
+        Commit the writes already queued and stop the writer thread
+        """
+        with self._lock:
+            if self._stopping or self._thread is None:
+                return
+            # Writes submitted from now on are committed right away in the caller's thread
+            self._stopping = True
+            self._writes.put(_STOP)
+        self._thread.join()
+        self._connection.close()
+        # Left behind when the writer thread died; commit them rather than leave callers waiting
+        while not self._writes.empty():
+            item = self._writes.get()
+            if item is not _STOP:
+                self._flush([item], expunge=False)